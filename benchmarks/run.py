@@ -0,0 +1,144 @@
+"""
+Run the smoqe benchmarks and report the time per call.
+
+Usage:
+
+    python benchmarks/run.py                        # all workloads
+    python benchmarks/run.py -k wrapper -o new.json # some, and save results
+    python benchmarks/run.py --compare old.json     # compare to saved results
+
+Each workload is timed in a number of runs. Each run makes enough calls to
+take about `--min-time` seconds, and gives one sample of the time per call.
+The median and 99th percentile of the samples are reported, so one slow
+run (e.g. from a garbage collection or another process) does not hide or
+fake a regression.
+"""
+__author__ = 'Dan Gunter <dkgunter@lbl.gov>'
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+# run from a checkout without installing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import smoqe
+from workloads import WORKLOADS
+
+
+def percentile(samples, p):
+    """Percentile of the samples, interpolating between the closest ranks.
+
+    :param samples: Values, sorted
+    :type samples: list(float)
+    :param p: Percentile, 0 to 100
+    :type p: float
+    :rtype: float
+    """
+    k = (len(samples) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(samples) - 1)
+    return samples[lo] + (samples[hi] - samples[lo]) * (k - lo)
+
+
+def calibrate(fn, min_time):
+    """Number of calls of `fn` that takes at least `min_time` seconds.
+    """
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        if time.perf_counter() - t0 >= min_time:
+            return number
+        number *= 2
+
+
+def bench(setup, runs=30, min_time=0.02):
+    """Time one workload.
+
+    The result cache of `to_mongo()` is turned off first,
+    so that what is timed is the translation itself.
+
+    :param setup: Function returning the function to time
+    :param runs: Number of samples
+    :type runs: int
+    :param min_time: Minimum time for one sample, in seconds
+    :type min_time: float
+    :return: Statistics, with times in microseconds per call
+    :rtype: dict
+    """
+    smoqe.set_cache_size(0)
+    fn = setup()
+    number = calibrate(fn, min_time)
+    samples = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - t0) / number * 1e6)
+    samples.sort()
+    return {'median_us': percentile(samples, 50), 'p99_us': percentile(samples, 99),
+            'min_us': samples[0], 'max_us': samples[-1],
+            'runs': runs, 'calls_per_run': number}
+
+
+def environment():
+    """Describe where the benchmarks were run, for the saved results.
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Run the smoqe benchmarks.')
+    parser.add_argument('-k', dest='pattern', default='',
+                        help='only run workloads whose name contains this')
+    parser.add_argument('-n', '--runs', type=int, default=30,
+                        help='samples per workload (default: %(default)d)')
+    parser.add_argument('--min-time', type=float, default=0.02,
+                        help='minimum seconds per sample (default: %(default)s)')
+    parser.add_argument('-o', '--output', metavar='FILE', help='save results as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare with saved results')
+    opts = parser.parse_args(args)
+    baseline = {}
+    if opts.compare:
+        with open(opts.compare) as f:
+            baseline = json.load(f)['results']
+    results = {}
+    print('{:<20s} {:>12s} {:>12s} {:>8s}'.format('workload', 'median(us)', 'p99(us)',
+                                                 'vs base' if baseline else ''))
+    for name, setup in WORKLOADS:
+        if opts.pattern not in name:
+            continue
+        try:
+            stats = bench(setup, runs=opts.runs, min_time=opts.min_time)
+        except ImportError as err:
+            # e.g. pymongo, for the wrapper workloads
+            print('{:<20s} skipped: {}'.format(name, err))
+            continue
+        results[name] = stats
+        ratio = ''
+        if name in baseline:
+            ratio = '{:.2f}x'.format(stats['median_us'] / baseline[name]['median_us'])
+        print('{:<20s} {:12.2f} {:12.2f} {:>8s}'.format(name, stats['median_us'],
+                                                       stats['p99_us'], ratio))
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,299 @@
+"""
+Workloads for the smoqe benchmarks.
+
+Usage:
+
+    from workloads import WORKLOADS
+    for name, setup in WORKLOADS:
+        fn = setup()    # function to time, takes no arguments
+        fn()
+
+Each workload is a name and a setup function. The setup function builds the
+inputs (generated from a fixed random seed, so runs are comparable) and
+returns the function to time.
+"""
+__author__ = 'Dan Gunter <dkgunter@lbl.gov>'
+
+import random
+
+import smoqe
+from smoqe.match import matcher
+
+# seed for the generated inputs
+SEED = 42
+
+_FIELDS = ['name', 'age', 'status', 'owner.id', 'tags', 'score', 'created', 'kind',
+           'meta/source', 'count']
+
+
+def _rng():
+    return random.Random(SEED)
+
+
+def _expression(rng, kinds=('eq', 'str', 'ineq', 'exists')):
+    field = rng.choice(_FIELDS)
+    kind = rng.choice(kinds)
+    if kind == 'eq':
+        return '{} = {:d}'.format(field, rng.randint(0, 1000))
+    if kind == 'str':
+        return '{} = "v{:d}"'.format(field, rng.randint(0, 1000))
+    if kind == 'ineq':
+        return '{} {} {}'.format(field, rng.choice(('>', '>=', '<', '<=')),
+                                 round(rng.uniform(-100, 100), 2))
+    if kind == 'exists':
+        return '{} exists {}'.format(field, rng.choice(('true', 'false')))
+    if kind == 'regex':
+        return '{} ~ "{}"'.format(field, rng.choice(('^abc', 'x.*y', '^[a-f0-9]+$', 'foo|bar',
+                                                     '\\d{3}-\\d{4}')))
+    if kind == 'type':
+        return '{} type {}'.format(field, rng.choice(('int', 'string', 'bool')))
+    # size
+    return '{} {} {:d}'.format(field, rng.choice(('size', 'size>', 'size<')), rng.randint(1, 10))
+
+
+def _conjunction(rng, n, **kw):
+    return ' and '.join(_expression(rng, **kw) for _ in range(n))
+
+
+def _translate(qry):
+    def run():
+        smoqe.to_mongo(qry)
+    return run
+
+
+def short_expr():
+    return _translate(_conjunction(_rng(), 2))
+
+
+def long_expr():
+    return _translate(_conjunction(_rng(), 200))
+
+
+def wide_or():
+    rng = _rng()
+    return _translate(' or '.join('(' + _conjunction(rng, 3) + ')' for _ in range(200)))
+
+
+def regex_heavy():
+    rng = _rng()
+    return _translate(' or '.join(_conjunction(rng, 5, kinds=('regex',)) for _ in range(20)))
+
+
+def size_type_heavy():
+    rng = _rng()
+    return _translate(' or '.join(_conjunction(rng, 5, kinds=('size', 'type')) for _ in range(20)))
+
+
+def list_form():
+    rng = _rng()
+    return _translate([[_expression(rng) for _ in range(25)] for _ in range(100)])
+
+
+def cache_hit():
+    qry = _conjunction(_rng(), 10)
+
+    def run():
+        smoqe.to_mongo(qry)
+    smoqe.set_cache_size(smoqe.query.DEFAULT_CACHE_SIZE)
+    run()
+    return run
+
+
+def compile_query():
+    qry = 'owner.id = :owner and age > :min and status ~ :pat and tags size :n'
+
+    def run():
+        smoqe.compile(qry)
+    return run
+
+
+def bind_query():
+    q = smoqe.compile('owner.id = :owner and age > :min and status ~ :pat and tags size :n')
+
+    def run():
+        q.bind(owner='u1', min=21, pat='^open', n=3)
+    return run
+
+
+def match_docs(adaptive=False):
+    rng = _rng()
+    docs = [{'name': 'v{:d}'.format(rng.randint(0, 1000)), 'age': rng.randint(0, 100),
+             'status': rng.choice(('open', 'closed', 'pending')),
+             'owner': {'id': rng.randint(0, 1000)},
+             'tags': ['t{:d}'.format(j) for j in range(rng.randint(0, 6))],
+             'score': rng.uniform(-100, 100)}
+            for _ in range(1000)]
+    match = matcher('age > 30 and status = "open" or tags size> 3 and score >= 0 '
+                    'or owner.id < 100 and name ~ "^v1"', adaptive=adaptive)
+
+    def run():
+        for doc in docs:
+            match(doc)
+    return run
+
+
+def _client(raw=False):
+    if raw:
+        from pymongo import MongoClient
+    else:
+        from smoqe.wrappers import MongoClient
+    # no server is contacted: find() only builds the cursor
+    return MongoClient(connect=False, serverSelectionTimeoutMS=1)
+
+
+def _collection():
+    return _client()['bench']['coll']
+
+
+def wrapper_find():
+    coll = _collection()
+    qry = _conjunction(_rng(), 5)
+
+    def run():
+        coll.find(qry)
+    return run
+
+
+def wrapper_find_dict():
+    """Baseline for `wrapper_find`: the same call with a MongoDB query.
+    """
+    coll = _collection()
+    spec = smoqe.to_mongo(_conjunction(_rng(), 5))
+
+    def run():
+        coll.find(spec)
+    return run
+
+
+def wrapper_find_cached():
+    """Same as `wrapper_find`, with the `to_mongo()` cache on, as in normal use.
+    """
+    coll = _collection()
+    qry = _conjunction(_rng(), 5)
+    smoqe.set_cache_size(smoqe.query.DEFAULT_CACHE_SIZE)
+
+    def run():
+        coll.find(qry)
+    return run
+
+
+def wrapper_handles():
+    """Attribute access to the database and collection, then find(), with the wrapper.
+    """
+    client = _client()
+    spec = smoqe.to_mongo(_conjunction(_rng(), 5))
+
+    def run():
+        client.app.events.find(spec)
+    return run
+
+
+def pymongo_handles():
+    """Baseline for `wrapper_handles`: the same calls with pymongo.
+    """
+    client = _client(raw=True)
+    spec = smoqe.to_mongo(_conjunction(_rng(), 5))
+
+    def run():
+        client.app.events.find(spec)
+    return run
+
+
+def _memstore(indexed):
+    from smoqe.memstore import Collection
+    rng = _rng()
+    coll = Collection({'id': i, 'age': rng.randint(0, 100), 'score': rng.random() * 1000,
+                       'status': rng.choice(('open', 'closed', 'pending'))}
+                      for i in range(100000))
+    if indexed:
+        coll.create_index('id')
+        coll.create_index('status')
+        coll.create_index('score', kind='sorted')
+    return coll
+
+
+def memstore_eq():
+    coll = _memstore(True)
+
+    def run():
+        coll.find('id = 12345 and status = "open"')
+    return run
+
+
+def memstore_range():
+    coll = _memstore(True)
+
+    def run():
+        coll.find('score > 500 and score < 505')
+    return run
+
+
+def memstore_scan():
+    """Baseline for the other memstore workloads: no indexes.
+    """
+    coll = _memstore(False)
+
+    def run():
+        coll.find('id = 12345 and status = "open"')
+    return run
+
+
+def _raw_batch():
+    import bson
+    rng = _rng()
+    return b''.join(bson.encode({
+        '_id': i, 'name': 'v{:d}'.format(rng.randint(0, 1000)), 'status': 'open',
+        'owner': {'id': rng.randint(0, 1000), 'name': 'u{:d}'.format(i)},
+        'events': [{'t': j, 'msg': 'm' * 20} for j in range(rng.randint(0, 100))],
+        'meta': {'k{:d}'.format(j): j for j in range(20)}, 'score': rng.random()})
+        for i in range(1000))
+
+
+def raw_decode_fields():
+    """Decode three fields of each document of a raw batch.
+    """
+    from smoqe.rawbson import FieldDecoder, documents
+    batch = _raw_batch()
+    decode = FieldDecoder.for_query('select name, owner.id where score > 0.5')
+
+    def run():
+        for doc in documents(batch):
+            decode(doc)
+    return run
+
+
+def bson_decode_all():
+    """Baseline for `raw_decode_fields`: decode the whole batch with bson.
+    """
+    import bson
+    batch = _raw_batch()
+
+    def run():
+        bson.decode_all(batch)
+    return run
+
+
+#: All workloads, as (name, setup function)
+WORKLOADS = [
+    ('short_expr', short_expr),
+    ('long_expr', long_expr),
+    ('wide_or', wide_or),
+    ('regex_heavy', regex_heavy),
+    ('size_type_heavy', size_type_heavy),
+    ('list_form', list_form),
+    ('cache_hit', cache_hit),
+    ('compile', compile_query),
+    ('bind', bind_query),
+    ('match_1000_docs', match_docs),
+    ('match_adaptive', lambda: match_docs(adaptive=True)),
+    ('wrapper_find', wrapper_find),
+    ('wrapper_find_dict', wrapper_find_dict),
+    ('wrapper_find_cached', wrapper_find_cached),
+    ('wrapper_handles', wrapper_handles),
+    ('pymongo_handles', pymongo_handles),
+    ('memstore_eq', memstore_eq),
+    ('memstore_range', memstore_range),
+    ('memstore_scan', memstore_scan),
+    ('raw_decode_fields', raw_decode_fields),
+    ('bson_decode_all', bson_decode_all),
+]
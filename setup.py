@@ -6,15 +6,18 @@ setup(
     version="0.1.2",
     packages=find_packages(),
     py_modules = ['ez_setup'],
-# TBD:
-#    entry_point={
-#        'console_scripts': [
-#             'smoqer = smoq.query:main'
-#        ]
-#    },
+    entry_points={
+        'console_scripts': [
+             'smoqe = smoqe.query:main'
+        ]
+    },
     # Project uses reStructuredText, so ensure that the docutils get
     # installed or upgraded on the target machine
     install_requires =['docutils>=0.3'],
+    extras_require={
+        'vectorized': ['numpy'],
+        'arrow': ['pyarrow>=14'],
+    },
     package_data={
         # If any package contains *.txt or *.rst files, include them:
         '': ['*.txt', '*.rst'],
@@ -8,6 +8,12 @@ __maintainer__ = "Dan Gunter"
 __email__ = "dkgunter@lbl.gov"
 __status__ = "Development"
 
-from .query import to_mongo, BadExpression
+from .query import to_mongo, to_mongo_many, to_pipeline, BadExpression, BatchError
+from .query import to_find, to_find_spec, FindSpec
+from .query import cache_info, set_cache_size, clear_cache
+from .query import stats, reset_stats, enable_stats, disable_stats
+from .query import compile, CompiledQuery, fingerprint
+from .match import matcher
+from .schema import Schema
 from .wrappers import MongoClient
 
@@ -0,0 +1,305 @@
+"""
+Recommend MongoDB indexes for a workload of smoqe queries.
+
+Usage:
+
+    from smoqe.advisor import advise_indexes
+    advice = advise_indexes(['status = "open" and age > 3', 'status = "done"'],
+                            frequencies=[100, 5])
+    print(advice.report())
+
+Or, from the command line, with one query per line (optionally preceded
+by a count and a tab):
+
+    smoqe advise-indexes queries.txt
+
+Each predicate is classified as equality, range, exists, or not usable by
+an index. Compound indexes are recommended in equality-sort-range order,
+with the sort keys from the ``order by`` clause of a query (see
+:py:func:`smoqe.to_find_spec`), and indexes that are a prefix of another
+one are folded into it.
+"""
+__author__ = 'Dan Gunter <dkgunter@lbl.gov>'
+
+from collections import Counter, OrderedDict
+import sys
+
+from .query import BadExpression, _canonical, _group_constraints, _parse_find
+
+# Predicate classes, and the class for sort keys
+EQUALITY, RANGE, EXISTS, UNUSABLE = 'equality', 'range', 'exists', 'unusable'
+SORT = 'sort'
+
+# regex characters that end a literal prefix
+_REGEX_SPECIAL = set('.^$*+?{}[]\\|()')
+
+
+def classify(constraint, where=False):
+    """Classify a constraint by how an index can serve it.
+
+    :param constraint: The constraint
+    :type constraint: smoqe.query.Constraint
+    :param where: Whether type and size comparisons go into $where clauses,
+                  see `to_mongo()`
+    :type where: bool
+    :return: Class (EQUALITY, RANGE, EXISTS, UNUSABLE) and, if unusable, the reason
+    :rtype: (str, str)
+    """
+    op, name = constraint.op, constraint.field.full_name
+    if op.is_eq():
+        return EQUALITY, None
+    if op.is_inequality():
+        return RANGE, None
+    if op.is_exists():
+        return EXISTS, None
+    if op.is_neq():
+        return UNUSABLE, '$ne on {}'.format(name)
+    if op.is_regex():
+        pattern = constraint.value.pattern
+        if pattern.startswith('^') and pattern[1:2] and pattern[1] not in _REGEX_SPECIAL:
+            # anchored with a literal prefix: scanned as a range of keys
+            return RANGE, None
+        return UNUSABLE, 'unanchored regex on {}'.format(name)
+    if op.is_type():
+        if where:
+            return UNUSABLE, '$where type check on {}'.format(name)
+        return RANGE, None
+    # size
+    if where and not op.is_size_eq():
+        return UNUSABLE, '$where size check on {}'.format(name)
+    if op.is_size_eq():
+        return UNUSABLE, '$size on {}'.format(name)
+    return UNUSABLE, '$expr size check on {}'.format(name)
+
+
+class IndexRecommendation(object):
+    """Recommended compound index.
+    """
+
+    def __init__(self, keys):
+        #: Index key, as a list of (field, direction) for pymongo's create_index()
+        self.keys = keys
+        #: Total frequency of the queries that can use it
+        self.weight = 0
+        #: Queries that can use it
+        self.queries = []
+
+    def add(self, expr, weight):
+        self.weight += weight
+        if expr not in self.queries:
+            self.queries.append(expr)
+
+    def __repr__(self):
+        return 'IndexRecommendation({!r}, weight={})'.format(self.keys, self.weight)
+
+
+class IndexAdvice(object):
+    """Result of analyzing a workload of queries.
+    """
+
+    def __init__(self):
+        #: Recommended indexes, most used first
+        self.indexes = []
+        #: Queries that cannot use any index: list of (query, [reasons])
+        self.unindexable = []
+        #: Queries that could not be parsed: list of (query, error details)
+        self.errors = []
+        #: Weighted count of each predicate class, by field
+        self.fields = OrderedDict()
+        #: Weighted count of the queries of each shape, by canonical text
+        #: (see :py:func:`smoqe.fingerprint`)
+        self.shapes = Counter()
+
+    def report(self):
+        """Human-readable report.
+
+        :rtype: str
+        """
+        lines = ['Recommended indexes:']
+        if not self.indexes:
+            lines.append('  (none)')
+        for ix in self.indexes:
+            keys = ', '.join('{}: {}'.format(f, d) for f, d in ix.keys)
+            lines.append('  {{{}}}  weight={} queries={:d}'.format(keys, ix.weight, len(ix.queries)))
+        lines.append('Query shapes: {:d} queries, {:d} shapes'.format(
+            sum(self.shapes.values()), len(self.shapes)))
+        for text, n in sorted(self.shapes.items(), key=lambda item: (-item[1], item[0])):
+            lines.append('  {}  ({})'.format(text or '(all documents)', n))
+        lines.append('Fields:')
+        for field, classes in self.fields.items():
+            counts = ', '.join('{}={}'.format(c, n) for c, n in sorted(classes.items()))
+            lines.append('  {}: {}'.format(field, counts))
+        if self.unindexable:
+            lines.append('Queries that cannot use an index:')
+            for expr, reasons in self.unindexable:
+                lines.append('  {}  ({})'.format(expr, '; '.join(reasons)))
+        if self.errors:
+            lines.append('Queries that could not be parsed:')
+            for expr, details in self.errors:
+                lines.append('  {}  ({})'.format(expr, details))
+        return '\n'.join(lines)
+
+
+def advise_indexes(queries, frequencies=None, where=False):
+    """Analyze a workload of queries and recommend indexes.
+
+    A query only avoids a collection scan if every "or"ed group in it can use
+    an index, so a query is reported as unindexable if any group has no
+    equality, range or exists predicate (and the query has no sort). For each
+    group, the recommended index has the equality fields first (most common
+    across the workload first), then the sort keys, with their directions, so
+    the server can return the documents in order without sorting them, then
+    the range and exists fields.
+
+    :param queries: Filter expressions, as for `to_mongo()`, optionally
+                    with clauses, as for `to_find_spec()`
+    :type queries: iterable of str or list
+    :param frequencies: How often each query runs; either a sequence parallel
+                        to `queries` or a dict keyed by query string. Default is 1.
+    :type frequencies: list or dict
+    :param where: Classify as for `to_mongo(where=True)`
+    :type where: bool
+    :return: Analysis and recommendations
+    :rtype: IndexAdvice
+    """
+    advice = IndexAdvice()
+    # parse everything first, to order the equality fields
+    parsed = []
+    eq_weight = Counter()
+    for i, expr in enumerate(queries):
+        weight = _frequency(frequencies, i, expr)
+        try:
+            groups, fields, sort, limit, skip = _parse_find(expr)
+            groups = [_group_constraints(g) for g in groups]
+        except BadExpression as err:
+            advice.errors.append((expr, str(err.details)))
+            continue
+        advice.shapes[_canonical(groups, fields, sort, limit, skip)] += weight
+        for name, _ in sort or ():
+            advice.fields.setdefault(name, Counter())[SORT] += weight
+        if sort and not groups:
+            # the sort alone can use an index
+            groups = [[]]
+        classified = []
+        for constraints in groups:
+            preds = []
+            for c in constraints:
+                cls, reason = classify(c, where=where)
+                name = c.field.full_name
+                advice.fields.setdefault(name, Counter())[cls] += weight
+                if cls == EQUALITY:
+                    eq_weight[name] += weight
+                preds.append((name, cls, reason))
+            classified.append(preds)
+        parsed.append((expr, weight, classified, sort))
+    # build an index for each group
+    by_keys = OrderedDict()
+    for expr, weight, classified, sort in parsed:
+        reasons = [] if classified else ['no constraints']
+        for preds in classified:
+            keys = _index_keys(preds, eq_weight, sort)
+            if keys:
+                by_keys.setdefault(tuple(keys), IndexRecommendation(keys)).add(expr, weight)
+            else:
+                reasons.extend(r for _, _, r in preds if r)
+        if reasons:
+            advice.unindexable.append((expr, reasons))
+    advice.indexes = _fold_prefixes(list(by_keys.values()))
+    return advice
+
+
+def _frequency(frequencies, i, expr):
+    if frequencies is None:
+        return 1
+    if isinstance(frequencies, dict):
+        # keyed by query string; list-form queries are not hashable
+        return frequencies.get(expr, 1) if isinstance(expr, str) else 1
+    return frequencies[i]
+
+
+def _index_keys(preds, eq_weight, sort=None):
+    eq, rng = [], []
+    for name, cls, _ in preds:
+        if cls == EQUALITY:
+            target = eq
+        elif cls in (RANGE, EXISTS):
+            target = rng
+        else:
+            continue
+        if name not in eq and name not in rng:
+            target.append(name)
+    # sort keys after the equality fields; sorting on those is a no-op
+    sort = [(f, d) for f, d in sort or () if f not in eq]
+    if not eq and not rng and not sort:
+        return []
+    eq.sort(key=lambda f: (-eq_weight[f], f))
+    sorted_fields = set(f for f, _ in sort)
+    return ([(f, 1) for f in eq] + sort +
+            [(f, 1) for f in rng if f not in sorted_fields])
+
+
+def _fold_prefixes(indexes):
+    """Fold each index that is a prefix of another into the longer one.
+    """
+    indexes.sort(key=lambda ix: -len(ix.keys))
+    kept = []
+    for ix in indexes:
+        longer = [k for k in kept if k.keys[:len(ix.keys)] == ix.keys]
+        if longer:
+            # fold into the most used of the longer indexes
+            target = max(longer, key=lambda k: k.weight)
+            for q in ix.queries:
+                target.add(q, 0)
+            target.weight += ix.weight
+        else:
+            kept.append(ix)
+    kept.sort(key=lambda ix: (-ix.weight, ix.keys))
+    return kept
+
+
+def read_workload(lines):
+    """Read queries, one per line, each optionally preceded by a count and a tab.
+    Blank lines and lines starting with '#' are skipped.
+
+    :return: Queries and their frequencies
+    :rtype: (list(str), list(int))
+    """
+    queries, frequencies = [], []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        count, sep, expr = line.partition('\t')
+        if sep and count.strip().isdigit():
+            queries.append(expr.strip())
+            frequencies.append(int(count))
+        else:
+            queries.append(line)
+            frequencies.append(1)
+    return queries, frequencies
+
+
+def main(args=None):
+    """Command-line program: smoqe advise-indexes [FILE]
+
+    :return: Exit status
+    :rtype: int
+    """
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog='smoqe advise-indexes',
+        description='Recommend MongoDB indexes for a workload of smoqe queries, '
+                    'one per line, optionally preceded by a count and a tab.')
+    parser.add_argument('file', metavar='FILE', nargs='?',
+                        help='input file (default: standard input)')
+    parser.add_argument('--where', action='store_true',
+                        help='classify type and size checks as $where clauses')
+    opts = parser.parse_args(args)
+    if opts.file:
+        with open(opts.file) as f:
+            queries, frequencies = read_workload(f)
+    else:
+        queries, frequencies = read_workload(sys.stdin)
+    advice = advise_indexes(queries, frequencies, where=opts.where)
+    print(advice.report())
+    return 0
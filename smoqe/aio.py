@@ -0,0 +1,126 @@
+"""
+Asyncio wrappers, for pymongo's asynchronous API.
+
+Usage:
+
+    from smoqe.aio import AsyncMongoClient, gather_queries
+    client = AsyncMongoClient()
+    coll = client.some_database.some_collection
+    # smoqe-style queries, as with smoqe.MongoClient
+    doc = await coll.find_one("beverage = 'beer' and IBU > 20")
+    # many queries, at most 8 at a time
+    results = await gather_queries(coll, ['IBU > 20', 'IBU > 40'], concurrency=8)
+
+`gather_queries()` works with any collection that has pymongo's asynchronous
+interface, including ones that are not wrapped.
+"""
+__author__ = 'Dan Gunter <dkgunter@lbl.gov>'
+
+import asyncio
+
+from .query import to_mongo_many
+from . import wrappers
+
+# default maximum number of queries in progress for `gather_queries()`
+DEFAULT_CONCURRENCY = 10
+
+have_async = False
+try:
+    from pymongo.asynchronous.mongo_client import AsyncMongoClient as _AsyncMongoClient
+    from pymongo.asynchronous.database import AsyncDatabase as _AsyncDatabase
+    from pymongo.asynchronous.collection import AsyncCollection as _AsyncCollection
+    have_async = True
+except ImportError:
+    pass
+
+
+async def gather_queries(coll, exprs, concurrency=DEFAULT_CONCURRENCY, method='find', **kwargs):
+    """Run many smoqe queries on a collection concurrently.
+
+    All the queries are translated before any is run, so a bad query
+    does not leave others half-done.
+
+    :param coll: Collection, with pymongo's asynchronous interface
+    :param exprs: Filter expressions, each as for `to_mongo()`
+    :type exprs: list
+    :param concurrency: Maximum number of queries in progress at a time
+    :type concurrency: int
+    :param method: Collection method to call with each query. For 'find', the
+                   result is the list of all matching documents.
+    :type method: str
+    :param kwargs: Other arguments for the method, e.g. `projection`
+    :return: Result of each query, in the same order as `exprs`
+    :rtype: list
+    :raises: BatchError, with the index of each query that cannot be parsed;
+             ValueError, if `concurrency` is less than 1
+    """
+    if concurrency < 1:
+        raise ValueError('concurrency must be at least 1: {}'.format(concurrency))
+    specs = to_mongo_many(exprs)
+    semaphore = asyncio.Semaphore(concurrency)
+    run_method = getattr(coll, method)
+
+    async def run(spec):
+        async with semaphore:
+            if method == 'find':
+                return await run_method(spec, **kwargs).to_list(None)
+            return await run_method(spec, **kwargs)
+
+    tasks = [asyncio.ensure_future(run(spec)) for spec in specs]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        # do not leave the other queries running
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+if have_async:
+
+    class AsyncCollection(_AsyncCollection):
+        """pymongo AsyncCollection whose query methods accept smoqe queries.
+        """
+
+    wrappers._wrap_collection_class(AsyncCollection, _AsyncCollection)
+
+    class AsyncDatabase(_AsyncDatabase):
+        """pymongo AsyncDatabase that returns wrapped collections,
+        with one handle per collection name.
+        """
+        def __init__(self, *args, **kwargs):
+            _AsyncDatabase.__init__(self, *args, **kwargs)
+            self._smoqe_collections = {}
+
+        def __getitem__(self, item):
+            try:
+                return self._smoqe_collections[item]
+            except KeyError:
+                return self._smoqe_collections.setdefault(item, AsyncCollection(self, item))
+
+        def __getattr__(self, item):
+            if item.startswith('_'):
+                raise AttributeError(item)
+            return self[item]
+
+    class AsyncMongoClient(_AsyncMongoClient):
+        """Drop-in replacement for pymongo.AsyncMongoClient.
+
+        As with :py:class:`smoqe.MongoClient`, the query methods of collections
+        (find, find_one, count_documents, update_many, delete_many, etc.)
+        accept a smoqe query string or list in place of the query argument.
+        """
+        def __init__(self, *args, **kwargs):
+            self._smoqe_databases = {}
+            _AsyncMongoClient.__init__(self, *args, **kwargs)
+
+        def __getitem__(self, item):
+            try:
+                return self._smoqe_databases[item]
+            except KeyError:
+                return self._smoqe_databases.setdefault(item, AsyncDatabase(self, item))
+
+        def __getattr__(self, item):
+            if item.startswith('_'):
+                raise AttributeError(item)
+            return self[item]
@@ -0,0 +1,236 @@
+"""
+Query results as Apache Arrow record batches, for DataFrames and Parquet files.
+
+Usage:
+
+    from smoqe import MongoClient
+    from smoqe.arrow import query_to_batches, to_table, write_parquet
+    coll = MongoClient().some_database.some_collection
+    for batch in query_to_batches(coll, 'select name, age where age > 30'):
+        ...                                     # pyarrow.RecordBatch
+    df = to_table(coll, 'status = "open" order by age').to_pandas()
+    n = write_parquet(coll, 'age > 30', 'older.parquet', batch_rows=100000)
+
+The columns are the fields named in the query (selected, filtered on and
+sorted by), unless an Arrow schema gives them, and only those fields are
+requested from the server. Documents are read `batch_rows` at a time and
+each batch is turned into Arrow arrays before the next one is read, so
+memory use depends on the batch size, not on the number of results.
+"""
+__author__ = 'Dan Gunter <dkgunter@lbl.gov>'
+
+import pyarrow as pa
+
+from .match import MISSING, field_getter
+from .query import to_find_spec, _projection
+
+# Default number of rows in each record batch
+BATCH_ROWS = 10000
+
+
+def query_to_batches(coll, expr, schema=None, batch_rows=BATCH_ROWS, **kwargs):
+    """Run a query and return the results as Arrow record batches.
+
+    Without a schema, the columns are the fields in the query, and their
+    types are inferred from the values; values that Arrow cannot hold, like
+    ObjectIds, become strings. When a batch needs a wider type than the
+    batches before it (a float in an integer column, a value in a column
+    that was all nulls), it has the wider type, and so do the batches after
+    it. Columns whose values have no common type become strings.
+    With a schema, each batch is cast to it, raising ArrowInvalid rather
+    than losing data.
+    With no fields in the query, the columns are the fields of the first
+    document.
+
+    :param coll: Collection, with pymongo's `find()`; need not be wrapped
+    :param expr: Query, as for `to_find_spec()`
+    :type expr: str or list
+    :param schema: Names and types of the columns; dotted names are
+                   embedded fields, and missing fields are null
+    :type schema: pyarrow.Schema
+    :param batch_rows: Number of rows in each batch (the last may have fewer)
+    :type batch_rows: int
+    :param kwargs: Other arguments for `find()`, which take precedence over
+                   the clauses of the query
+    :return: Iterator over the record batches
+    :rtype: iterator(pyarrow.RecordBatch)
+    :raises: BadExpression, if the query cannot be parsed;
+             ValueError, if `batch_rows` is less than 1
+    """
+    if batch_rows < 1:
+        raise ValueError('batch_rows must be at least 1: {}'.format(batch_rows))
+    spec = to_find_spec(expr, covered=True)
+    if schema is not None:
+        fields = schema.names
+    else:
+        fields = _query_fields(spec)
+    options = spec.options()
+    if fields:
+        options['projection'] = _projection(fields, True)
+    else:
+        options.pop('projection', None)
+    options['batch_size'] = batch_rows
+    options.update(kwargs)
+    cursor = coll.find(spec.filter, **options)
+    return _batches(cursor, fields, schema, batch_rows)
+
+
+def _batches(cursor, fields, schema, batch_rows):
+    getters = [field_getter(f) for f in fields]
+    fixed = schema is not None
+    docs = []
+    for doc in cursor:
+        docs.append(doc)
+        if len(docs) == batch_rows:
+            batch = _record_batch(docs, fields, getters, schema, fixed)
+            schema = batch.schema
+            if not getters:
+                fields = schema.names
+                getters = [field_getter(f) for f in fields]
+            docs = []
+            yield batch
+    if docs:
+        yield _record_batch(docs, fields, getters, schema, fixed)
+
+
+def _record_batch(docs, fields, getters, schema, fixed):
+    """Build a record batch from a list of documents.
+
+    The types of the columns are inferred from the values, then the batch
+    is cast to `schema`: the given one, if `fixed`, or else the schema of
+    the batches so far, widened as needed to hold this one. Casts never
+    lose data; one that would raises ArrowInvalid.
+    """
+    if not getters:
+        # columns from the first document
+        fields = list(docs[0])
+        getters = [field_getter(f) for f in fields]
+    columns = []
+    for get in getters:
+        values = [get(doc) for doc in docs]
+        columns.append(_array([None if v is MISSING else v for v in values]))
+    batch = pa.RecordBatch.from_arrays(columns, names=fields if schema is None else schema.names)
+    if schema is None:
+        return batch
+    if not fixed and batch.schema != schema:
+        schema = _widen(schema, batch.schema)
+    return batch.cast(schema)
+
+
+def _array(values):
+    """Build an Arrow array of the inferred type. Values that do not fit
+    one type (e.g. ObjectIds, or numbers mixed with strings) become strings.
+    """
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([None if v is None else str(v) for v in values], type=pa.string())
+
+
+def _widen(schema, other):
+    """Schema that can hold the columns of both schemas, e.g. float64
+    for int64 and float64, or the type of `other` for a column of nulls.
+    Columns of types with no common type become strings.
+    (`promote_options` needs pyarrow 14, hence the version in setup.py.)
+    """
+    try:
+        return pa.unify_schemas([schema, other], promote_options='permissive')
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        pass
+    fields = []
+    for a, b in zip(schema, other):
+        try:
+            fields.append(pa.unify_schemas([pa.schema([a]), pa.schema([b])],
+                                           promote_options='permissive').field(0))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            fields.append(pa.field(a.name, pa.string()))
+    return pa.schema(fields)
+
+
+def to_table(coll, expr, schema=None, batch_rows=BATCH_ROWS, **kwargs):
+    """Run a query and return the results as an Arrow table.
+
+    The arguments are those of `query_to_batches()`. Without a schema, all
+    the batches are cast to the schema of the last one, which can hold them all.
+
+    :rtype: pyarrow.Table
+    """
+    batches = list(query_to_batches(coll, expr, schema=schema, batch_rows=batch_rows,
+                                    **kwargs))
+    if schema is None:
+        if batches:
+            schema = batches[-1].schema
+            batches = [b.cast(schema) for b in batches]
+        else:
+            schema = pa.schema([(f, pa.null()) for f in
+                                _query_fields(to_find_spec(expr, covered=True))])
+    return pa.Table.from_batches(batches, schema=schema)
+
+
+# Most batches `write_parquet()` holds back while a column has only nulls
+PENDING_BATCHES = 10
+
+
+def write_parquet(coll, expr, path, schema=None, batch_rows=BATCH_ROWS, **kwargs):
+    """Run a query and write the results to a Parquet file,
+    one batch at a time.
+
+    The arguments are those of `query_to_batches()`, and the path of the file
+    (or a writable file object). Nothing is written if there are no results
+    and no schema.
+
+    Without a schema, the file gets the types of the first batches. While a
+    column has only nulls, up to `PENDING_BATCHES` batches are held back to
+    learn its type. Later batches are cast to the types of the file. If a
+    batch needs a wider type, e.g. a float in an integer column, ValueError
+    is raised rather than losing data; give a schema for such fields.
+
+    :return: Number of rows written
+    :rtype: int
+    :raises: ValueError, if a batch does not fit the types of the file
+    """
+    import pyarrow.parquet as pq
+    writer, rows, pending = None, 0, []
+    try:
+        for batch in query_to_batches(coll, expr, schema=schema, batch_rows=batch_rows,
+                                      **kwargs):
+            if writer is None:
+                pending.append(batch)
+                if (schema is None and len(pending) < PENDING_BATCHES and
+                        any(pa.types.is_null(t) for t in batch.schema.types)):
+                    continue
+                writer = pq.ParquetWriter(path, batch.schema)
+                batches, pending = pending, []
+            else:
+                batches = [batch]
+            for b in batches:
+                if b.schema != writer.schema:
+                    try:
+                        b = b.cast(writer.schema)
+                    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+                        raise ValueError('results do not fit the Parquet schema, '
+                                         'give a schema: {} vs {}'.format(
+                                             b.schema, writer.schema))
+                writer.write_batch(b)
+                rows += b.num_rows
+        if pending:
+            writer = pq.ParquetWriter(path, pending[-1].schema)
+            for b in pending:
+                writer.write_batch(b.cast(writer.schema))
+                rows += b.num_rows
+        elif writer is None and schema is not None:
+            writer = pq.ParquetWriter(path, schema)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def _query_fields(spec):
+    """Fields named in a query.
+
+    :param spec: From `to_find_spec()`, with `covered`
+    :type spec: FindSpec
+    :rtype: list(str)
+    """
+    return [f for f, v in (spec.projection or {}).items() if v]
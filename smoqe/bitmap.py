@@ -0,0 +1,238 @@
+"""
+Bitmap indexes for evaluating smoqe queries over a fixed list of documents.
+
+Usage:
+
+    from smoqe.bitmap import BitmapIndex
+    index = BitmapIndex(docs, ['status', 'kind', 'flagged'])
+    rows = index.find('status = "open" and flagged = true or kind != "bug"')
+    n = index.count('status = "open" and age > 30')
+
+There is one bitset (a Python int, bit `i` for document `i`) per distinct
+value of each indexed field, and one for the documents that have the
+field. Constraints on indexed fields are evaluated with bitwise operations:
+AND within a group and OR across groups. Other constraints are checked
+document by document, but only for the documents that the indexed
+constraints of their group leave. This suits fields with few distinct
+values (status, enums, booleans).
+
+NumPy is used, if installed, to build the bitsets and to list row ids.
+"""
+__author__ = 'Dan Gunter <dkgunter@lbl.gov>'
+
+from .match import MISSING, _conjunction, compile_constraint, field_getter
+from .memstore import _NUM, _key, _keys
+from .query import ConstraintOperator, QueryCache, _cache_key, _group_constraints, _split_groups
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Number of parsed queries kept by each index
+PLAN_CACHE_SIZE = 256
+
+# bit positions set in each byte value
+_BYTE_BITS = [tuple(b for b in range(8) if byte >> b & 1) for byte in range(256)]
+
+
+def _bitset(rows, n):
+    """Bitset with the bits for `rows` set.
+
+    :param rows: Row numbers
+    :type rows: list(int)
+    :param n: Number of rows
+    :rtype: int
+    """
+    if np is not None:
+        flags = np.zeros(n, dtype=bool)
+        flags[rows] = True
+        return int.from_bytes(np.packbits(flags, bitorder='little').tobytes(), 'little')
+    data = bytearray((n + 7) // 8)
+    for i in rows:
+        data[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(bytes(data), 'little')
+
+
+def row_ids(bits, n):
+    """Row numbers of the bits that are set.
+
+    :param bits: Bitset
+    :type bits: int
+    :param n: Number of rows
+    :type n: int
+    :return: Row numbers, in order
+    :rtype: list(int)
+    """
+    data = bits.to_bytes((n + 7) // 8, 'little')
+    if np is not None:
+        flags = np.unpackbits(np.frombuffer(data, dtype=np.uint8), bitorder='little')
+        return np.flatnonzero(flags).tolist()
+    rows = []
+    for i, byte in enumerate(data):
+        if byte:
+            base = i << 3
+            rows.extend(base + b for b in _BYTE_BITS[byte])
+    return rows
+
+
+def _popcount(bits):
+    try:
+        return bits.bit_count()
+    except AttributeError:  # Python < 3.10
+        return bin(bits).count('1')
+
+
+class _FieldBitmaps(object):
+    """Bitsets for one field: one per distinct value, and one for presence.
+    """
+    __slots__ = ('values', 'exists')
+
+    def __init__(self, docs, field):
+        get = field_getter(field)
+        rows = {}
+        present = []
+        for i, doc in enumerate(docs):
+            value = get(doc)
+            if value is MISSING:
+                continue
+            present.append(i)
+            for k in _keys(value):
+                rows.setdefault(k, []).append(i)
+        n = len(docs)
+        self.values = {k: _bitset(r, n) for k, r in rows.items()}
+        self.exists = _bitset(present, n)
+
+
+class _Group(object):
+    """Parsed "and"ed group of a query, split into the constraints
+    answered by bitmaps and a predicate for the rest.
+    """
+    __slots__ = ('indexed', 'residual')
+
+    def __init__(self, constraints, fields):
+        self.indexed = []
+        rest = []
+        for c in constraints:
+            if c.field.full_name in fields and _bitmap_op(c.op):
+                self.indexed.append(c)
+            else:
+                rest.append(compile_constraint(c))
+        self.residual = _conjunction(tuple(rest)) if rest else None
+
+
+def _bitmap_op(op):
+    """Whether a constraint with this operator is answered by the bitmaps.
+    """
+    return op.is_equality() or op.is_exists() or op.is_inequality()
+
+
+class BitmapIndex(object):
+    """Bitmap indexes over a fixed list of documents.
+    """
+
+    def __init__(self, docs, fields):
+        """Build the bitmaps.
+
+        :param docs: The documents; row `i` is `docs[i]`. The list should not be
+                     changed afterwards; build a new index instead.
+        :type docs: list(dict)
+        :param fields: Names of the fields to index, dotted for embedded fields
+        :type fields: list(str)
+        """
+        self._docs = docs
+        self._n = len(docs)
+        self._all = (1 << self._n) - 1
+        self._fields = {f: _FieldBitmaps(docs, f) for f in fields}
+        self._plans = QueryCache(PLAN_CACHE_SIZE)
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def fields(self):
+        """Indexed fields, with the number of distinct values of each.
+
+        :rtype: dict
+        """
+        return {f: len(b.values) for f, b in self._fields.items()}
+
+    def bitmap(self, qry):
+        """Evaluate a query to a bitset.
+
+        :param qry: Filter expression(s), as for `to_mongo()`
+        :type qry: str or list
+        :return: Bitset, with bit `i` set if document `i` matches
+        :rtype: int
+        :raises: BadExpression, if the query cannot be parsed
+        """
+        groups = self._plan(qry)
+        if groups is None:
+            return self._all
+        result = 0
+        for group in groups:
+            bits = self._all
+            for c in group.indexed:
+                bits &= self._constraint_bits(c)
+                if not bits:
+                    break
+            if bits and group.residual is not None:
+                docs, pred = self._docs, group.residual
+                bits = _bitset([i for i in row_ids(bits, self._n) if pred(docs[i])], self._n)
+            result |= bits
+        return result
+
+    def find(self, qry=""):
+        """Rows that match a query.
+
+        :param qry: Filter expression(s), as for `to_mongo()`
+        :type qry: str or list
+        :return: Row numbers (indexes in the document list), in order
+        :rtype: list(int)
+        :raises: BadExpression, if the query cannot be parsed
+        """
+        return row_ids(self.bitmap(qry), self._n)
+
+    def count(self, qry=""):
+        """Number of rows that match a query.
+
+        :rtype: int
+        """
+        return _popcount(self.bitmap(qry))
+
+    def explain(self, qry):
+        """Describe how a query would be evaluated.
+
+        :return: For each "and"ed group, the number of 'indexed' constraints and
+                 whether documents are checked for the rest ('residual')
+        :rtype: list(dict)
+        """
+        return [{'indexed': len(g.indexed), 'residual': g.residual is not None}
+                for g in self._plan(qry) or ()]
+
+    def _plan(self, qry):
+        if qry == "" or qry == []:
+            return None
+        key = _cache_key(qry)
+        groups = None if key is None else self._plans.get(key)
+        if groups is None:
+            groups = tuple(_Group(_group_constraints(g), self._fields)
+                           for g in _split_groups(qry))
+            if key is not None:
+                self._plans.put(key, groups)
+        return groups
+
+    def _constraint_bits(self, c):
+        fb = self._fields[c.field.full_name]
+        op = c.op
+        if op.is_exists():
+            return fb.exists if c.value else self._all & ~fb.exists
+        if op.is_inequality():
+            test, value, bits = ConstraintOperator.PY_INEQ[str(op)], c.value, 0
+            for (tag, v), b in fb.values.items():
+                if tag == _NUM and test(v, value):
+                    bits |= b
+            return bits
+        k = _key(c.value)
+        bits = 0 if k is None else fb.values.get(k, 0)
+        return self._all & ~bits if op.is_neq() else bits
@@ -0,0 +1,416 @@
+"""
+Evaluate smoqe queries against documents in memory,
+without a round trip to the database.
+
+Usage:
+
+    from smoqe.match import matcher
+    match = matcher('a > 3 and b = "hello" or c exists false')
+    hits = [doc for doc in docs if match(doc)]
+
+The semantics follow those of the MongoDB query produced by
+:py:func:`smoqe.to_mongo` for the same expression.
+"""
+__author__ = 'Dan Gunter <dkgunter@lbl.gov>'
+
+from numbers import Number
+
+from .query import ConstraintOperator, _group_constraints, _split_groups
+
+# Value of a field that is not in the document
+MISSING = object()
+
+# Names of the types for `type`, as written in a query
+_TYPE_NAMES = {Number: 'number', str: 'string', bool: 'bool'}
+
+
+def matcher(qry, adaptive=False):
+    """Compile a query into a predicate for documents.
+
+    Each constraint is turned into a function with its field path and
+    comparison bound ahead of time, so evaluation does no parsing or
+    dispatch on the operator.
+
+    Semantics follow MongoDB:
+
+        - fields are selected by dotted path (or `a/b`); arrays along the
+          path are searched element by element
+        - equality, inequality and regex match an array field if they match
+          any of its elements
+        - inequalities only match numbers, regexes only match strings,
+          and both are searches (not anchored unless the pattern is)
+        - `!=` matches documents without the field
+        - `type` matches an array if any element has the type
+        - `size` only matches arrays
+
+    :param qry: Filter expression(s), as for `to_mongo()`
+    :type qry: str or list
+    :param adaptive: Reorder the constraints and groups as documents are seen,
+                     see :py:class:`AdaptiveMatcher`
+    :type adaptive: bool
+    :return: Function taking a document (dict) and returning True if it matches
+    :rtype: function
+    :raises: BadExpression, if one of the input expressions cannot be parsed
+    """
+    if adaptive:
+        return AdaptiveMatcher(qry)
+    if qry == "" or qry == []:
+        return lambda doc: True
+    groups = [tuple(map(compile_constraint, _group_constraints(filter_exprs)))
+              for filter_exprs in _split_groups(qry)]
+    if len(groups) == 1:
+        return _conjunction(groups[0])
+
+    def match(doc):
+        for preds in groups:
+            for pred in preds:
+                if not pred(doc):
+                    break
+            else:
+                return True
+        return False
+    return match
+
+
+class AdaptiveMatcher(object):
+    """Predicate for documents that evaluates the constraints of each group
+    cheapest and most selective first, and the groups most likely to match
+    first, stopping as soon as the result is known.
+
+    The first order comes from a static cost for each kind of constraint
+    (`COSTS`). After that, every `sample_every`-th document is checked
+    against every constraint, to measure how often each one passes
+    without the bias of early exit, and every `reorder_every` samples,
+    the order is recomputed: constraints by increasing cost / (1 - pass rate),
+    groups by increasing expected cost / match rate. While the order stays
+    the same, the interval between samples doubles, up to `max_sample_every`,
+    so that a stable workload pays little for sampling.
+
+    Results are the same as for :py:func:`matcher`; only the speed changes.
+    """
+
+    # Relative cost of evaluating each kind of constraint
+    COSTS = {'equality': 1.0, 'exists': 1.0, 'inequality': 1.5, 'type': 2.0,
+             'size': 3.0, 'regex': 10.0}
+    # Extra cost for an embedded field
+    PATH_COST = 1.0
+
+    def __init__(self, qry, sample_every=16, reorder_every=16, max_sample_every=1024):
+        """Compile a query.
+
+        :param qry: Filter expression(s), as for `to_mongo()`
+        :type qry: str or list
+        :param sample_every: Check every constraint for one document in this many
+        :type sample_every: int
+        :param reorder_every: Recompute the order after this many sampled documents
+        :type reorder_every: int
+        :param max_sample_every: Longest interval between samples
+        :type max_sample_every: int
+        :raises: BadExpression, if one of the input expressions cannot be parsed
+        """
+        self._sample_every = sample_every
+        self._max_sample_every = max_sample_every
+        self._interval = self._countdown = sample_every
+        self._reorder_every = reorder_every
+        self._order = None
+        # groups of [function, description, cost, evaluations, passes], and
+        # for each group, [evaluations, matches]
+        self._groups, self._group_counts = [], []
+        if qry == "" or qry == []:
+            # one empty group, which matches everything
+            self._groups.append([])
+            self._group_counts.append([0, 0])
+        else:
+            for filter_exprs in _split_groups(qry):
+                self._groups.append([[compile_constraint(c), _describe(c), self._cost(c), 0, 0]
+                                     for c in _group_constraints(filter_exprs)])
+                self._group_counts.append([0, 0])
+        self._samples = 0
+        self._reorder()
+
+    @classmethod
+    def _cost(cls, c):
+        op = c.op
+        if op.is_equality():
+            kind = 'equality'
+        elif op.is_exists():
+            kind = 'exists'
+        elif op.is_inequality():
+            kind = 'inequality'
+        elif op.is_type():
+            kind = 'type'
+        elif op.is_size():
+            kind = 'size'
+        else:
+            kind = 'regex'
+        cost = cls.COSTS[kind]
+        if '.' in c.field.full_name:
+            cost += cls.PATH_COST
+        return cost
+
+    def __call__(self, doc):
+        self._countdown -= 1
+        if not self._countdown:
+            self._countdown = self._interval
+            return self._sample(doc)
+        for preds in self._order:
+            for pred in preds:
+                if not pred(doc):
+                    break
+            else:
+                return True
+        return False
+
+    def _sample(self, doc):
+        """Check every constraint, and count the results.
+        """
+        result = False
+        for group, counts in zip(self._groups, self._group_counts):
+            ok = True
+            for stats in group:
+                stats[3] += 1
+                if stats[0](doc):
+                    stats[4] += 1
+                else:
+                    ok = False
+            counts[0] += 1
+            if ok:
+                counts[1] += 1
+                result = True
+        self._samples += 1
+        if self._samples % self._reorder_every == 0:
+            self._reorder()
+        return result
+
+    @staticmethod
+    def _rate(n, k):
+        # estimated probability from k successes in n trials (Laplace)
+        return (k + 1.0) / (n + 2.0)
+
+    def _reorder(self):
+        ranked = []
+        for group, (n, matches) in zip(self._groups, self._group_counts):
+            group.sort(key=lambda st: st[2] / (1.0 - self._rate(st[3], st[4])))
+            # expected cost with early exit
+            cost, reach = 0.0, 1.0
+            for st in group:
+                cost += reach * st[2]
+                reach *= self._rate(st[3], st[4])
+            ranked.append((cost / self._rate(n, matches), group))
+        ranked.sort(key=lambda x: x[0])
+        order = tuple(tuple(st[0] for st in group) for _, group in ranked)
+        if order == self._order:
+            self._interval = min(self._interval * 2, self._max_sample_every)
+        else:
+            self._interval = self._sample_every
+        self._order = order
+        self._ranked = [group for _, group in ranked]
+
+    def order(self):
+        """Current order of evaluation, for debugging.
+
+        :return: Groups, in order, each a list of its constraints in order,
+                 as dicts with the 'expr', its static 'cost', and the observed
+                 'pass_rate' (None before any sample)
+        :rtype: list(list(dict))
+        """
+        return [[{'expr': st[1], 'cost': st[2],
+                  'pass_rate': float(st[4]) / st[3] if st[3] else None} for st in group]
+                for group in self._ranked]
+
+
+def _describe(c):
+    """Text of a constraint, for debugging.
+    """
+    op, value = c.op, c.value
+    if op.is_regex():
+        value = '"{}"'.format(value.pattern)
+    elif op.is_type():
+        value = _TYPE_NAMES[value]
+    elif isinstance(value, str) and not op.is_variable():
+        value = '"{}"'.format(value)
+    elif isinstance(value, bool):
+        value = str(value).lower()
+    if op.is_variable():
+        text_op = 'size$'
+    elif op.is_size():
+        text_op = 'size' if op.is_size_eq() else 'size' + op.size_op
+    else:
+        text_op = str(op)
+    return '{} {} {}'.format(c.field.full_name, text_op, value)
+
+
+def _conjunction(preds):
+    if len(preds) == 1:
+        return preds[0]
+
+    def match_all(doc):
+        for pred in preds:
+            if not pred(doc):
+                return False
+        return True
+    return match_all
+
+
+def compile_constraint(constraint):
+    """Compile one constraint into a predicate for documents.
+
+    :param constraint: The constraint
+    :type constraint: smoqe.query.Constraint
+    :return: Function taking a document (dict) and returning True if it passes
+    :rtype: function
+    """
+    get = field_getter(constraint.field.full_name)
+    if constraint.op.is_variable():
+        # size compared to the value of another field in the same document
+        get_size = field_getter(constraint.value)
+
+        def pred_var(doc):
+            x, size = get(doc), get_size(doc)
+            return type(x) is list and _is_number(size) and len(x) == size
+        return pred_var
+    test = value_test(constraint.op, constraint.value)
+
+    def pred(doc):
+        return test(get(doc))
+    return pred
+
+
+def field_getter(path):
+    """Get function that extracts the value for a field path from a document.
+
+    For a path through an array of documents, the values found in each
+    element are returned as a list. If nothing is found, the function
+    returns `MISSING`.
+
+    :param path: Field name, dotted for embedded fields
+    :type path: str
+    :rtype: function
+    """
+    parts = tuple(path.split('.'))
+    if len(parts) == 1:
+        key = parts[0]
+
+        def get_top(doc):
+            return doc.get(key, MISSING)
+        return get_top
+
+    def get_path(doc):
+        return _resolve(doc, parts, 0)
+    return get_path
+
+
+def _resolve(value, parts, i):
+    n = len(parts)
+    while i < n:
+        key = parts[i]
+        if isinstance(value, dict):
+            value = value.get(key, MISSING)
+            if value is MISSING:
+                return MISSING
+        elif isinstance(value, list):
+            if key.isdigit() and int(key) < len(value):
+                value = value[int(key)]
+            else:
+                found = []
+                for item in value:
+                    if isinstance(item, dict):
+                        v = _resolve(item, parts, i)
+                        if isinstance(v, list):
+                            found.extend(v)
+                        elif v is not MISSING:
+                            found.append(v)
+                return found if found else MISSING
+        else:
+            return MISSING
+        i += 1
+    return value
+
+
+def _is_number(x):
+    t = type(x)
+    return t is int or t is float or (t is not bool and isinstance(x, Number))
+
+
+def value_test(op, value):
+    """Get function that tests a field value for an operator and target value.
+
+    The variable form of `size` depends on the whole document,
+    so it is handled by `compile_constraint()` instead.
+
+    :param op: Operator
+    :type op: ConstraintOperator
+    :param value: Target value, as in `Constraint.value`
+    :return: Function of the field value (or `MISSING`) returning a bool
+    :rtype: function
+    """
+    if op.is_eq():
+        return _eq_test(value)
+    if op.is_neq():
+        eq = _eq_test(value)
+        return lambda x: not eq(x)
+    if op.is_inequality():
+        return _any_test(_ineq_test(ConstraintOperator.PY_INEQ[str(op)], value))
+    if op.is_regex():
+        search = value.search
+        return _any_test(lambda x: type(x) is str and search(x) is not None)
+    if op.is_exists():
+        if value:
+            return lambda x: x is not MISSING
+        return lambda x: x is MISSING
+    if op.is_type():
+        return _type_test(value)
+    if op.is_size():
+        if op.is_size_gt():
+            return lambda x: type(x) is list and len(x) > value
+        if op.is_size_lt():
+            return lambda x: type(x) is list and len(x) < value
+        return lambda x: type(x) is list and len(x) == value
+    raise ValueError('unexpected operator: {}'.format(op))
+
+
+def _any_test(test):
+    """Extend a test of a single value to arrays: true if any element passes.
+    """
+    def test_any(x):
+        if type(x) is list:
+            for item in x:
+                if test(item):
+                    return True
+            return False
+        return test(x)
+    return test_any
+
+
+def _eq_test(value):
+    if isinstance(value, bool):
+        def test_bool(x):
+            if x is value:
+                return True
+            return type(x) is list and any(item is value for item in x)
+        return test_bool
+    if isinstance(value, str):
+        def test_str(x):
+            return x == value or (type(x) is list and value in x)
+        return test_str
+
+    def test_num(x):
+        if type(x) is list:
+            return any(item == value and type(item) is not bool for item in x)
+        return x == value and type(x) is not bool
+    return test_num
+
+
+def _ineq_test(fn, value):
+    def test(x):
+        return _is_number(x) and fn(x, value)
+    return test
+
+
+def _type_test(value):
+    # $type semantics: an array matches if any element has the type
+    if value is Number:
+        return _any_test(_is_number)
+    if value is bool:
+        return _any_test(lambda x: type(x) is bool)
+    return _any_test(lambda x: type(x) is value)
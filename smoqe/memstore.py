@@ -0,0 +1,539 @@
+"""
+In-memory collection of documents, queried with smoqe expressions
+and indexed for fast lookups.
+
+Usage:
+
+    from smoqe.memstore import Collection
+    coll = Collection()
+    coll.insert_many(docs)
+    coll.create_index('status')                 # hash: equality
+    coll.create_index('age', kind='sorted')     # sorted: equality and ranges
+    hits = coll.find('status = "open" and age > 30 and name ~ "^A"')
+    top = coll.find('status = "open" order by age desc limit 10')
+
+For each "and"ed group of a query, the planner looks up the equality
+constraints in hash or sorted indexes and the ranges (all the inequalities
+on one field together) in sorted indexes, then intersects the candidate
+sets, smallest first. For a field with arrays, each inequality is looked up
+on its own, since different elements can satisfy them. Only the candidates are checked against the whole
+group. A group with no indexed constraint is answered by a scan.
+Matching follows the same semantics as :py:func:`smoqe.matcher`.
+
+Queries for `find()` and `count()` can end with ``order by``, ``limit`` and
+``skip`` clauses, as for :py:func:`smoqe.to_find_spec`. With a limit and
+a sort in one direction, only the top documents are kept while sorting.
+Sorting compares values of different types in MongoDB's order.
+"""
+__author__ = 'Dan Gunter <dkgunter@lbl.gov>'
+
+from bisect import bisect_left
+import heapq
+from numbers import Number
+
+from .match import MISSING, _conjunction, compile_constraint, field_getter
+from .query import BadExpression, QueryCache, _cache_key, _group_constraints, _parse_find
+
+# Index kinds
+HASH, SORTED = 'hash', 'sorted'
+
+# Number of parsed queries kept by each collection
+PLAN_CACHE_SIZE = 256
+
+# Tags for indexed values, so values of different types never compare
+# (and True is not 1). Numbers sort first, for range scans.
+_NUM, _STR, _BOOL = 0, 1, 2
+
+_MAX = float('inf')
+_EMPTY = frozenset()
+
+
+def _key(value):
+    """Index key for a scalar value, or None if it cannot be indexed.
+    """
+    t = type(value)
+    if t is str:
+        return _STR, value
+    if t is bool:
+        return _BOOL, value
+    if t is int or t is float or isinstance(value, Number):
+        if value != value:
+            return None   # NaN matches nothing
+        return _NUM, value
+    return None
+
+
+def _keys(value):
+    """Index keys for a field value; an array is indexed by its elements.
+    """
+    if value is MISSING:
+        return ()
+    if type(value) is list:
+        keys = set()
+        for item in value:
+            k = _key(item)
+            if k is not None:
+                keys.add(k)
+        return keys
+    k = _key(value)
+    return () if k is None else (k,)
+
+
+class HashIndex(object):
+    """Index of the values of a field, for equality lookups.
+    """
+    kind = HASH
+
+    def __init__(self, field):
+        self.field = field
+        self._get = field_getter(field)
+        self._map = {}
+
+    def add(self, rid, doc):
+        for k in _keys(self._get(doc)):
+            ids = self._map.get(k)
+            if ids is None:
+                self._map[k] = {rid}
+            else:
+                ids.add(rid)
+
+    def remove(self, rid, doc):
+        for k in _keys(self._get(doc)):
+            ids = self._map.get(k)
+            if ids is not None:
+                ids.discard(rid)
+                if not ids:
+                    del self._map[k]
+
+    def equal(self, value):
+        """Ids of the documents where the field equals (or has an element equal to) `value`.
+
+        :rtype: set
+        """
+        k = _key(value)
+        return _EMPTY if k is None else self._map.get(k, _EMPTY)
+
+
+class SortedIndex(object):
+    """Index of the values of a field in sorted order,
+    for equality and range lookups.
+    """
+    kind = SORTED
+
+    def __init__(self, field):
+        self.field = field
+        self._get = field_getter(field)
+        # (tag, value, id), sorted; additions are sorted in at the next lookup
+        self._entries = []
+        self._pending = []
+        # number of documents with more than one key (arrays)
+        self._multi = 0
+
+    @property
+    def multikey(self):
+        """Whether some document has more than one value for the field,
+        so that the inequalities on it cannot be merged into one range.
+
+        :rtype: bool
+        """
+        return self._multi > 0
+
+    def add(self, rid, doc):
+        keys = _keys(self._get(doc))
+        if len(keys) > 1:
+            self._multi += 1
+        for tag, value in keys:
+            self._pending.append((tag, value, rid))
+
+    def remove(self, rid, doc):
+        entries = self._sorted()
+        keys = _keys(self._get(doc))
+        if len(keys) > 1:
+            self._multi -= 1
+        for tag, value in keys:
+            entry = (tag, value, rid)
+            i = bisect_left(entries, entry)
+            if i < len(entries) and entries[i] == entry:
+                del entries[i]
+
+    def _sorted(self):
+        if self._pending:
+            self._entries.extend(self._pending)
+            self._entries.sort()
+            self._pending = []
+        return self._entries
+
+    def _ids(self, start, end):
+        return {e[2] for e in self._entries[start:end]}
+
+    def equal(self, value):
+        """Ids of the documents where the field equals (or has an element equal to) `value`.
+
+        :rtype: set
+        """
+        k = _key(value)
+        if k is None:
+            return _EMPTY
+        entries = self._sorted()
+        start = bisect_left(entries, k)
+        end = bisect_left(entries, k + (_MAX,), start)
+        return self._ids(start, end)
+
+    def range(self, lo, lo_incl, hi, hi_incl):
+        """Ids of the documents where the field is (or has an element that is)
+        a number in a range.
+
+        :param lo: Lower bound, or None for no lower bound
+        :param lo_incl: Whether the lower bound is included
+        :param hi: Upper bound, or None for no upper bound
+        :param hi_incl: Whether the upper bound is included
+        :rtype: set
+        """
+        entries = self._sorted()
+        if lo is None:
+            start = bisect_left(entries, (_NUM,))
+        else:
+            start = bisect_left(entries, (_NUM, lo) if lo_incl else (_NUM, lo, _MAX))
+        if hi is None:
+            end = bisect_left(entries, (_STR,), start)
+        else:
+            end = bisect_left(entries, (_NUM, hi, _MAX) if hi_incl else (_NUM, hi), start)
+        return self._ids(start, end) if start < end else _EMPTY
+
+
+INDEX_KINDS = {HASH: HashIndex, SORTED: SortedIndex}
+
+
+def _sort_value(value, reverse):
+    """Key for sorting a field value, ordering types as MongoDB does.
+    An array sorts by its smallest element, or largest if `reverse`.
+    """
+    if type(value) is list:
+        if not value:
+            return (-1,)
+        keys = [_sort_value(v, reverse) for v in value]
+        return max(keys) if reverse else min(keys)
+    if value is MISSING or value is None:
+        return (0,)
+    if isinstance(value, bool):
+        return (5, value)
+    if isinstance(value, Number):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    # embedded documents, and anything else, compare equal
+    return (3,) if isinstance(value, dict) else (4,)
+
+
+class _Group(object):
+    """Parsed "and"ed group of a query: its predicate, and the
+    constraints that an index can answer.
+    """
+    __slots__ = ('pred', 'equal', 'ranges', 'bounds')
+
+    def __init__(self, constraints):
+        self.pred = _conjunction(tuple(map(compile_constraint, constraints)))
+        # (field, value) for each equality
+        self.equal = []
+        # field: [lo, lo_incl, hi, hi_incl], merging the inequalities on a field
+        self.ranges = {}
+        # field: list of the same, one for each inequality, for fields with arrays
+        self.bounds = {}
+        for c in constraints:
+            op, name = c.op, c.field.full_name
+            if op.is_eq():
+                self.equal.append((name, c.value))
+            elif op.is_inequality():
+                bounds = self.ranges.setdefault(name, [None, True, None, True])
+                self._tighten(bounds, str(op), c.value)
+                one = [None, True, None, True]
+                self._tighten(one, str(op), c.value)
+                self.bounds.setdefault(name, []).append(one)
+
+    @staticmethod
+    def _tighten(bounds, op, value):
+        if op[0] == '>':
+            incl = op == '>='
+            if bounds[0] is None or value > bounds[0] or (value == bounds[0] and not incl):
+                bounds[0], bounds[1] = value, incl
+        else:
+            incl = op == '<='
+            if bounds[2] is None or value < bounds[2] or (value == bounds[2] and not incl):
+                bounds[2], bounds[3] = value, incl
+
+
+class Collection(object):
+    """In-memory collection of documents.
+
+    Documents are stored as given, not copied, so do not modify a document
+    after inserting it: use `update()`, which keeps the indexes in step.
+    Results are in order of insertion.
+    """
+
+    def __init__(self, docs=None):
+        """Create, optionally with some documents.
+
+        :param docs: Initial documents
+        :type docs: iterable of dict
+        """
+        self._docs = {}
+        self._next_id = 0
+        self._indexes = {}
+        self._plans = QueryCache(PLAN_CACHE_SIZE)
+        if docs is not None:
+            self.insert_many(docs)
+
+    def __len__(self):
+        return len(self._docs)
+
+    def insert(self, doc):
+        """Add a document.
+
+        :param doc: The document
+        :type doc: dict
+        :return: Id of the document in this collection
+        :rtype: int
+        :raise: TypeError if the document is not a dict
+        """
+        if not isinstance(doc, dict):
+            raise TypeError('document must be a dict, got {}'.format(type(doc).__name__))
+        rid = self._next_id
+        self._next_id += 1
+        self._docs[rid] = doc
+        for ix in self._indexes.values():
+            ix.add(rid, doc)
+        return rid
+
+    def insert_many(self, docs):
+        """Add documents.
+
+        :return: Ids of the documents
+        :rtype: list(int)
+        """
+        return [self.insert(doc) for doc in docs]
+
+    def create_index(self, field, kind=HASH):
+        """Index a field. A field has at most one index; an existing one is replaced.
+
+        :param field: Field name, dotted for embedded fields
+        :type field: str
+        :param kind: 'hash' for equality lookups, 'sorted' for equality and ranges
+        :type kind: str
+        :raise: ValueError for an unknown kind
+        """
+        try:
+            ix = INDEX_KINDS[kind](field)
+        except KeyError:
+            raise ValueError('index kind must be one of {}: {}'.format(
+                ', '.join(sorted(INDEX_KINDS)), kind))
+        for rid, doc in self._docs.items():
+            ix.add(rid, doc)
+        self._indexes[field] = ix
+
+    def drop_index(self, field):
+        """Remove the index on a field.
+
+        :raise: KeyError if the field is not indexed
+        """
+        del self._indexes[field]
+
+    def index_information(self):
+        """Indexed fields.
+
+        :return: Kind of index, by field
+        :rtype: dict
+        """
+        return {field: ix.kind for field, ix in self._indexes.items()}
+
+    def find(self, qry=""):
+        """Find the documents that match a query.
+
+        :param qry: Filter expression(s), as for `to_mongo()`, optionally followed
+                    by ``order by``, ``limit`` and ``skip`` clauses
+        :type qry: str or list
+        :return: Matching documents, in the order of the sort keys if given,
+                 otherwise of insertion
+        :rtype: list(dict)
+        :raises: BadExpression, if the query cannot be parsed
+        """
+        docs = self._docs
+        return [docs[rid] for rid in self._select(qry)]
+
+    def find_one(self, qry=""):
+        """Find the first document that matches a query.
+
+        :return: The document, or None if there is none
+        :rtype: dict
+        """
+        ids = self._select(qry)
+        return self._docs[ids[0]] if ids else None
+
+    def count(self, qry=""):
+        """Number of documents that match a query,
+        after any ``skip`` and ``limit``.
+
+        :rtype: int
+        """
+        return len(self._select(qry))
+
+    def update(self, qry, values):
+        """Set field values in the documents that match a query.
+
+        :param qry: Filter expression(s), as for `to_mongo()`
+        :type qry: str or list
+        :param values: New value for each field, by name (dotted for embedded fields)
+        :type values: dict
+        :return: Number of documents updated
+        :rtype: int
+        """
+        ids = self._select(qry, options=False)
+        for rid in ids:
+            doc = self._docs[rid]
+            for ix in self._indexes.values():
+                ix.remove(rid, doc)
+            for name, value in values.items():
+                _set_path(doc, name, value)
+            for ix in self._indexes.values():
+                ix.add(rid, doc)
+        return len(ids)
+
+    def delete(self, qry):
+        """Remove the documents that match a query.
+
+        :param qry: Filter expression(s), as for `to_mongo()`
+        :type qry: str or list
+        :return: Number of documents removed
+        :rtype: int
+        """
+        ids = self._select(qry, options=False)
+        for rid in ids:
+            doc = self._docs.pop(rid)
+            for ix in self._indexes.values():
+                ix.remove(rid, doc)
+        return len(ids)
+
+    def explain(self, qry):
+        """Describe how a query would be answered.
+
+        :return: For each "and"ed group, the 'indexes' used, as a list of
+                 (field, kind), and whether the group needs a 'scan'
+        :rtype: list(dict)
+        """
+        plans = []
+        for group in self._plan(qry)[0] or ():
+            used = [(ix.field, ix.kind) for ix, _, _ in self._lookups(group)]
+            plans.append({'indexes': used, 'scan': not used})
+        return plans
+
+    def _plan(self, qry):
+        """Parse a query, or get it from the cache.
+
+        :return: Groups (None if there is no filter), sort keys as a list of
+                 (field getter, descending), limit and skip
+        :rtype: tuple
+        """
+        if qry == "" or qry == []:
+            return None, None, None, None
+        key = _cache_key(qry)
+        plan = None if key is None else self._plans.get(key)
+        if plan is None:
+            groups, _, sort, limit, skip = _parse_find(qry, select=False)
+            groups = tuple(_Group(_group_constraints(g)) for g in groups) or None
+            if sort is not None:
+                sort = [(field_getter(name), direction < 0) for name, direction in sort]
+            plan = groups, sort, limit, skip
+            if key is not None:
+                self._plans.put(key, plan)
+        return plan
+
+    def _lookups(self, group):
+        """Index lookups for a group: (index, method, args).
+        """
+        indexes = self._indexes
+        lookups = []
+        for name, value in group.equal:
+            ix = indexes.get(name)
+            if ix is not None:
+                lookups.append((ix, ix.equal, (value,)))
+        for name, bounds in group.ranges.items():
+            ix = indexes.get(name)
+            if ix is not None and ix.kind == SORTED:
+                if ix.multikey:
+                    # different elements of an array can satisfy each inequality
+                    lookups.extend((ix, ix.range, b) for b in group.bounds[name])
+                else:
+                    lookups.append((ix, ix.range, bounds))
+        return lookups
+
+    def _select(self, qry, options=True):
+        """Ids of the matching documents, in order.
+
+        :param options: Apply the sort, skip and limit of the query,
+                        instead of rejecting them
+        """
+        groups, sort, limit, skip = self._plan(qry)
+        if groups is None:
+            ids = list(self._docs)
+        elif len(groups) == 1:
+            ids = sorted(self._group_ids(groups[0]))
+        else:
+            ids = set()
+            for group in groups:
+                ids.update(self._group_ids(group))
+            ids = sorted(ids)
+        if sort is None and limit is None and skip is None:
+            return ids
+        if not options:
+            raise BadExpression(qry, "'order by', 'limit' and 'skip' are only allowed "
+                                     "in find(), find_one() and count()")
+        start = skip or 0
+        # as in MongoDB, limit 0 is no limit
+        end = start + limit if limit else None
+        if sort is not None:
+            ids = self._sort(ids, sort, end)
+        return ids[start:end]
+
+    def _sort(self, ids, sort, end):
+        """Sort ids by the documents' sort keys; if `end` is given,
+        only the first `end` are needed.
+        """
+        docs = self._docs
+        reverse = sort[0][1]
+        if all(desc == reverse for _, desc in sort):
+            getters = [get for get, _ in sort]
+
+            def key(rid):
+                doc = docs[rid]
+                return tuple(_sort_value(get(doc), reverse) for get in getters)
+            if end is not None and end < len(ids):
+                # top-k; equivalent to sorting and slicing
+                return (heapq.nlargest if reverse else heapq.nsmallest)(end, ids, key=key)
+            return sorted(ids, key=key, reverse=reverse)
+        # mixed directions: stable sorts, least significant key first
+        for get, desc in reversed(sort):
+            ids.sort(key=lambda rid: _sort_value(get(docs[rid]), desc), reverse=desc)
+        return ids
+
+    def _group_ids(self, group):
+        sets = [lookup(*args) for _, lookup, args in self._lookups(group)]
+        if not sets:
+            candidates = self._docs
+        elif len(sets) == 1:
+            candidates = sets[0]
+        else:
+            sets.sort(key=len)
+            candidates = sets[0].intersection(*sets[1:])
+        docs, pred = self._docs, group.pred
+        return [rid for rid in candidates if pred(docs[rid])]
+
+
+def _set_path(doc, name, value):
+    """Set the value of a (dotted) field, creating embedded documents as needed.
+    """
+    parts = name.split('.')
+    for part in parts[:-1]:
+        sub = doc.get(part)
+        if not isinstance(sub, dict):
+            sub = doc[part] = {}
+        doc = sub
+    doc[parts[-1]] = value
@@ -0,0 +1,337 @@
+"""
+Rewrite MongoDB queries from smoqe into cheaper equivalents.
+
+Usage:
+
+    import smoqe
+    q = smoqe.to_mongo('a = 1 or a = 2 or a = 3', optimize=True)
+    # {'a': {'$in': [1, 2, 3]}}
+
+The rewrites are:
+
+    - merge_ranges: combine bounds on the same field, keeping the tightest
+    - flatten_or: splice an '$or' nested directly in an '$or' branch
+    - duplicate: drop '$or' branches identical to an earlier one
+    - subsumed: drop '$or' branches that are narrower than another branch
+    - in_list: turn equality branches on the same field into '$in'
+    - hoist: move constraints shared by every '$or' branch out of the '$or'
+    - single_or: replace an '$or' of one branch by the branch itself
+
+All of them preserve MongoDB semantics, including for array fields.
+"""
+__author__ = 'Dan Gunter <dkgunter@lbl.gov>'
+
+from collections import Counter, defaultdict
+import logging
+from numbers import Number
+
+_log = logging.getLogger(__name__)
+
+# bounds, by whether they are lower (True) or upper (False) bounds
+_LOWER = {'$gt': True, '$gte': True, '$lt': False, '$lte': False}
+
+# maximum number of passes over a query
+MAX_PASSES = 10
+
+
+def optimize(query, verbose=False):
+    """Rewrite a MongoDB query into a cheaper equivalent.
+
+    :param query: MongoDB query, as from `to_mongo()`. It is not modified.
+    :type query: dict
+    :param verbose: Log each rewrite that fired, at INFO level
+    :type verbose: bool
+    :return: Optimized query
+    :rtype: dict
+    """
+    return QueryOptimizer(verbose=verbose).optimize(query)
+
+
+class QueryOptimizer(object):
+    """Optimizer for MongoDB queries, with a record of the rewrites done.
+    """
+
+    REWRITES = ('merge_ranges', 'flatten_or', 'duplicate', 'subsumed',
+                'in_list', 'hoist', 'single_or')
+
+    def __init__(self, rewrites=None, verbose=False):
+        """Create optimizer.
+
+        :param rewrites: Names of the rewrites to use (default is all), see `REWRITES`
+        :type rewrites: list(str)
+        :param verbose: Log each rewrite that fired, at INFO level
+        :type verbose: bool
+        :raise: ValueError for an unknown rewrite
+        """
+        if rewrites is None:
+            rewrites = self.REWRITES
+        unknown = set(rewrites).difference(self.REWRITES)
+        if unknown:
+            raise ValueError('unknown rewrite(s): {}'.format(', '.join(sorted(unknown))))
+        self._enabled = frozenset(rewrites)
+        self._verbose = verbose
+        self.fired = []
+
+    def optimize(self, query):
+        """Rewrite a query.
+
+        The names and details of the rewrites done are added to `fired`.
+
+        :param query: MongoDB query. It is not modified.
+        :type query: dict
+        :return: Optimized query
+        :rtype: dict
+        """
+        n = len(self.fired)
+        for _ in range(MAX_PASSES):
+            query = self._conjunction(query)
+            if len(self.fired) == n:
+                break
+            n = len(self.fired)
+        return query
+
+    def _fire(self, name, detail):
+        self.fired.append((name, detail))
+        if self._verbose:
+            _log.info('rewrite {}: {}'.format(name, detail))
+
+    def _on(self, name):
+        return name in self._enabled
+
+    def _conjunction(self, q):
+        """Optimize a query dict, whose keys are all "and"ed.
+        """
+        q = dict(q)
+        if '$and' in q:
+            q['$and'] = [self._conjunction(c) for c in q['$and']]
+            if self._on('merge_ranges'):
+                self._merge_ranges(q)
+        if self._on('merge_ranges'):
+            for field, value in q.items():
+                if not field.startswith('$') and isinstance(value, dict) and _is_ops(value):
+                    tight = _tighten(value)
+                    if tight is not None and len(tight) < len(value):
+                        self._fire('merge_ranges', '{}: {}'.format(field, value))
+                        q[field] = tight
+        if '$or' in q:
+            branches = self._disjunction([self._conjunction(b) for b in q.pop('$or')])
+            if branches is not None:
+                self._add_or(q, branches)
+        return q
+
+    def _add_or(self, q, branches):
+        if len(branches) == 1 and self._on('single_or'):
+            branch = branches[0]
+            if all(k not in q for k in branch):
+                self._fire('single_or', branch)
+                q.update(branch)
+                return
+        q['$or'] = branches
+        if self._on('hoist'):
+            self._hoist(q)
+
+    def _disjunction(self, branches):
+        """Optimize the branches of an '$or'.
+
+        :return: New branches, or None if one branch matches everything
+        """
+        if self._on('flatten_or'):
+            flat = []
+            for b in branches:
+                if list(b) == ['$or']:
+                    self._fire('flatten_or', b)
+                    flat.extend(b['$or'])
+                else:
+                    flat.append(b)
+            branches = flat
+        if self._on('duplicate'):
+            seen, unique = set(), []
+            for b in branches:
+                key = _freeze(b)
+                if key in seen:
+                    self._fire('duplicate', b)
+                else:
+                    seen.add(key)
+                    unique.append(b)
+            branches = unique
+        if self._on('subsumed'):
+            branches = self._drop_subsumed(branches)
+            if branches is None:
+                return None
+        if self._on('in_list'):
+            branches = self._in_list(branches)
+        return branches
+
+    def _drop_subsumed(self, branches):
+        if any(not b for b in branches):
+            self._fire('subsumed', 'a branch matches everything')
+            return None
+        items = [frozenset((k, _freeze(v)) for k, v in b.items()) for b in branches]
+        # a branch can only be subsumed by one whose rarest constraint it has,
+        # so index the branches by that constraint to avoid comparing all pairs
+        freq = Counter(it for s in items for it in s)
+        by_rarest = defaultdict(list)
+        for j, s in enumerate(items):
+            by_rarest[min(s, key=freq.__getitem__)].append(j)
+        keep = []
+        for i, s in enumerate(items):
+            if any(j != i and items[j] <= s and (items[j] != s or j < i)
+                   for it in s for j in by_rarest.get(it, ())):
+                self._fire('subsumed', branches[i])
+            else:
+                keep.append(branches[i])
+        return keep
+
+    def _in_list(self, branches):
+        result, by_field = [], {}
+        for b in branches:
+            field, values = _equality_values(b)
+            if field is None:
+                result.append(b)
+                continue
+            if field in by_field:
+                group = by_field[field]
+                for v in values:
+                    if _freeze(v) not in group['keys']:
+                        group['keys'].add(_freeze(v))
+                        group['values'].append(v)
+                group['count'] += 1
+            else:
+                group = {'values': list(values), 'keys': set(map(_freeze, values)),
+                         'count': 1, 'pos': len(result)}
+                by_field[field] = group
+                result.append(None)
+        for field, group in by_field.items():
+            values = group['values']
+            if group['count'] > 1:
+                self._fire('in_list', '{} in {}'.format(field, values))
+            if len(values) == 1:
+                result[group['pos']] = {field: values[0]}
+            else:
+                result[group['pos']] = {field: {'$in': values}}
+        return result
+
+    def _hoist(self, q):
+        branches = q['$or']
+        if len(branches) < 2:
+            return
+        shared = [k for k, v in branches[0].items()
+                  if not k.startswith('$') and k not in q and
+                  all(k in b and _freeze(b[k]) == _freeze(v) for b in branches[1:])]
+        if not shared:
+            return
+        for k in shared:
+            self._fire('hoist', {k: branches[0][k]})
+            q[k] = branches[0][k]
+        branches = [{k: v for k, v in b.items() if k not in shared} for b in branches]
+        if any(not b for b in branches):
+            # one branch is now empty, i.e. always true
+            del q['$or']
+        else:
+            q['$or'] = branches
+
+    def _merge_ranges(self, q):
+        """Fold single-field clauses in '$and' into the field's operators,
+        keeping only the tightest lower and upper bounds.
+        """
+        rest = []
+        for clause in q['$and']:
+            if len(clause) != 1:
+                rest.append(clause)
+                continue
+            (field, value), = clause.items()
+            cur = q.get(field, None)
+            merged = None
+            if field.startswith('$'):
+                pass
+            elif cur is None:
+                merged = value
+            elif isinstance(cur, dict) and isinstance(value, dict) and _is_ops(cur) and _is_ops(value):
+                merged = _merge_ops(cur, value)
+            if merged is None:
+                rest.append(clause)
+            else:
+                self._fire('merge_ranges', '{}: {} and {}'.format(field, cur, value))
+                q[field] = merged
+        if rest:
+            q['$and'] = rest
+        else:
+            del q['$and']
+
+
+def _is_ops(d):
+    return all(k.startswith('$') for k in d)
+
+
+def _merge_ops(a, b):
+    """Combine two operator dicts for the same field.
+
+    :return: New dict, or None if they cannot be combined
+    """
+    result = dict(a)
+    for op, value in b.items():
+        if op not in result:
+            result[op] = value
+            continue
+        cur = result[op]
+        if _freeze(cur) == _freeze(value):
+            continue
+        if op not in _LOWER or not (_is_number(cur) and _is_number(value)):
+            return None
+        if (value > cur) == _LOWER[op]:
+            result[op] = value
+    return _tighten(result)
+
+
+def _tighten(ops):
+    """Keep only one lower and one upper bound in an operator dict,
+    strict winning over inclusive at the same value.
+
+    :return: New dict, or None if the bounds cannot be compared
+    """
+    result = dict(ops)
+    for strict, incl in (('$gt', '$gte'), ('$lt', '$lte')):
+        if strict in result and incl in result:
+            lower = _LOWER[strict]
+            s, i = result[strict], result[incl]
+            if not (_is_number(s) and _is_number(i)):
+                return None
+            if (i > s) == lower and i != s:
+                del result[strict]
+            else:
+                del result[incl]
+    return result
+
+
+def _is_number(x):
+    return isinstance(x, Number) and not isinstance(x, bool)
+
+
+def _equality_values(branch):
+    """Values of a branch that is only an equality (or $in) on one field.
+
+    :return: Field and values, or (None, None)
+    """
+    if len(branch) != 1:
+        return None, None
+    (field, value), = branch.items()
+    if field.startswith('$'):
+        return None, None
+    if isinstance(value, dict):
+        if list(value) == ['$in']:
+            return field, value['$in']
+        return None, None
+    if isinstance(value, list):
+        return None, None
+    return field, [value]
+
+
+def _freeze(v):
+    """Hashable, order-independent form of a query value,
+    keeping values of different types apart (e.g. True and 1).
+    """
+    if isinstance(v, dict):
+        return ('dict', frozenset((k, _freeze(x)) for k, x in v.items()))
+    if isinstance(v, list):
+        return ('list', tuple(_freeze(x) for x in v))
+    return (type(v).__name__, v)
@@ -6,34 +6,389 @@ __author__ = "Dan Gunter"
 
 ## Imports
 # Standard library
-import copy
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor
+import functools
+import hashlib
 from numbers import Number
+import operator
+import os
 import re
+import sys
+import threading
+import time
+# Local
+from .optimizer import QueryOptimizer
 
 
 class BadExpression(Exception):
     """Raised by `query()` if the input is not understood.
     """
-    def __init__(self, expr, details=""):
+    def __init__(self, expr, details="", offset=None):
         self.expr = expr
         self.details = details
+        #: Position in `expr` where the error was found, if known
+        self.offset = offset
         Exception.__init__(self, "Bad expression")
 
 
-# or/and tokens
-_TOK_OR = " or "
-_TOK_AND = " and "
+class BatchError(BadExpression):
+    """Raised when translating many expressions at once, if any of them
+    is not understood. All the failures are reported in `errors`.
+    """
+    def __init__(self, errors):
+        """Create from the failures.
+
+        :param errors: For each failure, a tuple of its index in the input,
+                       the expression, and the details of the error
+        :type errors: list(tuple)
+        """
+        self.errors = errors
+        index, expr, details = errors[0]
+        BadExpression.__init__(self, expr, '{:d} bad expression(s), first at index {:d}: {}'.format(
+            len(errors), index, details))
+
+
+# default number of translated queries kept by `to_mongo()`
+DEFAULT_CACHE_SIZE = 1024
+
+
+class QueryCache(object):
+    """Bounded least-recently-used cache of translated queries.
+
+    Values are stored privately and handed out as copies, so callers
+    can freely modify what they get back.
+    """
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        """Create empty cache.
+
+        :param maxsize: Maximum number of entries, 0 disables caching
+        :type maxsize: int
+        :raise: ValueError for negative size
+        """
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._maxsize = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.resize(maxsize)
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    def get(self, key):
+        """Get a copy of the cached value for `key`.
+
+        :return: Cached value, or None if not present
+        """
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+        return _copy_query(value)
+
+    def put(self, key, value):
+        """Store a copy of `value` under `key`, evicting the
+        least-recently-used entry if the cache is full.
+        """
+        if self._maxsize == 0:
+            return
+        value = _copy_query(value)
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def resize(self, maxsize):
+        """Change maximum size, evicting entries as needed.
+
+        :param maxsize: Maximum number of entries, 0 disables caching
+        :type maxsize: int
+        :raise: ValueError for negative size
+        """
+        if not isinstance(maxsize, int) or maxsize < 0:
+            raise ValueError('cache size must be a non-negative integer: {}'.format(maxsize))
+        with self._lock:
+            self._maxsize = maxsize
+            while len(self._data) > maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Remove all entries and reset the statistics.
+        """
+        with self._lock:
+            self._data.clear()
+            self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def info(self):
+        """Cache statistics.
+
+        :return: Keys 'hits', 'misses', 'evictions', 'size' and 'maxsize'
+        :rtype: dict
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'size': len(self._data),
+                    'maxsize': self._maxsize}
+
+    def __len__(self):
+        return len(self._data)
+
+
+def _copy_query(q):
+    """Copy the dicts and lists of a query, sharing the (immutable) leaves.
+    Much faster than `copy.deepcopy` for the shapes produced here.
+    """
+    if isinstance(q, dict):
+        return {k: _copy_query(v) for k, v in q.items()}
+    if isinstance(q, list):
+        return [_copy_query(v) for v in q]
+    if type(q) is tuple:
+        return tuple(_copy_query(v) for v in q)
+    return q
+
+
+def _cache_key(qry):
+    """Build a cache key from a string or list query.
+
+    :return: Hashable key, or None if the input cannot be cached
+    """
+    if isinstance(qry, str):
+        return qry.strip()
+    try:
+        key = tuple(tuple(g) if isinstance(g, (list, tuple)) else g for g in qry)
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+_cache = QueryCache()
+
+
+def cache_info():
+    """Statistics for the `to_mongo()` cache.
+
+    :return: Keys 'hits', 'misses', 'evictions', 'size' and 'maxsize'
+    :rtype: dict
+    """
+    return _cache.info()
+
+
+def set_cache_size(maxsize):
+    """Set the maximum number of queries cached by `to_mongo()`.
+
+    :param maxsize: Maximum number of entries, 0 turns the cache off
+    :type maxsize: int
+    :raise: ValueError for negative size
+    """
+    _cache.resize(maxsize)
+
+
+def clear_cache():
+    """Empty the `to_mongo()` cache and reset its statistics.
+    """
+    _cache.clear()
+
+
+class QueryStats(object):
+    """Counters and per-stage timings for the translation of queries.
+
+    The stages are:
+
+        - translate: all of `to_mongo()` (or `to_find_spec()`) after a cache miss
+        - parse: parsing expressions into constraints, including
+        - constraint: building and checking the constraints, including
+        - regex: compiling regular expressions
+        - clause: building the MongoDB clause for each constraint
+        - assemble: combining the clauses into the query for each group
+        - optimize: see :py:mod:`smoqe.optimizer`
+
+    Work done by processes in a pool (`workers`) is not counted.
+    """
+    STAGES = ('translate', 'parse', 'constraint', 'regex', 'clause', 'assemble', 'optimize')
+    COUNTERS = ('queries', 'groups', 'expressions', 'errors', 'sorted')
+
+    def __init__(self, callback=None):
+        """Create with everything zero.
+
+        :param callback: Called after each query is translated,
+                         see `enable_stats()`
+        :type callback: function
+        """
+        self.callback = callback
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """Set all counters and timings to zero.
+        """
+        with self._lock:
+            self._time = dict.fromkeys(self.STAGES, 0.0)
+            self._calls = dict.fromkeys(self.STAGES, 0)
+            self._counts = dict.fromkeys(self.COUNTERS, 0)
+
+    def begin(self, qry):
+        """Start collecting for one query, in this thread.
+        """
+        self._local.record = {'query': qry, 'time': {}, 'calls': {},
+                              'groups': 0, 'expressions': 0, 'error': None, 'sort': None}
+
+    def end(self, error=None, sort=None):
+        """Finish collecting for the current query, add it to the totals
+        and pass it to the callback.
+
+        :param error: Details of the error, if the query could not be translated
+        :param sort: Sort keys of the query, if it has an ``order by`` clause
+        :type sort: list
+        """
+        rec, self._local.record = self._local.record, None
+        rec['error'] = error
+        rec['sort'] = sort
+        with self._lock:
+            for stage, seconds in rec['time'].items():
+                self._time[stage] += seconds
+                self._calls[stage] += rec['calls'][stage]
+            self._counts['queries'] += 1
+            self._counts['groups'] += rec['groups']
+            self._counts['expressions'] += rec['expressions']
+            if error is not None:
+                self._counts['errors'] += 1
+            if sort:
+                self._counts['sorted'] += 1
+        if self.callback is not None:
+            self.callback(rec)
+
+    def add(self, stage, seconds, calls=1):
+        """Add time spent in a stage.
+        """
+        rec = getattr(self._local, 'record', None)
+        if rec is None:
+            # outside of to_mongo(), e.g. parsing for matcher()
+            with self._lock:
+                self._time[stage] += seconds
+                self._calls[stage] += calls
+        else:
+            rec['time'][stage] = rec['time'].get(stage, 0.0) + seconds
+            rec['calls'][stage] = rec['calls'].get(stage, 0) + calls
+
+    def count(self, counter, n):
+        """Add to the 'groups' or 'expressions' counter.
+        """
+        rec = getattr(self._local, 'record', None)
+        if rec is None:
+            with self._lock:
+                self._counts[counter] += n
+        else:
+            rec[counter] += n
+
+    def timed(self, stage, fn, *args):
+        """Call `fn` with `args`, adding the time it takes to `stage`.
+        """
+        t0 = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.add(stage, time.perf_counter() - t0)
+
+    def snapshot(self):
+        """Current totals.
+
+        :return: Counters, by name, and for each stage, under 'stages',
+                 the total 'time' in seconds and the number of 'calls'
+        :rtype: dict
+        """
+        with self._lock:
+            result = dict(self._counts)
+            result['stages'] = {s: {'time': self._time[s], 'calls': self._calls[s]}
+                                for s in self.STAGES}
+        return result
+
+
+_collector = QueryStats()
+# the collector, while statistics are enabled
+_stats = None
+
+
+def enable_stats(callback=None):
+    """Start collecting statistics on translating queries, see `stats()`.
+    Until this is called, the only cost is a check at each stage.
+
+    :param callback: Called after `to_mongo()` translates a query (not for cache
+                     hits), with a dict of: 'query', 'time' and 'calls' for each
+                     stage that ran, counts of 'groups' and 'expressions',
+                     'error' (None, or details of why the query is bad), and
+                     'sort' (the sort keys, for `to_find_spec()`, or None).
+    :type callback: function
+    """
+    global _stats
+    _collector.callback = callback
+    _stats = _collector
+
+
+def disable_stats():
+    """Stop collecting statistics. The totals so far are kept.
+    """
+    global _stats
+    _stats = None
+
 
+def stats():
+    """Statistics on translating queries, while enabled by `enable_stats()`.
 
-def to_mongo(qry):
+    :return: Counts of 'queries', 'groups', 'expressions', 'errors' and
+             'sorted' (queries with an ``order by`` clause, see `to_find_spec()`),
+             'enabled', and under 'stages', for each stage (see
+             :py:class:`QueryStats`) the total 'time' in seconds and
+             number of 'calls'.
+    :rtype: dict
+    """
+    result = _collector.snapshot()
+    result['enabled'] = _stats is not None
+    return result
+
+
+def reset_stats():
+    """Set the statistics to zero.
+    """
+    _collector.reset()
+
+
+def to_mongo(qry, where=False, optimize=False, workers=None, schema=None):
     """Transform a simple query with one or more filter expressions
     into a MongoDB query expression.
 
     :param qry: Filter expression(s), see function docstring for details.
     :type qry: str or list
+    :param where: Use JavaScript ``$where`` clauses for the ``type`` and ``size``
+                  comparisons, as in older versions. By default these use ``$type``
+                  and ``$expr``, which do not need a JavaScript interpreter
+                  for each document.
+    :type where: bool
+    :param optimize: Rewrite the query into a cheaper equivalent, see
+                     :py:mod:`smoqe.optimizer`.
+    :type optimize: bool
+    :param workers: For a query with many groups (at least `PARALLEL_MIN_GROUPS`),
+                    number of processes to translate the groups in, or an
+                    executor to use, which is taken to have one worker per CPU.
+                    By default, groups are translated serially.
+    :type workers: int or concurrent.futures.Executor
+    :param schema: Field types and aliases, see :py:class:`smoqe.Schema`
+    :type schema: Schema
     :return: MongoDB query
     :rtype: dict
     :raises: BadExpression, if one of the input expressions cannot be parsed
+             (or, with a schema, cannot match a declared field);
+             BatchError, if translated in parallel, with the index of each bad group
 
     Expressions have three parts, called in order ``field``, ``operator``,
     and ``value``.
@@ -43,13 +398,15 @@ def to_mongo(qry):
             * numeric
             * string, you MUST use 'single' or "double" quotes
             * boolean: true, false
+            * parameter placeholder, ``:name`` (only with `compile()`)
         - `operator` is a comparison operator:
             * inequalities: >, <, =, <=, >=, !=
             * PCRE regular expression: ~
             * data type: int, float, string, or bool
             * exists: boolean (true/false) whether field exists in record
             * size: for array fields, an inequality for the array size, given as
-              a suffix to the operator: size>, size<
+              a suffix to the operator: size>, size<. With the suffix size$, the
+              value is the name of a field holding the size.
 
     Multiple expressions can be a single string, or a list.
     In either case, the form is a "disjunction of conjunctions".
@@ -64,9 +421,14 @@ def to_mongo(qry):
         * The inner list is a group of "and"ed expressions
         * The outer list "or"s the expression groups together.
 
-    In the string form, parentheses before or after the "or"ed expression
-    groups [note: even non-sensical ones like '((('], are ignored.
-    So these can be used to clarify the groupings.
+    In the string form, "and" binds more tightly than "or", and parentheses
+    group expressions, e.g. ``(a = 1 or b = 2) and c = 3``. Nested groupings
+    are expanded into the "disjunction of conjunctions" form, of at most
+    `MAX_GROUPS` groups for an "and" of parenthesized "or"s. Parentheses must
+    be balanced, and quoted values may contain "and" or "or". On an error,
+    `BadExpression.offset` is the position in the string where it was found.
+
+    In the list form, an item may also "and" several expressions together.
 
     **Examples**
 
@@ -84,40 +446,70 @@ def to_mongo(qry):
 
     >>> to_mongo([['a > 3', 'b = "hello"'], ['c > 1', 'd = "goodbye"']])
     {'$or': [{'a': {'$gt': 3}, 'b': 'hello'}, {'c': {'$gt': 1}, 'd': 'goodbye'}]}
+
+    Results are kept in a bounded least-recently-used cache, keyed by the input
+    (strings are stripped of leading and trailing whitespace). Each call returns
+    a fresh copy, so modifying the result does not affect later calls.
+    See `set_cache_size()`, `cache_info()` and `clear_cache()`.
     """
-    rev = False     # filters, not constraints
-    # special case for empty string/list
+    key = None
+    if _cache.maxsize > 0:
+        key = _cache_key(qry)
+        if key is not None:
+            key = (key, where, optimize, schema)
+            result = _cache.get(key)
+            if result is not None:
+                return result
+    collector = _stats
+    if collector is None:
+        result = _to_mongo(qry, where, workers, schema)
+        if optimize:
+            result = QueryOptimizer().optimize(result)
+    else:
+        result = _to_mongo_stats(collector, qry, where, optimize, workers, schema)
+    if key is not None:
+        _cache.put(key, result)
+    return result
+
+
+def _to_mongo_stats(collector, qry, where, optimize, workers, schema):
+    """Uncached `to_mongo()`, collecting statistics.
+    """
+    collector.begin(qry)
+    t0 = time.perf_counter()
+    error = None
+    try:
+        result = _to_mongo(qry, where, workers, schema)
+        if optimize:
+            result = collector.timed('optimize', QueryOptimizer().optimize, result)
+        return result
+    except BadExpression as err:
+        error = str(err.details)
+        raise
+    except Exception as err:
+        # e.g. ValueError for a bad size value, found when building clauses
+        error = str(err)
+        raise
+    finally:
+        collector.add('translate', time.perf_counter() - t0)
+        collector.end(error=error)
+
+
+def _to_mongo(qry, where=False, workers=None, schema=None):
+    """Uncached implementation of `to_mongo()`.
+    """
+    # special case for empty string/list/groups
     if qry == "" or qry == []:
         return {}
-    # break input into groups of filters
-    unpar = lambda s: s.strip().strip('()')
-    if isinstance(qry, str):
-        groups = []
-        if _TOK_OR in qry:
-            groups = [unpar(g).split(_TOK_AND) for g in qry.split(_TOK_OR)]
-        else:
-            groups = [unpar(qry).split(_TOK_AND)]
-    else:
-        if isinstance(qry[0], list) or isinstance(qry[0], tuple):
-            groups = qry
-        else:
-            groups = [qry]
     # generate mongodb queries for each filter group
-    filters = []
-    for filter_exprs in groups:
-        mq = MongoQuery()
-        for e in filter_exprs:
-            try:
-                e = unpar(e)
-            except AttributeError:
-                raise BadExpression(e, "expected string, got '{t}'".format(t=type(e)))
-            try:
-                constraint = Constraint(*parse_expr(e))
-            except ValueError as err:
-                raise BadExpression(e, err)
-            clause = MongoClause(constraint, rev=rev)
-            mq.add_clause(clause)
-        filters.append(mq.to_mongo(rev))
+    groups = _split_groups(qry, schema=schema)
+    if _stats is not None:
+        _stats.count('groups', len(groups))
+    if workers is not None and workers != 1 and len(groups) >= PARALLEL_MIN_GROUPS:
+        filters = _parallel_map(_group_chunk, groups, workers, (where, schema))
+    else:
+        filters = [_group_query(filter_exprs, where=where, schema=schema)[0]
+                   for filter_exprs in groups]
     # combine together filters, or strip down the one filter
     if len(filters) > 1:
         result = {'$or': filters}
@@ -125,6 +517,531 @@ def to_mongo(qry):
         result = filters[0]
     return result
 
+
+# smallest number of groups for which `to_mongo()` uses `workers`
+PARALLEL_MIN_GROUPS = 1000
+
+
+def to_find(qry, covered=False, where=False, optimize=False, schema=None):
+    """Transform a query, optionally with a list of fields to return, into
+    the filter and projection arguments of `find()`.
+
+    A query string may start with ``select`` and a comma-separated list of fields,
+    followed by ``where`` and the filter expression(s), or by nothing at all to
+    select from every document:
+
+    >>> to_find('select a, b.c where x > 3')
+    ({'x': {'$gt': 3}}, {'a': 1, 'b.c': 1})
+    >>> to_find('select a, b.c where x > 3', covered=True)
+    ({'x': {'$gt': 3}}, {'a': 1, 'b.c': 1, 'x': 1, '_id': 0})
+
+    :param qry: Filter expression(s), as for `to_mongo()`, optionally with a
+                ``select`` clause (string form only)
+    :type qry: str or list
+    :param covered: Project only the selected fields and the fields used in the
+                    filter, and leave out `_id` (unless selected), so that a query
+                    whose fields are all in one index can be answered from the
+                    index alone
+    :type covered: bool
+    :param where: See `to_mongo()`
+    :type where: bool
+    :param optimize: See `to_mongo()`
+    :type optimize: bool
+    :param schema: See `to_mongo()`; its aliases also apply to the selected fields
+    :type schema: Schema
+    :return: The MongoDB query, and the projection (None if all fields are returned)
+    :rtype: (dict, dict)
+    :raises: BadExpression, if the query cannot be parsed, or has
+             ``order by``, ``limit`` or ``skip`` (see `to_find_spec()`)
+    """
+    return _find(qry, covered, where, optimize, schema, False)[:2]
+
+
+def to_find_spec(qry, covered=False, where=False, optimize=False, schema=None):
+    """Transform a query, with its ``select``, ``order by``, ``limit`` and ``skip``
+    clauses, into the arguments of `find()`.
+
+    As for `to_find()`, a query string may start with a ``select`` clause.
+    After the filter expression(s), it may end with any of:
+
+        - ``order by`` and a comma-separated list of fields, each optionally
+          followed by ``asc`` (the default) or ``desc``
+        - ``limit`` and the maximum number of documents to return
+        - ``skip`` and the number of documents to skip
+
+    The filter can be left out, as in ``order by created desc limit 10``.
+
+    >>> spec = to_find_spec('status = "open" order by age desc, name limit 100')
+    >>> spec.filter, spec.sort, spec.limit
+    ({'status': 'open'}, [('age', -1), ('name', 1)], 100)
+
+    :param qry: Filter expression(s), as for `to_mongo()`, optionally with
+                clauses (string form only)
+    :type qry: str or list
+    :param covered: See `to_find()`
+    :type covered: bool
+    :param where: See `to_mongo()`
+    :type where: bool
+    :param optimize: See `to_mongo()`
+    :type optimize: bool
+    :param schema: See `to_mongo()`; its aliases also apply to the selected
+                   and sort fields
+    :type schema: Schema
+    :return: Filter, projection, sort, limit and skip
+    :rtype: FindSpec
+    :raises: BadExpression, if the query cannot be parsed
+    """
+    return FindSpec(*_find(qry, covered, where, optimize, schema, True))
+
+
+class FindSpec(object):
+    """Arguments for `find()`, from `to_find_spec()`.
+    """
+    __slots__ = ('filter', 'projection', 'sort', 'limit', 'skip')
+
+    def __init__(self, filter, projection=None, sort=None, limit=None, skip=None):
+        #: MongoDB query
+        self.filter = filter
+        #: Projection, or None for all fields
+        self.projection = projection
+        #: Sort keys, as a list of (field, direction), with 1 for ascending
+        #: and -1 for descending, as for pymongo; or None for no sort
+        self.sort = sort
+        #: Maximum number of documents, or None for no limit
+        self.limit = limit
+        #: Number of documents to skip, or None
+        self.skip = skip
+
+    def options(self):
+        """Keyword arguments for pymongo's `find()`, other than the filter,
+        for the parts that are set.
+
+        :rtype: dict
+        """
+        return {name: getattr(self, name) for name in ('projection', 'sort', 'limit', 'skip')
+                if getattr(self, name) is not None}
+
+    def __eq__(self, other):
+        if not isinstance(other, FindSpec):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return 'FindSpec({})'.format(', '.join('{}={!r}'.format(name, getattr(self, name))
+                                              for name in self.__slots__))
+
+
+def _find(qry, covered, where, optimize, schema, options):
+    """Implementation of `to_find()` (without `options`) and `to_find_spec()`.
+
+    :return: Filter, projection, sort, limit and skip
+    :rtype: tuple
+    """
+    if not covered and not _has_clauses(qry):
+        return to_mongo(qry, where=where, optimize=optimize, schema=schema), None, None, None, None
+    key = None
+    if _cache.maxsize > 0:
+        key = _cache_key(qry)
+        if key is not None:
+            key = ('$find', key, options, covered, where, optimize, schema)
+            result = _cache.get(key)
+            if result is not None:
+                return result
+    collector = _stats
+    if collector is None:
+        result = _find_uncached(qry, covered, where, optimize, schema, options)
+    else:
+        collector.begin(qry)
+        t0 = time.perf_counter()
+        error, result = None, None
+        try:
+            result = _find_uncached(qry, covered, where, optimize, schema, options)
+        except BadExpression as err:
+            error = str(err.details)
+            raise
+        except Exception as err:
+            error = str(err)
+            raise
+        finally:
+            collector.add('translate', time.perf_counter() - t0)
+            collector.end(error=error, sort=None if result is None else result[2])
+    if key is not None:
+        _cache.put(key, result)
+    return result
+
+
+def _find_uncached(qry, covered, where, optimize, schema, options):
+    groups, fields, sort, limit, skip = _parse_find(qry, schema=schema, options=options)
+    spec = _to_mongo(groups, where, schema=schema)
+    if optimize:
+        spec = QueryOptimizer().optimize(spec)
+    if covered:
+        fields = list(fields or ())
+        for filter_exprs in groups:
+            for c in _group_constraints(filter_exprs, schema=schema):
+                fields.append(c.field.full_name)
+                if c.op.is_variable():
+                    fields.append(c.value)
+        fields.extend(name for name, _ in sort or ())
+    projection = None if fields is None else _projection(fields, covered)
+    return spec, projection, sort, limit, skip
+
+
+def _parse_find(qry, schema=None, options=True, select=True, params=False):
+    """Parse a query, with its clauses (see `to_find_spec()`).
+
+    :param options: Allow ``order by``, ``limit`` and ``skip``
+    :type options: bool
+    :param select: Allow ``select``
+    :type select: bool
+    :param params: Allow parameter placeholders in values
+    :type params: bool
+    :return: Groups of expressions (as from `_split_groups()`), and the selected
+             fields, sort keys, limit and skip (None if not given)
+    :rtype: tuple
+    :raises: BadExpression, if the query cannot be parsed
+    """
+    if qry == "" or qry == []:
+        return [], None, None, None, None
+    if not isinstance(qry, str):
+        return _split_groups(qry, params=params, schema=schema), None, None, None, None
+    parser = Parser(qry, params=params, schema=schema, select=select, options=options)
+    groups = parser.parse()
+    return groups, parser.fields, parser.sort, parser.limit, parser.skip
+
+
+def _has_clauses(qry):
+    """Whether a query might have a ``select``, ``order by``, ``limit`` or
+    ``skip`` clause. False positives are fine, they are only slower.
+    """
+    if type(qry) is not str:
+        return False
+    return ('order' in qry or 'limit' in qry or 'skip' in qry
+            or qry.lstrip().startswith('select'))
+
+
+def _projection(fields, covered):
+    """Build a projection including the fields.
+
+    Fields inside another included field are left out, since MongoDB
+    rejects overlapping paths.
+
+    :param fields: Field names, dotted for embedded fields
+    :type fields: list(str)
+    :param covered: Leave out `_id` unless it is one of the fields
+    :type covered: bool
+    :rtype: dict
+    """
+    projection = {}
+    for name in fields:
+        parts = name.split('.')
+        if not any('.'.join(parts[:i]) in projection for i in range(1, len(parts) + 1)):
+            for other in [f for f in projection if f.startswith(name + '.')]:
+                del projection[other]
+            projection[name] = 1
+    if covered and '_id' not in projection:
+        projection['_id'] = 0
+    return projection
+
+
+def to_pipeline(qry, optimize=False, schema=None):
+    """Transform a query into the `$match` stages of an aggregation pipeline.
+
+    The first `$match` holds the constraints that can use an index (equality,
+    inequality, ``exists`` and regex), so the server narrows the documents
+    with its indexes first. The ``size`` and ``type`` checks go in a second
+    `$match`, evaluated only for the documents that are left, with `$expr`
+    for the size comparisons. No stage uses `$where`, which is not allowed
+    in `$match`.
+
+    With several "or"ed groups, the first stage "or"s the indexable part of each
+    group, and the second stage checks the whole groups. If a group has no
+    indexable constraints, there is only the second stage.
+
+    >>> to_pipeline('a > 3 and b size> 1')
+    [{'$match': {'a': {'$gt': 3}}}, {'$match': {'$expr': {'$and': [{'$isArray': '$b'}, {'$gt': [{'$size': '$b'}, 1]}]}}}]
+
+    :param qry: Filter expression(s), as for `to_mongo()`
+    :type qry: str or list
+    :param optimize: Rewrite each stage into a cheaper equivalent, see `to_mongo()`
+    :type optimize: bool
+    :param schema: Field types and aliases, see `to_mongo()`
+    :type schema: Schema
+    :return: Pipeline stages, empty for the empty query. Further stages can
+             be appended to it.
+    :rtype: list(dict)
+    :raises: BadExpression, if one of the input expressions cannot be parsed
+
+    Results are cached with those of `to_mongo()`.
+    """
+    key = None
+    if _cache.maxsize > 0:
+        key = _cache_key(qry)
+        if key is not None:
+            key = ('$pipeline', key, optimize, schema)
+            result = _cache.get(key)
+            if result is not None:
+                return result
+    result = _to_pipeline(qry, optimize, schema)
+    if key is not None:
+        _cache.put(key, result)
+    return result
+
+
+def _to_pipeline(qry, optimize, schema):
+    """Uncached implementation of `to_pipeline()`.
+    """
+    if qry == "" or qry == []:
+        return []
+    # for each group: indexable part, size and type checks, and the whole
+    indexed, checks, whole = [], [], []
+    for filter_exprs in _split_groups(qry, schema=schema):
+        index_mq, check_mq, all_mq = MongoQuery(), MongoQuery(), MongoQuery()
+        for constraint in _group_constraints(filter_exprs, schema=schema):
+            clause = MongoClause(constraint, rev=False)
+            if constraint.op.is_size() or constraint.op.is_type():
+                check_mq.add_clause(clause)
+            else:
+                index_mq.add_clause(clause)
+            all_mq.add_clause(clause)
+        indexed.append(index_mq.to_mongo(False))
+        checks.append(check_mq.to_mongo(False))
+        whole.append(all_mq.to_mongo(False))
+    if len(whole) == 1:
+        stages = [q for q in (indexed[0], checks[0]) if q]
+    else:
+        stages = []
+        if all(indexed):
+            stages.append({'$or': indexed})
+        if any(checks) or not stages:
+            stages.append({'$or': whole})
+    if optimize:
+        optimizer = QueryOptimizer()
+        stages = [optimizer.optimize(q) for q in stages]
+    return [{'$match': q} for q in stages]
+
+
+def to_mongo_many(queries, workers=None, chunksize=None, where=False, optimize=False,
+                  schema=None):
+    """Translate many queries, optionally in parallel processes.
+
+    :param queries: Filter expressions, each as for `to_mongo()`
+    :type queries: list
+    :param workers: Number of processes, or an executor to use, which is taken
+                    to have one worker per CPU when splitting the queries (give
+                    `chunksize` for one with fewer or more).
+                    By default, queries are translated serially.
+    :type workers: int or concurrent.futures.Executor
+    :param chunksize: Number of queries given to a process at a time
+                      (default is to split the queries evenly, four chunks per process)
+    :type chunksize: int
+    :param where: See `to_mongo()`
+    :type where: bool
+    :param optimize: See `to_mongo()`
+    :type optimize: bool
+    :param schema: See `to_mongo()`
+    :type schema: Schema
+    :return: MongoDB query for each input query, in the same order
+    :rtype: list(dict)
+    :raises: BatchError, with the index of each query that cannot be parsed
+    """
+    queries = list(queries)
+    if workers is None or workers == 1:
+        return _translate_chunk((0, queries, where, optimize, schema), raise_errors=True)
+    return _parallel_map(_translate_chunk, queries, workers, (where, optimize, schema), chunksize)
+
+
+def _parallel_map(fn, items, workers, options, chunksize=None):
+    """Apply `fn` to chunks of the items in a pool of processes.
+
+    :return: Results in order of the items
+    :raises: BatchError, if any item failed
+    """
+    if isinstance(workers, Executor):
+        # executors do not say how many workers they have
+        pool, nproc = workers, os.cpu_count() or 1
+    else:
+        pool, nproc = ProcessPoolExecutor(max_workers=workers), workers
+    if chunksize is None:
+        chunksize = max(1, -(-len(items) // (nproc * 4)))
+    chunks = [(i, items[i:i + chunksize]) + options for i in range(0, len(items), chunksize)]
+    results, errors = [], []
+    try:
+        for out in pool.map(fn, chunks):
+            for ok, value in out:
+                if ok:
+                    results.append(value)
+                else:
+                    errors.append(value)
+    finally:
+        if pool is not workers:
+            pool.shutdown()
+    if errors:
+        raise BatchError(errors)
+    return results
+
+
+def _translate_chunk(chunk, raise_errors=False):
+    """Translate a chunk of queries, for `to_mongo_many()`.
+
+    :param chunk: Index of first query, queries, where, optimize, schema
+    :return: For each query, (True, result) or (False, (index, expr, details));
+             or if `raise_errors` is True, only the results
+    """
+    start, queries, where, optimize, schema = chunk
+    out, errors = [], []
+    for i, qry in enumerate(queries, start):
+        try:
+            out.append((True, to_mongo(qry, where=where, optimize=optimize, schema=schema)))
+        except BadExpression as err:
+            out.append((False, (i, err.expr, str(err.details))))
+            errors.append(out[-1][1])
+        except ValueError as err:
+            # bad values found when building clauses, e.g. a negative size
+            out.append((False, (i, qry, str(err))))
+            errors.append(out[-1][1])
+    if raise_errors:
+        if errors:
+            raise BatchError(errors)
+        return [value for _, value in out]
+    return out
+
+
+def _group_chunk(chunk):
+    """Translate a chunk of groups, for `to_mongo()` with workers.
+
+    :param chunk: Index of first group, groups, where, schema
+    :return: For each group, (True, query) or (False, (index, expr, details))
+    """
+    start, groups, where, schema = chunk
+    out = []
+    for i, filter_exprs in enumerate(groups, start):
+        try:
+            out.append((True, _group_query(filter_exprs, where=where, schema=schema)[0]))
+        except BadExpression as err:
+            out.append((False, (i, err.expr, str(err.details))))
+        except ValueError as err:
+            expr = ' and '.join(str(e) for e in filter_exprs)
+            out.append((False, (i, expr, str(err))))
+    return out
+
+
+def _split_groups(qry, params=False, schema=None):
+    """Break input into groups of filter expressions.
+
+    The string form is parsed here, so its groups hold constraints;
+    the expressions of the list form are parsed by `_group_constraints()`.
+
+    :param qry: Filter expression(s), as for `to_mongo()`
+    :type qry: str or list
+    :param params: Allow parameter placeholders in values
+    :type params: bool
+    :param schema: Field types and aliases
+    :type schema: Schema
+    :return: Groups of expressions
+    :rtype: list(list(str or Constraint))
+    :raises: BadExpression, if the string form cannot be parsed
+    """
+    if isinstance(qry, str):
+        groups = Parser(qry, params=params, schema=schema).parse()
+    else:
+        if isinstance(qry[0], list) or isinstance(qry[0], tuple):
+            groups = qry
+        else:
+            groups = [qry]
+    return groups
+
+
+def _group_constraints(filter_exprs, params=False, schema=None):
+    """Parse one group of "and"ed expressions.
+
+    :param filter_exprs: Expressions in the group
+    :type filter_exprs: list(str)
+    :param params: Allow parameter placeholders in values
+    :type params: bool
+    :param schema: Field types and aliases
+    :type schema: Schema
+    :return: One constraint per expression
+    :rtype: list(Constraint)
+    :raises: BadExpression, if one of the expressions cannot be parsed
+    """
+    constraints = []
+    for e in filter_exprs:
+        if isinstance(e, Constraint):
+            # already parsed, from the string form
+            constraints.append(e)
+        elif isinstance(e, str):
+            constraints.extend(Parser(e, params=params, schema=schema).parse_conjunction())
+        else:
+            raise BadExpression(e, "expected string, got '{t}'".format(t=type(e)))
+    return constraints
+
+
+def _group_query(filter_exprs, params=False, where=False, schema=None):
+    """Build the MongoDB query for one group of "and"ed expressions.
+
+    :param filter_exprs: Expressions in the group
+    :type filter_exprs: list(str)
+    :param params: Allow parameter placeholders in values
+    :type params: bool
+    :param where: Use $where clauses, see `to_mongo()`
+    :type where: bool
+    :param schema: Field types and aliases
+    :type schema: Schema
+    :return: The query, and the constraints of the group
+    :rtype: (dict, list(Constraint))
+    :raises: BadExpression, if one of the expressions cannot be parsed
+    """
+    rev = False     # filters, not constraints
+    mq = MongoQuery()
+    constraints = _group_constraints(filter_exprs, params=params, schema=schema)
+    collector = _stats
+    if collector is None:
+        for constraint in constraints:
+            mq.add_clause(MongoClause(constraint, rev=rev, where=where))
+        return mq.to_mongo(rev), constraints
+    t0 = time.perf_counter()
+    for constraint in constraints:
+        mq.add_clause(MongoClause(constraint, rev=rev, where=where))
+    t1 = time.perf_counter()
+    collector.add('clause', t1 - t0, len(constraints))
+    q = mq.to_mongo(rev)
+    collector.add('assemble', time.perf_counter() - t1)
+    return q, constraints
+
+
+def _find_path(obj, target):
+    """Find the keys/indexes leading to the object `target` in a query.
+
+    :return: Path, or None if not found
+    :rtype: tuple
+    """
+    if obj is target:
+        return ()
+    if isinstance(obj, dict):
+        items = obj.items()
+    elif isinstance(obj, list):
+        items = enumerate(obj)
+    else:
+        return None
+    for key, value in items:
+        path = _find_path(value, target)
+        if path is not None:
+            return (key,) + path
+    return None
+
+
+class Param(object):
+    """Named placeholder for a value, written ``:name`` in an expression.
+    """
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return 'Param({!r})'.format(self.name)
+
 # To parse a single constraint expression
 relation_re = re.compile(r'''\s*
     ([a-zA-Z_.0-9]+(?:/[a-zA-Z_.0-9]+)?)\s*     # Identifier
@@ -135,7 +1052,8 @@ relation_re = re.compile(r'''\s*
     ([-]?\d+(?:\.\d+)?|                         # Value: number
         \'[^\']+\'|                             #   single-quoted string
         \"[^"]+\"|                              #   double-quoted string
-        [Tt]rue|[Ff]alse|                       #   boolean
+        (?:[Tt]rue|[Ff]alse)\b|                 #   boolean
+        :[a-zA-Z_][a-zA-Z_0-9]*|                #   parameter placeholder
         [a-zA-Z_][a-zA-Z_.0-9]*                 # variable name
     )
     \s*''', re.VERBOSE)
@@ -155,6 +1073,17 @@ def parse_expr(e):
     if m is None:
         raise ValueError("error parsing expression '{}'".format(e))
     field, op, val = m.groups()
+    return field, op, _parse_value(val)
+
+
+def _parse_value(val):
+    """Convert the text of a value, as matched by `relation_re`.
+    """
+    first = val[0]
+    if first == ':':
+        return Param(val[1:])
+    if first == '"' or first == "'":
+        return val[1:-1]
     # Try different types
     try:
         # Integer
@@ -174,12 +1103,267 @@ def parse_expr(e):
                 if re.match(r'".*"|\'.*\'', val):
                     # strip quotes from strings
                     val = val[1:-1]
-    return field, op, val
+    return val
+
+
+# most groups that distributing "and" over "or" may produce, see `Parser`
+MAX_GROUPS = 10000
+
+
+class Parser(object):
+    """Parser for the string form of a query.
+
+    The grammar is::
+
+        query      := disjunct
+        disjunct   := conjunct ("or" conjunct)*
+        conjunct   := term ("and" term)*
+        term       := "(" disjunct ")" | expression
+        expression := field operator value
+
+    where each expression is matched by `relation_re`. The input is scanned
+    once, left to right, and the result is put in disjunctive normal form:
+    a list of groups of "and"ed constraints, which are "or"ed together.
+    Errors are reported with their offset in the input.
+
+    An "and" of parenthesized "or"s multiplies the number of groups, so
+    `MAX_GROUPS` bounds the result, and with it the time and memory taken:
+    a longer product is an error, rather than an exponential expansion.
+    """
+
+    _space_re = re.compile(r'\s*')
+    _select_re = re.compile(r'''select\s+
+        ([a-zA-Z_.0-9]+(?:/[a-zA-Z_.0-9]+)?                 # field
+         (?:\s*,\s*[a-zA-Z_.0-9]+(?:/[a-zA-Z_.0-9]+)?)*)    # more fields
+        \s*(?:(where)(?![a-zA-Z_.0-9/])\s*|$|(?=(?:order\s+by|limit|skip)\s))''', re.VERBOSE)
+    _option_re = re.compile(r'''(?:(order)\s+by(?![a-zA-Z_.0-9/])\s*|
+        (limit|skip)\s+(\d+)(?![a-zA-Z_.0-9/])\s*)''', re.VERBOSE)
+    _sort_key_re = re.compile(r'''([a-zA-Z_.0-9]+(?:/[a-zA-Z_.0-9]+)?)\s*
+        (?:(asc|desc)(?![a-zA-Z_.0-9/])\s*)?''', re.VERBOSE)
+    _keyword_re = re.compile(r'(and|or)(?![a-zA-Z_.0-9/])\s*')
+    _field_re = re.compile(r'[a-zA-Z_.0-9]+(?:/[a-zA-Z_.0-9]+)?\s*')
+    _op_re = re.compile(r'(?:<=?|>=?|!?=|exists|~|type|size[><$]?)\s*')
+
+    def __init__(self, text, params=False, schema=None, select=False, options=False):
+        """Create parser for some text.
+
+        :param text: Query string
+        :type text: str
+        :param params: Allow parameter placeholders in values
+        :type params: bool
+        :param schema: Field types and aliases, applied to each expression
+        :type schema: Schema
+        :param select: Allow a leading ``select <fields> where``, see `to_find()`
+        :type select: bool
+        :param options: Allow trailing ``order by``, ``limit`` and ``skip``
+                        clauses, see `to_find_spec()`
+        :type options: bool
+        """
+        self._text = text
+        self._params = params
+        self._schema = schema
+        self._select = select
+        self._allow_options = options
+        #: Fields in the select clause, or None if there is none
+        self.fields = None
+        #: Sort keys, as (field, 1 or -1), or None if there is no order by clause
+        self.sort = None
+        #: Values of the limit and skip clauses, or None
+        self.limit, self.skip = None, None
+        self._pos = 0
+
+    def parse(self):
+        """Parse the whole text.
+
+        :return: Groups of constraints
+        :rtype: list(list(Constraint))
+        :raises: BadExpression, if the text cannot be parsed
+        """
+        collector = _stats
+        if collector is None:
+            return self._parse()
+        t0 = time.perf_counter()
+        try:
+            groups = self._parse()
+        finally:
+            collector.add('parse', time.perf_counter() - t0)
+        collector.count('expressions', sum(len(g) for g in groups))
+        return groups
+
+    def _parse(self):
+        text = self._text
+        self._pos = self._space_re.match(text).end()
+        m = self._select_re.match(text, self._pos)
+        if m is not None:
+            if not self._select:
+                self._fail("'select' is only allowed with to_find() or to_find_spec()")
+            self.fields = [self._field_name(name.strip()) for name in m.group(1).split(',')]
+            self._pos = m.end()
+        if (m is not None and self._pos == len(text)) or self._option_re.match(text, self._pos):
+            # no filter
+            if m is not None and m.group(2):
+                self._fail("expected expression after 'where'")
+            groups = []
+        else:
+            try:
+                groups = self._disjunct()
+            except RecursionError:
+                raise BadExpression(text, 'parentheses nested too deeply')
+        self._options()
+        if self._pos < len(text):
+            if self._text[self._pos] == ')':
+                self._fail("unbalanced ')'")
+            self._fail("expected 'and', 'or' or end of expression")
+        return groups
+
+    def _field_name(self, name):
+        aliases = None if self._schema is None else self._schema.aliases
+        return Field(name, aliases).full_name
+
+    def _options(self):
+        """Parse the order by, limit and skip clauses, if any.
+        """
+        text = self._text
+        while self._pos < len(text):
+            m = self._option_re.match(text, self._pos)
+            if m is None:
+                return
+            name = 'order by' if m.group(1) else m.group(2)
+            if not self._allow_options:
+                self._fail("'{}' is only allowed with to_find_spec()".format(name))
+            attr = 'sort' if m.group(1) else name
+            if getattr(self, attr) is not None:
+                self._fail("repeated '{}'".format(name))
+            self._pos = m.end()
+            if m.group(1):
+                self.sort = self._sort_keys()
+            else:
+                setattr(self, attr, int(m.group(3)))
+
+    def _sort_keys(self):
+        text, keys = self._text, []
+        while True:
+            m = self._sort_key_re.match(text, self._pos)
+            if m is None:
+                self._fail('expected field name')
+            keys.append((self._field_name(m.group(1)), -1 if m.group(2) == 'desc' else 1))
+            self._pos = m.end()
+            if not text.startswith(',', self._pos):
+                return keys
+            self._pos = self._space_re.match(text, self._pos + 1).end()
+
+    def parse_conjunction(self):
+        """Parse text holding one group of "and"ed expressions,
+        as in an item of the list form of a query.
+
+        :return: The constraints
+        :rtype: list(Constraint)
+        :raises: BadExpression, if the text cannot be parsed
+        """
+        groups = self.parse()
+        if len(groups) != 1:
+            self._fail("'or' is not allowed in an item of a list", 0)
+        return groups[0]
+
+    def _fail(self, details, pos=None):
+        if pos is None:
+            pos = self._pos
+        raise BadExpression(self._text, '{} at offset {:d}'.format(details, pos), offset=pos)
+
+    def _keyword(self, word):
+        """Consume the keyword `word`, if it is next.
+        """
+        text, pos = self._text, self._pos
+        # keywords must be separated from what precedes them
+        if pos == 0 or not (text[pos - 1].isspace() or text[pos - 1] == ')'):
+            return False
+        m = self._keyword_re.match(text, pos)
+        if m is None or m.group(1) != word:
+            return False
+        self._pos = m.end()
+        return True
+
+    def _disjunct(self):
+        groups = self._conjunct()
+        while self._keyword('or'):
+            groups.extend(self._conjunct())
+        return groups
+
+    def _conjunct(self):
+        groups = self._term()
+        while self._keyword('and'):
+            start = self._pos
+            term = self._term()
+            if len(term) == 1:
+                for g in groups:
+                    g.extend(term[0])
+            else:
+                # distribute "and" over "or"
+                if len(groups) * len(term) > MAX_GROUPS:
+                    self._fail("'and' of 'or's expands to more than {:d} groups".format(
+                        MAX_GROUPS), start)
+                groups = [g + t for g in groups for t in term]
+        return groups
+
+    def _term(self):
+        text = self._text
+        if text.startswith('(', self._pos):
+            self._pos = self._space_re.match(text, self._pos + 1).end()
+            groups = self._disjunct()
+            if not text.startswith(')', self._pos):
+                if self._pos == len(text):
+                    self._fail("missing ')'")
+                self._fail("expected 'and', 'or' or ')'")
+            self._pos = self._space_re.match(text, self._pos + 1).end()
+            return groups
+        return [[self._expression()]]
+
+    def _expression(self):
+        text, pos = self._text, self._pos
+        m = relation_re.match(text, pos)
+        if m is None:
+            self._diagnose()
+        field, op, val = m.groups()
+        val = _parse_value(val)
+        if isinstance(val, Param) and not self._params:
+            self._fail("unbound parameter ':{}', use compile()".format(val.name), m.start(3))
+        try:
+            if self._schema is not None:
+                field, op, val = self._schema.resolve(field, op, val, m.group(3))
+            if _stats is None:
+                constraint = Constraint(field, op, val)
+            else:
+                constraint = _stats.timed('constraint', Constraint, field, op, val)
+        except ValueError as err:
+            self._fail(str(err), m.start(1))
+        end = m.end()
+        # the value must be followed by a separator
+        if end < len(text) and not (text[end - 1].isspace() or text[end] == ')'):
+            self._fail("expected 'and', 'or' or ')'", end)
+        self._pos = end
+        return constraint
+
+    def _diagnose(self):
+        """Report which part of an expression is missing.
+        """
+        text, pos = self._text, self._pos
+        m = self._field_re.match(text, pos)
+        if m is None:
+            self._fail('expected field name')
+        self._pos = m.end()
+        m = self._op_re.match(text, self._pos)
+        if m is None:
+            self._fail('expected operator')
+        self._pos = m.end()
+        self._fail('expected value')
 
 
 class Field(object):
     """Single field in a constraint.
+
+    Field names are interned, so the many constraints on a field share one string.
     """
+    __slots__ = ('_name', '_subname')
 
     PICK_SEP = '/'   # embedded syntax for picking subfield
 
@@ -198,9 +1382,10 @@ class Field(object):
             name = aliases.get(name, name)
             # assign field name and possible subfield name
         if self.PICK_SEP in name:
-            self._name, self._subname = name.split(self.PICK_SEP)
+            name, subname = name.split(self.PICK_SEP)
+            self._name, self._subname = sys.intern(name), sys.intern(subname)
         else:
-            self._name, self._subname = name, None
+            self._name, self._subname = sys.intern(name), None
 
     def has_subfield(self):
         return self._subname is not None
@@ -210,8 +1395,12 @@ class Field(object):
         return self._name
 
     @property
-    def full_name(self, sep='.'):
-        return sep.join((self._name, self._subname))
+    def full_name(self):
+        """Dotted path of the field, including any subfield.
+        """
+        if self._subname is None:
+            return self._name
+        return '.'.join((self._name, self._subname))
 
     @property
     def sub_name(self):
@@ -220,7 +1409,11 @@ class Field(object):
 
 class ConstraintOperator(object):
     """Operator in a single constraint.
+
+    Operators are immutable, and there is only one instance for each
+    operator string: ``ConstraintOperator('>') is ConstraintOperator('>')``.
     """
+    __slots__ = ('_op', '_size_code', '_text')
     SIZE = 'size'
     EXISTS = 'exists'
     TYPE = 'type'
@@ -240,23 +1433,42 @@ class ConstraintOperator(object):
     for size_sfx in SZ_MAPPING:
         VALID_OPS.add(SIZE + size_sfx)
 
-    # mapping to python operators, where different, for inequalities
-    PY_INEQ = {'=': '=='}
+    # mapping to python functions for inequalities
+    PY_INEQ = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le}
 
-    def __init__(self, op):
-        """Create new operator.
+    # shared instances, by operator string
+    _instances = {}
+
+    def __new__(cls, op):
+        """Get the operator.
 
         :param op: Operator string
         :type op: str
         :raise: ValueError for bad op
         """
-        if not isinstance(op, str) or not op in self.VALID_OPS:
+        try:
+            return cls._instances[op]
+        except (KeyError, TypeError):
+            pass
+        if not isinstance(op, str) or not op in cls.VALID_OPS:
             raise ValueError('bad operation: {}'.format(op))
+        self = object.__new__(cls)
+        self._text = op
         self._op = op
         self._set_size_code()
         if self.is_size():
             # strip down to prefix
             self._op = self.SIZE
+        return cls._instances.setdefault(op, self)
+
+    def __reduce__(self):
+        return ConstraintOperator, (self._text,)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
 
     def __str__(self):
         return self._op
@@ -289,10 +1501,18 @@ class ConstraintOperator(object):
     is_regex = lambda self: self._op == self.REGEX
 
     def reverse(self):
-        orig = self._op
-        self._op = self.OP_NOT[self._op]
-        if self._op is None:
-            raise BadExpression("cannot reverse operator '{}'".format(orig))
+        """Get the logical 'not' of this operator.
+
+        :return: Reversed operator
+        :rtype: ConstraintOperator
+        :raise: BadExpression if the operator cannot be reversed
+        """
+        op = self.OP_NOT[self._op]
+        if op is None:
+            raise BadExpression("cannot reverse operator '{}'".format(self._op))
+        if op == self.SIZE:
+            return self
+        return ConstraintOperator(op)
 
     def _check_size(self):
         if self._size_code is None:
@@ -343,8 +1563,7 @@ class ConstraintOperator(object):
         if self.is_inequality():
             if not isinstance(lhs_value, Number):
                 return False
-            py_op = self.PY_INEQ.get(self._op, self._op)
-            return eval('{} {} {}'.format(lhs_value, py_op, rhs_value))
+            return self.PY_INEQ[self._op](lhs_value, rhs_value)
         if self.is_type():
             ltype = type(lhs_value)
             if rhs_value is Number:
@@ -361,7 +1580,9 @@ class ConstraintOperator(object):
 
 class Constraint(object):
     """Definition of a single constraint.
+    Constraints are immutable.
     """
+    __slots__ = ('_field', '_op', '_value', '_orig_value')
 
     # Convert name of type into Python class
     TYPE_MAPPING = {'number': Number, 'int': Number, 'integer': Number, 'float': Number,
@@ -383,10 +1604,18 @@ class Constraint(object):
             operator = ConstraintOperator(operator)
         if not isinstance(field, Field):
             field = Field(field)
-        self.field = field
+        self._field = field
         self._op = operator
-        if self._op.is_inequality() and not isinstance(value, Number):
+        self._orig_value = None
+        if isinstance(value, Param):
+            # checked when the parameter is bound
+            if self._op.is_type() or (self._op.is_size() and not self._op.is_size_eq()):
+                raise ValueError('parameter not allowed for operator: {}'.format(
+                    self._op.display_op))
+        elif self._op.is_inequality() and not isinstance(value, Number):
             raise ValueError('inequality with non-numeric value: {}'.format(value))
+        elif self._op.is_exists() and not isinstance(value, bool):
+            raise ValueError('exists with non-boolean value: {}'.format(value))
         elif self._op.is_type():
             value = value.lower()
             t = self.TYPE_MAPPING.get(value, None)
@@ -397,8 +1626,14 @@ class Constraint(object):
         elif self._op.is_regex():
             if isinstance(value, Number):
                 raise ValueError('regular expression with numeric value: {}'.format(value))
-            self._orig_value, value = value, re.compile(value)
-        self.value = value
+            try:
+                if _stats is None:
+                    self._orig_value, value = value, re.compile(value)
+                else:
+                    self._orig_value, value = value, _stats.timed('regex', re.compile, value)
+            except re.error as err:
+                raise ValueError('bad regular expression {}: {}'.format(value, err))
+        self._value = value
 
     def passes(self, value):
         """Does the given value pass this constraint?
@@ -414,6 +1649,19 @@ class Constraint(object):
         except ValueError as err:
             return False, str(err)
 
+    @property
+    def field(self):
+        """Constrained field
+        :rtype: Field
+        """
+        return self._field
+
+    @property
+    def value(self):
+        """Target value
+        """
+        return self._value
+
     @property
     def op(self):
         """Constraint operator
@@ -429,6 +1677,7 @@ class Constraint(object):
 class ConstraintGroup(object):
     """Definition of a group of constraints, for a given field.
     """
+    __slots__ = ('constraints', '_existence_constraints', '_array', '_range', '_field')
 
     def __init__(self, field=None):
         """
@@ -510,8 +1759,9 @@ class MongoClause(object):
     """Representation of query clause in a MongoDB query.
        Ho, Ho, Ho! Merry Mongxmas!
     """
-    # Target location, main part of query or where-clauses
-    LOC_MAIN, LOC_WHERE, LOC_MAIN2 = 0, 1, 2
+    __slots__ = ('_rev', '_where', '_loc', '_expr', '_constraint')
+    # Target location, main part of query, where-clauses or $expr-clauses
+    LOC_MAIN, LOC_WHERE, LOC_MAIN2, LOC_EXPR = 0, 1, 2, 3
 
     # Mongo versions of operations
     MONGO_OPS = {
@@ -534,7 +1784,13 @@ class MongoClause(object):
     # Map of Python types to Javascript type names
     JS_TYPES = {Number: 'number', str: 'string', bool: 'boolean'}
 
-    def __init__(self, constraint, rev=True, exists_main=False):
+    # Map of Python types to MongoDB $type aliases
+    MONGO_TYPES = {Number: 'number', str: 'string', bool: 'bool'}
+
+    # Aggregation operators for size comparisons in $expr clauses
+    EXPR_OPS = {'>': '$gt', '>=': '$gte', '<': '$lt', '<=': '$lte', '=': '$eq', '!=': '$ne'}
+
+    def __init__(self, constraint, rev=True, exists_main=False, where=False):
         """Create new clause from a constraint.
 
         :param constraint: The constraint
@@ -544,21 +1800,27 @@ class MongoClause(object):
         :type rev: bool
         :param exists_main: Put exists into main clause
         :type exists_main: bool
+        :param where: Use JavaScript $where clauses for type and size comparisons
+                      (legacy), instead of $type and $expr
+        :type where: bool
         :raise: AssertionError if constraint is None
 
         """
         assert constraint is not None
         self._rev = rev
+        self._where = where
         self._loc, self._expr = self._create(constraint, exists_main)
         self._constraint = constraint
 
     @property
     def query_loc(self):
         """Where this clause should go in the query.
-        The two possible values are enumerated by variables in this class:
+        The possible values are enumerated by variables in this class:
 
         - MongoClause.LOC_MAIN
+        - MongoClause.LOC_MAIN2
         - MongoClause.LOC_WHERE
+        - MongoClause.LOC_EXPR
 
         :return: Location code
         :rtype: int
@@ -587,53 +1849,89 @@ class MongoClause(object):
         :raise: ValueError if value doesn't make sense for operator
         """
         c = constraint  # alias
+        name = c.field.full_name
         op = self._reverse_operator(c.op) if self._rev else c.op
         mop = self._mongo_op_str(op)
         # build the clause parts: location and expression
         loc = MongoClause.LOC_MAIN  # default location
         if op.is_exists():
             loc = MongoClause.LOC_MAIN2 if exists_main else MongoClause.LOC_MAIN
-            assert (isinstance(c.value, bool))
+            assert (isinstance(c.value, (bool, Param)))
             # for exists, reverse the value instead of the operator
             not_c_val = not c.value if self._rev else c.value
-            expr = {c.field.name: {mop: not_c_val}}
+            expr = {name: {mop: not_c_val}}
+        elif op.is_size() and not self._where:
+            loc, expr = self._create_size(op, name, c.value)
+        elif op.is_type() and not self._where:
+            type_name = self.MONGO_TYPES[c.value]
+            if self._rev:
+                expr = {name: {'$not': {'$type': type_name}}}
+            else:
+                expr = {name: {'$type': type_name}}
         elif op.is_size():
             if op.is_variable():
                 # variables only support equality, and need to be in $where
                 loc = MongoClause.LOC_WHERE
                 js_op = '!=' if self._rev else '=='
-                expr = 'this.{}.length {} this.{}'.format(c.field.name, js_op, c.value)
+                expr = 'this.{}.length {} this.{}'.format(name, js_op, c.value)
             elif op.is_size_eq() and not self._rev:
-                expr = {c.field.name: {'$size': c.value}}
+                expr = {name: {'$size': c.value}}
             else:
                 # inequalities also need to go into $where clause
                 self._check_size(op, c.value)
                 loc = MongoClause.LOC_WHERE
                 szop = ConstraintOperator(op.size_op)
                 if self._rev:
-                    szop.reverse()
+                    szop = szop.reverse()
                 js_op = self._js_op_str(szop)
-                expr = 'this.{}.length {} {}'.format(c.field.name, js_op, c.value)
+                expr = 'this.{}.length {} {}'.format(name, js_op, c.value)
         elif op.is_type():
             loc = MongoClause.LOC_WHERE
             type_name = self.JS_TYPES.get(c.value, None)
             if type_name is None:
                 raise RuntimeError('Could not get JS type for {}'.format(c.value))
             typeop = '!=' if self._rev else '=='
-            expr = 'typeof this.{} {} "{}"'.format(c.field.name, typeop, type_name)
+            expr = 'typeof this.{} {} "{}"'.format(name, typeop, type_name)
         elif op.is_regex():
-            expr = {c.field.name: {mop: c.value.pattern}}
+            pattern = c.value if isinstance(c.value, Param) else c.value.pattern
+            expr = {name: {mop: pattern}}
         else:
             if mop is None:
-                expr = {c.field.name: c.value}
-            elif isinstance(c.value, bool):
+                expr = {name: c.value}
+            elif self._rev and mop == '$ne' and isinstance(c.value, bool):
                 # can simplify boolean {a: {'$ne': True/False}} to {a: False/True}
-                not_c_val = not c.value if self._rev else c.value
-                expr = {c.field.name: not_c_val}
+                expr = {name: not c.value}
             else:
-                expr = {c.field.name: {mop: c.value}}
+                expr = {name: {mop: c.value}}
         return loc, expr
 
+    def _create_size(self, op, name, value):
+        """Create native clause for a size constraint.
+
+        Comparisons other than equality to a number use an aggregation
+        expression, guarded by $isArray so that documents where the field is
+        not an array do not match (and do not raise an error in $size).
+
+        :return: Location and expression
+        :rtype: (int, dict)
+        """
+        if op.is_size_eq():
+            if self._rev:
+                return MongoClause.LOC_MAIN, {name: {'$not': {'$size': value}}}
+            return MongoClause.LOC_MAIN, {name: {'$size': value}}
+        if op.is_variable():
+            rhs = '$' + value
+        else:
+            self._check_size(op, value)
+            rhs = value
+        szop = ConstraintOperator(op.size_op)
+        if self._rev:
+            szop = szop.reverse()
+        path = '$' + name
+        expr = {'$and': [{'$isArray': path},
+                         {self.EXPR_OPS[str(szop)]: [{'$size': path}, rhs]}]}
+        return MongoClause.LOC_EXPR, expr
+
     def _check_size(self, op, value):
         if not isinstance(value, int):
             raise ValueError('wrong type for size: {}'.format(value))
@@ -650,8 +1948,7 @@ class MongoClause(object):
         :param op: Operator for any field/value
         :type op: ConstraintOperator
         """
-        op = copy.copy(op)
-        op.reverse()
+        op = op.reverse()
         # check that we can map it
         if not str(op) in self.MONGO_OPS:
             raise ValueError('unknown operator: {}'.format(op))
@@ -674,12 +1971,13 @@ class MongoClause(object):
 class MongoQuery(object):
     """MongoDB query composed of MongoClause objects.
     """
+    __slots__ = ('_main', '_where', '_main2', '_expr')
 
     def __init__(self):
         """Create empty query.
         """
         self._main, self._where = [], []
-        self._main2 = []
+        self._main2, self._expr = [], []
 
     def add_clause(self, clause):
         """Add a new clause to the existing query.
@@ -694,6 +1992,8 @@ class MongoQuery(object):
             self._main2.append(clause)
         elif clause.query_loc == MongoClause.LOC_WHERE:
             self._where.append(clause)
+        elif clause.query_loc == MongoClause.LOC_EXPR:
+            self._expr.append(clause)
         else:
             raise RuntimeError('bad clause location: {}'.format(clause.query_loc))
 
@@ -708,14 +2008,14 @@ class MongoQuery(object):
         clauses = [e.expr for e in self._main]
         if clauses:
             if disjunction:
-                if len(clauses) + len(self._where) > 1:
+                if len(clauses) + len(self._where) + len(self._expr) > 1:
                     q['$or'] = clauses
                 else:
                     # simplify 'or' of one thing
                     q.update(clauses[0])
             else:
                 for c in clauses:
-                    q.update(c)
+                    self._merge(q, c)
         # add all the main2 clauses; these are not or'ed
         for c in (e.expr for e in self._main2):
             # add to existing stuff for the field
@@ -734,8 +2034,42 @@ class MongoQuery(object):
                 q['$or'].append({'$where': where_clause})
             else:
                 q['$where'] = where_clause
+        # add $expr clauses, if any, to `q`
+        if self._expr:
+            exprs = [e.expr for e in self._expr]
+            if disjunction:
+                q.setdefault('$or', []).extend({'$expr': e} for e in exprs)
+            elif len(exprs) == 1:
+                q['$expr'] = exprs[0]
+            else:
+                # flatten the conjunctions, dropping repeated $isArray guards
+                terms = []
+                for e in exprs:
+                    for term in (e['$and'] if list(e) == ['$and'] else [e]):
+                        if term not in terms:
+                            terms.append(term)
+                q['$expr'] = {'$and': terms}
         return q
 
+    @staticmethod
+    def _merge(q, expr):
+        """Merge "and"ed clause expression into query.
+
+        Operators for a field already in the query are combined with the
+        existing ones when they do not overlap, otherwise the clause goes
+        into an '$and' list, so that no constraint is lost.
+        """
+        for field, value in expr.items():
+            if field not in q:
+                q[field] = value
+                continue
+            cur = q[field]
+            if isinstance(cur, dict) and isinstance(value, dict) and cur.keys().isdisjoint(value):
+                # new dict, the clause expressions are not modified
+                q[field] = dict(cur, **value)
+            else:
+                q.setdefault('$and', []).append({field: value})
+
     @property
     def where_clauses(self):
         return self._where
@@ -744,17 +2078,257 @@ class MongoQuery(object):
     def clauses(self):
         return self._main
 
+    @property
+    def expr_clauses(self):
+        return self._expr
+
     @property
     def all_clauses(self):
-        return self._main + self._where
+        return self._main + self._where + self._expr
+
 
+def compile(qry, where=False, schema=None):
+    """Parse a query once, for repeated use with different values.
 
-def main():
+    Values written as ``:name`` are parameter placeholders, which are filled
+    in by :py:meth:`CompiledQuery.bind`. Parameters can be used with the
+    inequality, equality, regex, ``exists`` and ``size`` operators.
+
+    >>> q = compile('user = :name and age > :min')
+    >>> q.bind(name='alice', min=21)
+    {'user': 'alice', 'age': {'$gt': 21}}
+
+    :param qry: Filter expression(s), as for `to_mongo()`
+    :type qry: str or list
+    :param where: Use $where clauses, see `to_mongo()`
+    :type where: bool
+    :param schema: Field types and aliases, see `to_mongo()`. Parameter values
+                   are converted to the declared types when they are bound.
+    :type schema: Schema
+    :return: Compiled query
+    :rtype: CompiledQuery
+    :raises: BadExpression, if one of the input expressions cannot be parsed
+    """
+    return CompiledQuery(qry, where=where, schema=schema)
+
+
+class CompiledQuery(object):
+    """Query parsed once into a MongoDB query template,
+    with placeholders for the parameter values.
+    """
+
+    # types allowed for parameter values
+    VALUE_TYPES = (str, Number)
+
+    def __init__(self, qry, where=False, schema=None):
+        """Create from a filter expression.
+
+        :param qry: Filter expression(s), as for `to_mongo()`
+        :type qry: str or list
+        :param where: Use $where clauses, see `to_mongo()`
+        :type where: bool
+        :param schema: Field types and aliases, see `to_mongo()`
+        :type schema: Schema
+        :raises: BadExpression, if one of the input expressions cannot be parsed
+        """
+        self._qry = qry
+        self._groups, self._slots = [], []
+        groups = [] if qry == "" or qry == [] else _split_groups(qry, params=True, schema=schema)
+        if not groups:
+            self._groups.append({})
+        for i, filter_exprs in enumerate(groups):
+            q, constraints = _group_query(filter_exprs, params=True, where=where, schema=schema)
+            for c in constraints:
+                if isinstance(c.value, Param):
+                    path = _find_path(q, c.value)
+                    coerce = None
+                    if schema is not None and (c.op.is_equality() or c.op.is_inequality()):
+                        coerce = functools.partial(schema.coerce, c.field.full_name)
+                    self._slots.append((i, path, c.value.name, self._value_check(c.op), coerce))
+            self._groups.append(q)
+        self._params = frozenset(slot[2] for slot in self._slots)
+
+    @property
+    def params(self):
+        """Names of the parameters.
+
+        :rtype: frozenset(str)
+        """
+        return self._params
+
+    def bind(self, **values):
+        """Build the MongoDB query for a set of parameter values.
+
+        :param values: Value for each parameter, by name
+        :return: MongoDB query
+        :rtype: dict
+        :raises: BadExpression, for a missing parameter or a value
+                 that is not allowed with its operator
+        """
+        missing = self._params.difference(values)
+        if missing:
+            raise BadExpression(self._qry, 'missing value for parameter(s): {}'.format(
+                ', '.join(sorted(missing))))
+        groups = [_copy_query(g) for g in self._groups]
+        for i, path, param, check, coerce in self._slots:
+            value = values[param]
+            if not isinstance(value, self.VALUE_TYPES):
+                raise BadExpression(self._qry, "bad type for parameter '{}': {}".format(
+                    param, type(value).__name__))
+            try:
+                if coerce is not None:
+                    value = coerce(value)
+                check(value)
+            except ValueError as err:
+                raise BadExpression(self._qry, "parameter '{}': {}".format(param, err))
+            target = groups[i]
+            for key in path[:-1]:
+                target = target[key]
+            target[path[-1]] = value
+        if len(groups) > 1:
+            return {'$or': groups}
+        return groups[0]
+
+    __call__ = bind
+
+    @staticmethod
+    def _value_check(op):
+        """Get function that checks a parameter value for an operator,
+        raising ValueError if the value is not allowed.
+        """
+        if op.is_inequality():
+            def check(value):
+                if isinstance(value, bool) or not isinstance(value, Number):
+                    raise ValueError('inequality with non-numeric value: {}'.format(value))
+        elif op.is_regex():
+            def check(value):
+                if isinstance(value, Number):
+                    raise ValueError('regular expression with numeric value: {}'.format(value))
+                try:
+                    re.compile(value)
+                except re.error as err:
+                    raise ValueError('bad regular expression {}: {}'.format(value, err))
+        elif op.is_exists():
+            def check(value):
+                if not isinstance(value, bool):
+                    raise ValueError('exists with non-boolean value: {}'.format(value))
+        elif op.is_size():
+            def check(value):
+                if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+                    raise ValueError('bad value for size: {}'.format(value))
+        else:
+            def check(value):
+                pass
+        return check
+
+
+def fingerprint(qry, schema=None):
+    """Identify the shape of a query: the same query with different values
+    has the same fingerprint.
+
+    The query is parsed, and its canonical text built from the constraints:
+    values become ``?`` (except for ``exists`` and ``type``, whose values
+    change what is checked), the "and"ed constraints of each group, and the
+    "or"ed groups, are sorted, and spacing, parentheses and the case of
+    ``true`` and ``false`` no longer matter. Clauses (see `to_find_spec()`)
+    are kept, with the selected fields sorted and the limit and skip as ``?``.
+
+    >>> fingerprint('(b = "x" and a > 3) or c exists True')
+    ('6843e3c4f48af22e', 'a > ? and b = ? or c exists true')
+    >>> fingerprint('c exists true or a > 10 and b = "y"')[0]
+    '6843e3c4f48af22e'
+
+    :param qry: Query, as for `to_find_spec()`; values may also be
+                parameter placeholders, as for `compile()`
+    :type qry: str or list
+    :param schema: Field types and aliases, see `to_mongo()`
+    :type schema: Schema
+    :return: Hash of the canonical text (16 hex digits, the same in every
+             process and version of Python), and the canonical text
+    :rtype: (str, str)
+    :raises: BadExpression, if the query cannot be parsed
+    """
+    key = None
+    if _cache.maxsize > 0:
+        key = _cache_key(qry)
+        if key is not None:
+            key = ('$fingerprint', key, schema)
+            result = _cache.get(key)
+            if result is not None:
+                return result
+    if qry == "" or qry == []:
+        text = ''
+    else:
+        groups, fields, sort, limit, skip = _parse_find(qry, schema=schema, params=True)
+        groups = [_group_constraints(g, params=True, schema=schema) for g in groups]
+        text = _canonical(groups, fields, sort, limit, skip)
+    result = hashlib.sha1(text.encode('utf-8')).hexdigest()[:16], text
+    if key is not None:
+        _cache.put(key, result)
+    return result
+
+
+def _canonical(groups, fields=None, sort=None, limit=None, skip=None):
+    """Canonical text of a parsed query, see `fingerprint()`.
+
+    :param groups: Groups of "and"ed constraints
+    :type groups: list(list(Constraint))
+    :rtype: str
+    """
+    text = ' or '.join(sorted(' and '.join(sorted(_canonical_constraint(c) for c in g))
+                              for g in groups))
+    parts = []
+    if fields is not None:
+        parts.append('select ' + ', '.join(sorted(set(fields))))
+        if text:
+            parts.append('where')
+    if text:
+        parts.append(text)
+    if sort is not None:
+        parts.append('order by ' + ', '.join(f + (' desc' if d < 0 else '') for f, d in sort))
+    if limit is not None:
+        parts.append('limit ?')
+    if skip is not None:
+        parts.append('skip ?')
+    return ' '.join(parts)
+
+
+# canonical names of the types in 'type' constraints
+_TYPE_NAMES = {Number: 'number', str: 'string', bool: 'bool'}
+
+
+def _canonical_constraint(c):
+    op, value = c.op, c.value
+    if isinstance(value, Param):
+        value = '?'
+    elif op.is_exists():
+        value = 'true' if value else 'false'
+    elif op.is_type():
+        value = _TYPE_NAMES[value]
+    elif not op.is_variable():
+        value = '?'
+    return '{} {} {}'.format(c.field.full_name, op._text, value)
+
+
+def main(args=None):
     """Run an interactive CLI program that
     prints the output of running query() on the input string.
+
+    With the sub-command ``filter``, instead filter JSON-lines input,
+    see :py:func:`smoqe.stream.main`. With ``advise-indexes``, recommend
+    indexes for a workload, see :py:func:`smoqe.advisor.main`.
     """
     import sys, signal
 
+    if args is None:
+        args = sys.argv[1:]
+    if args and args[0] == 'filter':
+        from .stream import main as filter_main
+        sys.exit(filter_main(args[1:]))
+    if args and args[0] == 'advise-indexes':
+        from .advisor import main as advise_main
+        sys.exit(advise_main(args[1:]))
+
     def _exit():
         print("Thank you for playing Simple Mongo Query!")
         sys.exit(0)
@@ -0,0 +1,239 @@
+"""
+Raw BSON batches, decoded lazily, for jobs that scan or export query results.
+
+Usage:
+
+    from smoqe import MongoClient
+    from smoqe.rawbson import FieldDecoder
+    coll = MongoClient().some_database.some_collection
+    qry = 'select name, address.city where age > 30'
+    decode = FieldDecoder.for_query(qry)
+    for batch in coll.find_raw(qry, batch_size=5000):
+        for doc in batch:
+            out.write(doc.raw)      # forward the BSON as-is, or
+            record = decode(doc)    # {'name': ..., 'address': {'city': ...}}
+
+A batch from `find_raw_batches()` is the BSON of its documents, one after
+the other. `documents()` splits it into `RawBSONDocument` objects without
+decoding anything. A `FieldDecoder` walks the elements of a document and
+decodes only the ones it needs, skipping the others by their size, so the
+cost depends on the fields that are used rather than on the size of the
+document.
+"""
+__author__ = 'Dan Gunter <dkgunter@lbl.gov>'
+
+import struct
+
+import bson
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+from bson.int64 import Int64
+from bson.raw_bson import RawBSONDocument
+
+from .query import to_find_spec
+
+_INT32 = struct.Struct('<i')
+_INT64 = struct.Struct('<q')
+_DOUBLE = struct.Struct('<d')
+
+# BSON element types
+_DOC, _ARRAY = 0x03, 0x04
+
+# size of the values of fixed-size types
+_FIXED_SIZE = {0x01: 8, 0x06: 0, 0x07: 12, 0x08: 1, 0x09: 8, 0x0A: 0, 0x10: 4,
+               0x11: 8, 0x12: 8, 0x13: 16, 0x7F: 0, 0xFF: 0}
+
+# types whose value is an int32 length, then that many bytes
+_STRING_TYPES = (0x02, 0x0D, 0x0E)
+
+# types whose value starts with its own total length
+_SIZED_TYPES = (_DOC, _ARRAY, 0x0F)
+
+# by element type, for the loop over elements: the size of the value, or
+# how to find it (see `_STRING_TYPES`, `_SIZED_TYPES`, `_value_end()`)
+_STRING, _SIZED, _OTHER = -1, -2, -3
+_SIZES = [_FIXED_SIZE.get(t, _STRING if t in _STRING_TYPES else
+                          _SIZED if t in _SIZED_TYPES else _OTHER) for t in range(256)]
+
+
+def documents(batch):
+    """Split a batch into its documents, without decoding them.
+
+    :param batch: BSON documents, one after the other, as from `find_raw_batches()`
+    :type batch: bytes
+    :return: The documents
+    :rtype: list(RawBSONDocument)
+    """
+    docs, pos, n = [], 0, len(batch)
+    unpack = _INT32.unpack_from
+    while pos < n:
+        size = unpack(batch, pos)[0]
+        docs.append(RawBSONDocument(batch[pos:pos + size]))
+        pos += size
+    return docs
+
+
+def _value_end(data, etype, pos):
+    """Offset just past the value of an element that starts at `pos`.
+    """
+    size = _FIXED_SIZE.get(etype)
+    if size is not None:
+        return pos + size
+    if etype in _STRING_TYPES:
+        return pos + 4 + _INT32.unpack_from(data, pos)[0]
+    if etype in _SIZED_TYPES:
+        return pos + _INT32.unpack_from(data, pos)[0]
+    if etype == 0x05:   # binary: length, subtype, bytes
+        return pos + 5 + _INT32.unpack_from(data, pos)[0]
+    if etype == 0x0B:   # regex: pattern and options, both C strings
+        return data.index(b'\x00', data.index(b'\x00', pos) + 1) + 1
+    if etype == 0x0C:   # DBPointer: string, then ObjectId
+        return pos + 16 + _INT32.unpack_from(data, pos)[0]
+    raise bson.errors.InvalidBSON('unknown element type 0x{:02x}'.format(etype))
+
+
+def _field_tree(fields):
+    """Nest dotted field names: None for a field wanted whole.
+    """
+    tree = {}
+    for name in fields:
+        node, parts = tree, name.replace('/', '.').split('.')
+        for part in parts[:-1]:
+            sub = node.get(part, {})
+            if sub is None:     # a parent is already wanted whole
+                break
+            node = node.setdefault(part, sub)
+        else:
+            node[parts[-1]] = None
+    return tree
+
+
+class FieldDecoder(object):
+    """Decode only some fields of raw BSON documents.
+
+    The result is what MongoDB returns for a projection with the same
+    fields: embedded documents hold only the wanted fields, and arrays
+    only their documents (and arrays), each with only the wanted fields.
+    Missing fields are left out.
+    """
+
+    def __init__(self, fields, codec_options=DEFAULT_CODEC_OPTIONS):
+        """Create a decoder.
+
+        :param fields: Field names, dotted for embedded fields
+        :type fields: list(str)
+        :param codec_options: Options for decoding values, e.g. the time zone
+                              of dates
+        :type codec_options: bson.codec_options.CodecOptions
+        """
+        self._fields = list(fields)
+        self._tree = {k.encode('utf-8'): self._encode(v) for k, v in
+                      _field_tree(self._fields).items()}
+        self._options = codec_options
+        self._errors = codec_options.unicode_decode_error_handler
+
+    @classmethod
+    def for_query(cls, qry, codec_options=DEFAULT_CODEC_OPTIONS):
+        """Create a decoder for the fields of a query: the selected fields and
+        the fields used in the filter (see `to_find_spec()`).
+
+        :param qry: Query, as for `to_find_spec()`
+        :type qry: str or list
+        :rtype: FieldDecoder
+        :raises: BadExpression, if the query cannot be parsed
+        """
+        projection = to_find_spec(qry, covered=True).projection
+        return cls([f for f, v in projection.items() if v], codec_options)
+
+    @property
+    def fields(self):
+        """Names of the fields that are decoded.
+
+        :rtype: list(str)
+        """
+        return list(self._fields)
+
+    def __call__(self, doc):
+        """Decode the wanted fields of a document.
+
+        :param doc: The document
+        :type doc: RawBSONDocument or bytes
+        :rtype: dict
+        """
+        data = doc.raw if isinstance(doc, RawBSONDocument) else doc
+        return self._document(data, 0, self._tree)
+
+    def _encode(self, node):
+        if node is None:
+            return None
+        return {k.encode('utf-8'): self._encode(v) for k, v in node.items()}
+
+    def _document(self, data, start, tree):
+        """Decode the wanted elements of the document at offset `start`.
+        """
+        result = {}
+        wanted = len(tree)
+        unpack, index, sizes = _INT32.unpack_from, data.index, _SIZES
+        pos, end = start + 4, start + unpack(data, start)[0] - 1
+        while pos < end and wanted:
+            etype = data[pos]
+            name_end = index(b'\x00', pos + 1)
+            name = data[pos + 1:name_end]
+            value_pos = name_end + 1
+            size = sizes[etype]
+            if size >= 0:
+                value_end = value_pos + size
+            elif size == _STRING:
+                value_end = value_pos + 4 + unpack(data, value_pos)[0]
+            elif size == _SIZED:
+                value_end = value_pos + unpack(data, value_pos)[0]
+            else:
+                value_end = _value_end(data, etype, value_pos)
+            if name in tree:
+                wanted -= 1
+                sub = tree[name]
+                key = name.decode('utf-8')
+                if sub is None:
+                    result[key] = self._value(data, etype, value_pos, value_end, pos)
+                elif etype == _DOC:
+                    result[key] = self._document(data, value_pos, sub)
+                elif etype == _ARRAY:
+                    result[key] = self._array(data, value_pos, sub)
+            pos = value_end
+        return result
+
+    def _array(self, data, start, tree):
+        """Documents and arrays in an array, with their wanted fields.
+        """
+        items = []
+        pos, end = start + 4, start + _INT32.unpack_from(data, start)[0] - 1
+        while pos < end:
+            etype = data[pos]
+            value_pos = data.index(b'\x00', pos + 1) + 1
+            if etype == _DOC:
+                items.append(self._document(data, value_pos, tree))
+            elif etype == _ARRAY:
+                items.append(self._array(data, value_pos, tree))
+            pos = _value_end(data, etype, value_pos)
+        return items
+
+    def _value(self, data, etype, pos, end, elem_start):
+        """Decode one value; the common types directly, the others with bson.
+        """
+        if etype == 0x02:
+            return data[pos + 4:end - 1].decode('utf-8', self._errors)
+        if etype == 0x10:
+            return _INT32.unpack_from(data, pos)[0]
+        if etype == 0x01:
+            return _DOUBLE.unpack_from(data, pos)[0]
+        if etype == 0x12:
+            return Int64(_INT64.unpack_from(data, pos)[0])
+        if etype == 0x08:
+            return data[pos] == 1
+        if etype == 0x0A:
+            return None
+        if etype == _DOC:
+            return bson.decode(data[pos:end], self._options)
+        # wrap the element in a document of its own
+        element = data[elem_start:end]
+        wrapped = _INT32.pack(len(element) + 5) + element + b'\x00'
+        return next(iter(bson.decode(wrapped, self._options).values()))
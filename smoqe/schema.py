@@ -0,0 +1,198 @@
+"""
+Declared field types and aliases, applied when a query is translated.
+
+Usage:
+
+    import smoqe
+    schema = smoqe.Schema({'age': 'int', 'zip': 'string', 'tags': ['string'],
+                           'active': 'bool'},
+                          aliases={'postcode': 'zip'})
+    smoqe.to_mongo('age = "42" and postcode = 02139', schema=schema)
+    # {'age': 42, 'zip': '02139'}
+
+With a schema:
+
+    - field names are looked up in the aliases first
+    - values compared to a declared field with =, !=, <, etc. are converted to
+      its type, so that they match what is stored (and can use its indexes)
+    - `type` checks on declared scalar fields are decided when the query is
+      translated: one that always holds becomes `exists true`, one that
+      never can is an error
+    - `size` on a declared field that is not an array is an error
+
+Fields that are not declared are left alone.
+"""
+__author__ = 'Dan Gunter <dkgunter@lbl.gov>'
+
+from numbers import Number
+
+from .query import Constraint, ConstraintOperator
+
+# Declared type names, and the Python type of the stored values
+TYPES = {'int': int, 'integer': int, 'float': float, 'number': Number,
+         'str': str, 'string': str, 'bool': bool, 'boolean': bool}
+
+# Type name for an array with elements of any type
+ARRAY = 'array'
+
+
+class FieldType(object):
+    """Declared type of one field.
+    """
+    __slots__ = ('name', 'type', 'array')
+
+    def __init__(self, spec):
+        """Create from a type specification.
+
+        :param spec: Type name (see `TYPES`), a list holding one type name for an
+                     array of that type, or 'array' for an array of any type
+        :type spec: str or list
+        :raise: ValueError for an unknown type
+        """
+        self.array = isinstance(spec, (list, tuple))
+        if self.array:
+            if len(spec) != 1:
+                raise ValueError('array type must have one element type: {}'.format(spec))
+            spec = spec[0]
+        if spec == ARRAY:
+            self.array, self.type = True, None
+        elif spec in TYPES:
+            self.type = TYPES[spec]
+        else:
+            raise ValueError('unknown type {!r}, not in ({})'.format(
+                spec, ', '.join(sorted(TYPES) + [ARRAY])))
+        self.name = spec
+
+    def __repr__(self):
+        return 'FieldType({!r})'.format([self.name] if self.array and self.name != ARRAY
+                                        else self.name)
+
+
+class Schema(object):
+    """Types and aliases for the fields of a collection.
+
+    A schema is read-only once created, and can be shared between threads.
+    """
+
+    def __init__(self, fields=None, aliases=None):
+        """Create from field declarations.
+
+        :param fields: Type of each field, by name (dotted for embedded fields).
+                       See :py:class:`FieldType` for the type specifications.
+        :type fields: dict
+        :param aliases: Name of the field for each alias
+        :type aliases: dict
+        :raise: ValueError for an unknown type
+        """
+        self._fields = {name.replace('/', '.'): FieldType(spec)
+                        for name, spec in (fields or {}).items()}
+        self._aliases = dict(aliases or {})
+
+    @property
+    def aliases(self):
+        """Name of the field for each alias.
+
+        :rtype: dict
+        """
+        return dict(self._aliases)
+
+    def field_type(self, name):
+        """Declared type of a field.
+
+        :param name: Field name, after aliases (dotted for embedded fields)
+        :type name: str
+        :return: The type, or None if the field is not declared
+        :rtype: FieldType
+        """
+        return self._fields.get(name)
+
+    def resolve(self, field, op, value, text=None):
+        """Apply the schema to one expression.
+
+        :param field: Field name, as written
+        :type field: str
+        :param op: Operator
+        :type op: str
+        :param value: Value, as parsed
+        :param text: Value, as written (used to keep e.g. leading zeros
+                     when a number is converted to a string)
+        :type text: str
+        :return: Field name, operator and value to use
+        :rtype: (str, str, object)
+        :raise: ValueError if the expression cannot match a declared field
+        """
+        field = self._aliases.get(field, field)
+        ftype = self._fields.get(field.replace('/', '.'))
+        if ftype is None:
+            return field, op, value
+        cop = ConstraintOperator(op)
+        if cop.is_size():
+            if not ftype.array:
+                raise ValueError("size of field '{}', which is {}, not an array".format(
+                    field, ftype.name))
+        elif cop.is_type():
+            if not ftype.array and isinstance(value, str):
+                op, value = self._resolve_type(field, ftype, value)
+        elif cop.is_inequality() and ftype.type in (str, bool):
+            raise ValueError("inequality on field '{}', which is {}".format(field, ftype.name))
+        elif cop.is_equality() or cop.is_inequality():
+            value = self.coerce(field, value, text)
+        return field, op, value
+
+    @staticmethod
+    def _resolve_type(field, ftype, value):
+        wanted = Constraint.TYPE_MAPPING.get(value.lower())
+        if wanted is None:
+            return ConstraintOperator.TYPE, value    # reported by Constraint
+        declared = Number if ftype.type in (int, float) else ftype.type
+        if declared is not wanted:
+            raise ValueError("type {} never matches field '{}', which is {}".format(
+                value, field, ftype.name))
+        return ConstraintOperator.EXISTS, True
+
+    def coerce(self, field, value, text=None):
+        """Convert a value to the declared type of a field (for an array,
+        the type of its elements).
+
+        :param field: Field name, after aliases
+        :type field: str
+        :param value: Value
+        :param text: Value, as written, if known
+        :type text: str
+        :return: Converted value, or `value` if the field is not declared
+                 or the value is a parameter placeholder
+        :raise: ValueError if the value cannot be converted
+        """
+        ftype = self._fields.get(field.replace('/', '.'))
+        if ftype is None or ftype.type is None or not isinstance(value, (str, Number)):
+            return value
+        target = ftype.type
+        if target is str:
+            if isinstance(value, bool):
+                raise ValueError("boolean value {} for string field '{}'".format(value, field))
+            if isinstance(value, Number):
+                # unquoted number: keep it as written, e.g. leading zeros
+                return str(value) if text is None else text
+            return value
+        if target is bool:
+            if isinstance(value, bool):
+                return value
+            if isinstance(value, str) and value.lower() in ('true', 'false'):
+                return value.lower() == 'true'
+            raise ValueError("value {!r} for boolean field '{}'".format(value, field))
+        # numeric field
+        if isinstance(value, bool):
+            raise ValueError("boolean value {} for numeric field '{}'".format(value, field))
+        if isinstance(value, str):
+            try:
+                value = int(value)
+            except ValueError:
+                try:
+                    value = float(value)
+                except ValueError:
+                    raise ValueError("value {!r} for numeric field '{}'".format(value, field))
+        if target is int and isinstance(value, float) and value.is_integer():
+            return int(value)
+        if target is float and isinstance(value, int):
+            return float(value)
+        return value
@@ -0,0 +1,170 @@
+"""
+Filter streams of JSON documents, one per line, with smoqe queries.
+
+Usage:
+
+    from smoqe.stream import filter_lines
+    with open('export.json', 'rb') as f:
+        for line in filter_lines('status = "error" and code > 500', f):
+            out.write(line)
+
+Or, from the command line:
+
+    smoqe filter 'status = "error" and code > 500' export.json
+
+Matching lines are passed through unchanged, and only one line is held in
+memory at a time, so memory use does not depend on the size of the input.
+"""
+__author__ = 'Dan Gunter <dkgunter@lbl.gov>'
+
+import io
+import json
+import sys
+
+from .match import matcher
+from .query import BadExpression, _group_constraints, _split_groups
+
+# bytes read from the input at a time
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+
+def filter_lines(qry, lines, prefilter=True):
+    """Select the lines, each a JSON document, that match a query.
+
+    Lines are only decoded if they could match: when every group of the query
+    needs a top-level field whose quoted name does not appear anywhere in the
+    raw line, the line is skipped without parsing it. This check assumes that
+    field names in the input are not written with JSON escapes; use
+    `prefilter=False` if they might be. Decoded lines are checked with a
+    :py:class:`smoqe.match.AdaptiveMatcher`, which learns a fast order for
+    the constraints from the input.
+
+    :param qry: Filter expression(s), as for `to_mongo()`
+    :type qry: str or list
+    :param lines: Lines of input, as bytes or str
+    :type lines: iterable
+    :param prefilter: Skip lines that cannot match before decoding them
+    :type prefilter: bool
+    :return: Generator of the matching lines, unchanged
+    :raises: BadExpression, if one of the input expressions cannot be parsed;
+             ValueError, for a line that is not valid JSON
+    """
+    match = matcher(qry, adaptive=True)
+    needed = _required_keys(qry) if prefilter else None
+    for lineno, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        if needed is not None and not _may_match(line, needed):
+            continue
+        try:
+            doc = json.loads(line)
+        except ValueError as err:
+            raise ValueError('line {:d}: bad JSON: {}'.format(lineno, err))
+        if isinstance(doc, dict) and match(doc):
+            yield line
+
+
+def filter_file(qry, infile, outfile, chunk_size=DEFAULT_CHUNK_SIZE, prefilter=True):
+    """Copy the lines of a JSON-lines file that match a query to another file.
+
+    :param qry: Filter expression(s), as for `to_mongo()`
+    :type qry: str or list
+    :param infile: Path to input, or binary file object
+    :param outfile: Path to output, or binary file object
+    :param chunk_size: Size of reads from the input, in bytes
+    :type chunk_size: int
+    :param prefilter: See `filter_lines()`
+    :return: Number of lines written
+    :rtype: int
+    """
+    close = []
+    if isinstance(infile, str):
+        infile = io.open(infile, 'rb', buffering=chunk_size)
+        close.append(infile)
+    if isinstance(outfile, str):
+        outfile = io.open(outfile, 'wb')
+        close.append(outfile)
+    n = 0
+    try:
+        write = outfile.write
+        for line in filter_lines(qry, infile, prefilter=prefilter):
+            write(line)
+            n += 1
+    finally:
+        for f in close:
+            f.close()
+    return n
+
+
+def _required_keys(qry):
+    """For each group of the query, the quoted top-level field names
+    that must be present in a matching document.
+
+    :return: One set of names per group, or None if some group
+             could match a document without any of its fields
+    :rtype: list(set(bytes)) or None
+    """
+    if qry == "" or qry == []:
+        return None
+    result = []
+    for filter_exprs in _split_groups(qry):
+        keys = set()
+        for c in _group_constraints(filter_exprs):
+            op = c.op
+            if op.is_neq() or (op.is_exists() and not c.value):
+                continue
+            name = c.field.full_name.split('.', 1)[0]
+            keys.add('"{}"'.format(name).encode('utf-8'))
+        if not keys:
+            return None
+        result.append(keys)
+    return result
+
+
+def _may_match(line, needed):
+    if isinstance(line, str):
+        line = line.encode('utf-8')
+    for keys in needed:
+        for key in keys:
+            if key not in line:
+                break
+        else:
+            return True
+    return False
+
+
+def main(args=None):
+    """Command-line program: smoqe filter EXPR [FILE ...]
+
+    :return: Exit status: 0 if any lines matched, 1 if none did, 2 for errors
+    :rtype: int
+    """
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog='smoqe filter',
+        description='Print the lines of JSON-lines input that match a smoqe query.')
+    parser.add_argument('expr', metavar='EXPR', help='smoqe query')
+    parser.add_argument('files', metavar='FILE', nargs='*',
+                        help='input files (default: standard input)')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='bytes to read at a time (default: %(default)d)')
+    parser.add_argument('--no-prefilter', action='store_true',
+                        help='decode every line, e.g. if field names may use JSON escapes')
+    opts = parser.parse_args(args)
+    out = sys.stdout.buffer
+    n = 0
+    try:
+        for path in (opts.files or [sys.stdin.buffer]):
+            n += filter_file(opts.expr, path, out, chunk_size=opts.chunk_size,
+                             prefilter=not opts.no_prefilter)
+        out.flush()
+    except BadExpression as err:
+        sys.stderr.write("Error! Cannot parse '{}': {}\n".format(err.expr, err.details))
+        return 2
+    except BrokenPipeError:
+        # output closed early, e.g. piped into `head`
+        return 0
+    except (IOError, ValueError) as err:
+        sys.stderr.write('Error! {}\n'.format(err))
+        return 2
+    return 0 if n else 1
@@ -0,0 +1,71 @@
+"""
+Test index recommendations
+"""
+__author__ = "Dan Gunter"
+__copyright__ = "Copyright 2013, LBNL"
+__email__ = "dkgunter@lbl.gov"
+
+import unittest
+
+from smoqe.advisor import advise_indexes, read_workload
+
+
+class TestCase(unittest.TestCase):
+
+    def test_esr_order(self):
+        "Equality before range, prefixes folded"
+        advice = advise_indexes(['age > 3 and status = "open"', 'status = "done"',
+                                 'status = "x" and kind = "y" and n exists true'],
+                                frequencies=[10, 5, 1])
+        keys = [ix.keys for ix in advice.indexes]
+        self.assertEqual(keys, [[('status', 1), ('age', 1)],
+                                [('status', 1), ('kind', 1), ('n', 1)]])
+        self.assertEqual(advice.indexes[0].weight, 15)
+        self.assertEqual(dict(advice.fields['status']), {'equality': 16})
+        self.assertEqual(advice.unindexable, [])
+
+    def test_sort(self):
+        "Sort keys between equality and range fields"
+        advice = advise_indexes(['status = "open" and age > 3 order by created desc limit 10',
+                                 'order by created desc limit 10',
+                                 'kind = "x" order by kind, n'])
+        keys = [ix.keys for ix in advice.indexes]
+        self.assertEqual(keys, [[('created', -1)], [('kind', 1), ('n', 1)],
+                                [('status', 1), ('created', -1), ('age', 1)]])
+        self.assertEqual(dict(advice.fields['created']), {'sort': 2})
+        self.assertEqual(advice.unindexable, [])
+
+    def test_unindexable(self):
+        "Predicates that cannot use an index"
+        advice = advise_indexes(['name ~ "smith"', 'name ~ "^smi"', 'a != 3 or b = 1',
+                                 't size> 3', 'c type int'])
+        reasons = dict(advice.unindexable)
+        self.assertEqual(sorted(reasons), ['a != 3 or b = 1', 'name ~ "smith"', 't size> 3'])
+        self.assertEqual(reasons['a != 3 or b = 1'], ['$ne on a'])
+        advice = advise_indexes(['c type int'], where=True)
+        self.assertEqual(advice.unindexable, [('c type int', ['$where type check on c'])])
+
+    def test_workload(self):
+        "Read workload file"
+        queries, freq = read_workload(['# comment', '12\ta = 1', '', 'b = 2', 'bad <> 1'])
+        self.assertEqual(queries, ['a = 1', 'b = 2', 'bad <> 1'])
+        self.assertEqual(freq, [12, 1, 1])
+        advice = advise_indexes(queries, freq)
+        self.assertEqual(len(advice.errors), 1)
+        self.assertIn('Recommended indexes:', advice.report())
+
+    def test_frequencies(self):
+        "Frequencies by query string, with list-form queries"
+        advice = advise_indexes([['a = 1'], 'a = 2'], frequencies={'a = 2': 3})
+        self.assertEqual(advice.indexes[0].weight, 4)
+
+    def test_shapes(self):
+        "Queries counted by shape"
+        advice = advise_indexes(['a = 1 and b > 2', 'b > 5 and a = 3', 'a = 1', 'order by x'],
+                                frequencies=[2, 1, 1, 1])
+        self.assertEqual(dict(advice.shapes), {'a = ? and b > ?': 3, 'a = ?': 1, 'order by x': 1})
+        self.assertIn('Query shapes: 5 queries, 3 shapes', advice.report())
+
+
+if __name__ == '__main__':
+    unittest.main()
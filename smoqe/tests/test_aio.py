@@ -0,0 +1,90 @@
+"""
+Test asyncio wrappers
+"""
+__author__ = "Dan Gunter"
+__copyright__ = "Copyright 2013, LBNL"
+__email__ = "dkgunter@lbl.gov"
+
+import asyncio
+import unittest
+
+import smoqe
+from smoqe import aio
+from smoqe.match import matcher
+
+
+class FakeCursor(object):
+    def __init__(self, coll, spec):
+        self._coll, self._spec = coll, spec
+
+    async def to_list(self, length):
+        return await self._coll._run(self._spec)
+
+
+class FakeCollection(object):
+    """In-process stand-in for an asynchronous collection. Queries are
+    smoqe expressions (as translated, the spec is looked up in `exprs`)
+    and take some time, so that several are in progress at once.
+    """
+    def __init__(self, docs, exprs):
+        self.docs = docs
+        self.specs = [(smoqe.to_mongo(e), matcher(e)) for e in exprs]
+        self.active = self.max_active = 0
+
+    async def _run(self, spec):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(0.001)
+            match = [m for s, m in self.specs if s == spec][0]
+            return [d for d in self.docs if match(d)]
+        finally:
+            self.active -= 1
+
+    def find(self, spec):
+        return FakeCursor(self, spec)
+
+    async def count_documents(self, spec):
+        return len(await self._run(spec))
+
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.docs = [{'n': i, 'even': i % 2 == 0} for i in range(20)]
+        self.exprs = ['n < {:d}'.format(i) for i in range(30)] + ['even = true']
+
+    def test_gather(self):
+        "Bounded concurrency, results in order"
+        coll = FakeCollection(self.docs, self.exprs)
+        results = asyncio.run(aio.gather_queries(coll, self.exprs, concurrency=4))
+        self.assertEqual([len(r) for r in results], [min(i, 20) for i in range(30)] + [10])
+        self.assertEqual(coll.max_active, 4)
+        counts = asyncio.run(aio.gather_queries(coll, self.exprs, method='count_documents'))
+        self.assertEqual(counts[-1], 10)
+        self.assertLessEqual(coll.max_active, aio.DEFAULT_CONCURRENCY)
+
+    def test_gather_bad(self):
+        "Bad queries are reported before any query runs"
+        coll = FakeCollection(self.docs, self.exprs)
+        try:
+            asyncio.run(aio.gather_queries(coll, ['n < 1', 'n <'], concurrency=2))
+            self.fail("BatchError not raised")
+        except smoqe.BatchError as err:
+            self.assertEqual([e[0] for e in err.errors], [1])
+        self.assertEqual(coll.max_active, 0)
+        self.assertRaises(ValueError, asyncio.run,
+                          aio.gather_queries(coll, ['n < 1'], concurrency=0))
+
+    @unittest.skipUnless(aio.have_async, "pymongo async API not available")
+    def test_client(self):
+        "Wrapped asynchronous client"
+        client = aio.AsyncMongoClient(connect=False, serverSelectionTimeoutMS=1)
+        coll = client.app.events
+        self.assertIs(coll, client['app']['events'])
+        self.assertIsInstance(coll, aio.AsyncCollection)
+        cursor = coll.find('a > 1 and b = "x"')
+        self.assertEqual(cursor._spec, {'a': {'$gt': 1}, 'b': 'x'})
+
+if __name__ == '__main__':
+    unittest.main()
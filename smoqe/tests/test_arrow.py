@@ -0,0 +1,118 @@
+"""
+Test Arrow export of query results
+"""
+__author__ = "Dan Gunter"
+__copyright__ = "Copyright 2013, LBNL"
+__email__ = "dkgunter@lbl.gov"
+
+import os
+import tempfile
+import unittest
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from smoqe import arrow
+    have_arrow = True
+except ImportError:
+    have_arrow = False
+
+
+class FakeCollection(object):
+    """Collection whose find() returns fixed documents, and records its arguments.
+    """
+    def __init__(self, docs):
+        self.docs = docs
+        self.calls = []
+
+    def find(self, spec, **kwargs):
+        self.calls.append((spec, kwargs))
+        for doc in self.docs:
+            yield doc
+
+
+@unittest.skipUnless(have_arrow, "pyarrow is not installed")
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.docs = [{'name': 'n{:d}'.format(i), 'age': i, 'owner': {'id': i * 10},
+                      'extra': 'x'} for i in range(7)]
+        del self.docs[3]['owner']
+        self.coll = FakeCollection(self.docs)
+
+    def test_batches(self):
+        "Columns from the query, in batches"
+        batches = list(arrow.query_to_batches(
+            self.coll, 'select name, owner.id where age > 1 order by age limit 10', batch_rows=3))
+        self.assertEqual([b.num_rows for b in batches], [3, 3, 1])
+        self.assertEqual(batches[0].schema.names, ['name', 'owner.id', 'age'])
+        self.assertEqual(batches[0].schema.field('age').type, pa.int64())
+        self.assertTrue(all(b.schema == batches[0].schema for b in batches))
+        self.assertEqual(batches[1].column(1).to_pylist(), [None, 40, 50])
+        spec, kwargs = self.coll.calls[0]
+        self.assertEqual(spec, {'age': {'$gt': 1}})
+        self.assertEqual(kwargs, {'projection': {'name': 1, 'owner.id': 1, 'age': 1, '_id': 0},
+                                  'sort': [('age', 1)], 'limit': 10, 'batch_size': 3})
+        self.assertRaises(ValueError, arrow.query_to_batches, self.coll, 'age > 1', batch_rows=0)
+
+    def test_schema(self):
+        "Columns and types from a schema"
+        schema = pa.schema([('age', pa.float64()), ('owner.id', pa.int32())])
+        table = arrow.to_table(self.coll, 'age > 1', schema=schema)
+        self.assertEqual(table.schema, schema)
+        self.assertEqual(table.column('age').to_pylist()[:2], [0.0, 1.0])
+        self.assertEqual(self.coll.calls[0][1]['projection'], {'age': 1, 'owner.id': 1, '_id': 0})
+
+    def test_table(self):
+        "Tables, with no fields in the query, and with no results"
+        table = arrow.to_table(self.coll, '', batch_rows=2)
+        self.assertEqual(table.num_rows, 7)
+        self.assertEqual(table.column_names, ['name', 'age', 'owner', 'extra'])
+        self.assertNotIn('projection', self.coll.calls[0][1])
+        empty = arrow.to_table(FakeCollection([]), 'a > 1 and b = 2')
+        self.assertEqual((empty.num_rows, empty.column_names), (0, ['a', 'b']))
+        # values Arrow cannot hold become strings
+        table = arrow.to_table(FakeCollection([{'a': object()}, {'a': None}]), 'a exists true')
+        self.assertEqual(table.schema.field('a').type, pa.string())
+
+    def test_widen(self):
+        "Later batches widen the types, and never lose data"
+        coll = FakeCollection([{'a': 1}, {'a': 1}, {'a': 1, 'b': 'x'}, {'a': 1.5, 'b': 'y'},
+                               {'a': 2, 'b': 3}])
+        batches = list(arrow.query_to_batches(coll, 'select a, b', batch_rows=2))
+        self.assertEqual([str(b.schema.types) for b in batches[:2]],
+                         ['[DataType(int64), DataType(null)]',
+                          '[DataType(double), DataType(string)]'])
+        self.assertEqual(batches[1].column(0).to_pylist(), [1.0, 1.5])
+        self.assertEqual(batches[1].column(1).to_pylist(), ['x', 'y'])
+        # no common type: strings
+        self.assertEqual(batches[2].schema.field('b').type, pa.string())
+        self.assertEqual(batches[2].column(1).to_pylist(), ['3'])
+        table = arrow.to_table(coll, 'select a, b', batch_rows=2)
+        self.assertEqual(table.column('a').to_pylist(), [1.0, 1.0, 1.0, 1.5, 2.0])
+        self.assertEqual(table.column('b').to_pylist(), [None, None, 'x', 'y', '3'])
+        # with a schema, a value that does not fit is an error
+        self.assertRaises(pa.ArrowInvalid, arrow.to_table, coll, 'a > 0',
+                          schema=pa.schema([('a', pa.int64())]))
+
+    def test_parquet(self):
+        "Parquet file, written in batches"
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'out.parquet')
+            n = arrow.write_parquet(self.coll, 'select name where age >= 0', path, batch_rows=2)
+            self.assertEqual(n, 7)
+            table = pq.read_table(path)
+            self.assertEqual(table.column_names, ['name', 'age'])
+            self.assertEqual(table.column('name').to_pylist(), [d['name'] for d in self.docs])
+            # a column of nulls in the first batch gets its type from a later one
+            coll = FakeCollection([{'a': 1}, {'a': 2}, {'a': 3, 'b': 1.5}])
+            self.assertEqual(arrow.write_parquet(coll, 'select a, b', path, batch_rows=2), 3)
+            table = pq.read_table(path)
+            self.assertEqual(table.schema.field('b').type, pa.float64())
+            self.assertEqual(table.column('b').to_pylist(), [None, None, 1.5])
+            # once written, a type cannot be widened
+            coll = FakeCollection([{'a': 1}, {'a': 2}, {'a': 1.5}])
+            self.assertRaises(ValueError, arrow.write_parquet, coll, 'a > 0', path, batch_rows=2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+"""
+Test bitmap indexes
+"""
+__author__ = "Dan Gunter"
+__copyright__ = "Copyright 2013, LBNL"
+__email__ = "dkgunter@lbl.gov"
+
+import random
+import unittest
+
+import smoqe
+from smoqe import bitmap
+from smoqe.bitmap import BitmapIndex
+from smoqe.match import matcher
+
+
+class TestCase(unittest.TestCase):
+
+    QUERIES = ['status = "open"', 'status != "open" and flag = true', 'kind = 1 or flag = false',
+               'status = "done" and n > 50', 'n < 10 and kind exists false', 'kind exists true',
+               'tags = "t1" and status = "open" or tags = "t2"', 'kind >= 2 and kind < 3',
+               'flag = 1', 'sub.v = 2 and name ~ "^x1"', 'status = "nope"', 'tags != "t0"',
+               'status = "open" and status = "done"', '']
+
+    def setUp(self):
+        rng = random.Random(2)
+        self.docs = []
+        for i in range(500):
+            doc = {'status': rng.choice(['open', 'done', 'blocked']),
+                   'flag': rng.choice([True, False, 1, 0]), 'n': rng.randint(0, 100),
+                   'tags': ['t{:d}'.format(j) for j in range(rng.randint(0, 3))],
+                   'sub': {'v': rng.randint(0, 3)}, 'name': 'x{:d}'.format(i)}
+            if rng.random() < 0.7:
+                doc['kind'] = rng.choice([1, 2, 2.5, 3, 'a'])
+            self.docs.append(doc)
+
+    def _check(self, index):
+        for qry in self.QUERIES:
+            match = matcher(qry)
+            expect = [i for i, d in enumerate(self.docs) if match(d)]
+            self.assertEqual(index.find(qry), expect, qry)
+            self.assertEqual(index.count(qry), len(expect), qry)
+
+    def test_same_as_matcher(self):
+        "Bitmap evaluation gives the same rows as the matcher"
+        index = BitmapIndex(self.docs, ['status', 'flag', 'kind', 'tags', 'sub.v'])
+        self.assertEqual(len(index), len(self.docs))
+        self.assertEqual(index.fields['status'], 3)
+        self._check(index)
+        self.assertEqual(index.explain('status = "open" and n > 3 or flag = true'),
+                         [{'indexed': 1, 'residual': True}, {'indexed': 1, 'residual': False}])
+
+    def test_no_numpy(self):
+        "Pure Python bitsets"
+        np, bitmap.np = bitmap.np, None
+        try:
+            self._check(BitmapIndex(self.docs, ['status', 'flag', 'kind', 'tags']))
+        finally:
+            bitmap.np = np
+
+    def test_row_ids(self):
+        "Bitsets to row ids"
+        bits = bitmap._bitset([0, 3, 8, 64, 99], 100)
+        self.assertEqual(bits, (1 << 0) | (1 << 3) | (1 << 8) | (1 << 64) | (1 << 99))
+        self.assertEqual(bitmap.row_ids(bits, 100), [0, 3, 8, 64, 99])
+        self.assertEqual(bitmap.row_ids(0, 0), [])
+        self.assertRaises(smoqe.BadExpression, BitmapIndex([], ['a']).find, 'a =')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+"""
+Test in-memory matching of documents
+"""
+__author__ = "Dan Gunter"
+__copyright__ = "Copyright 2013, LBNL"
+__email__ = "dkgunter@lbl.gov"
+
+import unittest
+
+import smoqe
+from smoqe.match import AdaptiveMatcher
+
+
+class TestCase(unittest.TestCase):
+
+    DOCS = [
+        {'n': 0, 'a': 5, 'b': 'hello', 't': [1, 2, 3], 'k': 3, 'e': {'x': [{'y': 1}, {'y': 7}]}},
+        {'n': 1, 'a': '5', 'c': None},
+        {'n': 2, 'a': [1, 9], 'b': True, 'f': 1.5},
+        {'n': 3, 'a': 1, 'b': False, 't': []},
+    ]
+
+    def _m_expect(self, expr, expected):
+        match = smoqe.matcher(expr)
+        found = [d['n'] for d in self.DOCS if match(d)]
+        self.assertEqual(found, expected, "Expression ({e}) matched {x}\nbut expected: {y}".format(
+            e=expr, x=found, y=expected))
+
+    def test_compare(self):
+        "Equality and inequality"
+        self._m_expect('a = 5', [0])
+        self._m_expect('a = "5"', [1])
+        self._m_expect('a = 9', [2])
+        self._m_expect('a != 5', [1, 2, 3])
+        self._m_expect('a > 3', [0, 2])
+        self._m_expect('a <= 1', [2, 3])
+        self._m_expect('b = true', [2])
+        self._m_expect('b != false', [0, 1, 2])
+        self._m_expect('f >= 1.5', [2])
+
+    def test_other_ops(self):
+        "Regex, exists, type, size"
+        self._m_expect('b ~ "ell"', [0])
+        self._m_expect('b ~ "^h"', [0])
+        self._m_expect('c exists true', [1])
+        self._m_expect('c exists false', [0, 2, 3])
+        self._m_expect('a type int', [0, 2, 3])
+        self._m_expect('a type string', [1])
+        self._m_expect('b type bool', [2, 3])
+        self._m_expect('t size 3', [0])
+        self._m_expect('t size 0', [3])
+        self._m_expect('t size> 0', [0])
+        self._m_expect('t size< 1', [3])
+        self._m_expect('t size$ k', [0])
+
+    def test_paths(self):
+        "Embedded fields"
+        self._m_expect('e.x.y = 7', [0])
+        self._m_expect('e.x.y > 5', [0])
+        self._m_expect('e.x.0.y = 1', [0])
+        self._m_expect('e.x.y = 3', [])
+        self._m_expect('e/x exists true', [0])
+
+    def test_groups(self):
+        "Disjunction of conjunctions"
+        self._m_expect('a > 3 and b = "hello" or b = false', [0, 3])
+        self._m_expect([['a > 3', 'b = "hello"'], ['b = false']], [0, 3])
+        self._m_expect('a > 1 and a < 6', [0, 2])
+        self._m_expect('', [0, 1, 2, 3])
+
+    def test_bad(self):
+        "Bad expressions"
+        self.assertRaises(smoqe.BadExpression, smoqe.matcher, 'a <> 2')
+        self.assertRaises(smoqe.BadExpression, smoqe.matcher, 'a = :x')
+
+    def test_adaptive(self):
+        "Adaptive ordering gives the same results"
+        for expr in ('a > 3 and b = "hello" or b = false', 'e.x.y = 7', 't size 0 or c exists true',
+                     'b ~ "^h" and a = 5', 'b type bool or a = "5"', ''):
+            match = smoqe.matcher(expr, adaptive=True)
+            expected = [d['n'] for d in self.DOCS if smoqe.matcher(expr)(d)]
+            for _ in range(100):
+                found = [d['n'] for d in self.DOCS if match(d)]
+                self.assertEqual(found, expected, expr)
+        self.assertRaises(smoqe.BadExpression, smoqe.matcher, 'a <> 2', adaptive=True)
+
+    def test_adaptive_order(self):
+        "Constraints and groups are reordered by observed pass rates"
+        match = AdaptiveMatcher('s ~ "^z" and a = 1 or a = 2 or a = 1',
+                                sample_every=1, reorder_every=8)
+        regex_group = [g for g in match.order() if len(g) == 2][0]
+        # static costs: equality before regex
+        self.assertEqual([c['expr'] for c in regex_group], ['a = 1', 's ~ "^z"'])
+        docs = [{'a': 1, 's': 'abc'}] * 99 + [{'a': 1, 's': 'zed'}]
+        for doc in docs * 5:
+            self.assertTrue(match(doc))
+        order = match.order()
+        # the group that always matches comes first
+        self.assertEqual([c['expr'] for c in order[0]], ['a = 1'])
+        self.assertGreater(order[0][0]['pass_rate'], 0.9)
+        # the regex, which rarely passes, now goes before the equality
+        regex_group = [g for g in order if len(g) == 2][0]
+        self.assertEqual([c['expr'] for c in regex_group], ['s ~ "^z"', 'a = 1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+"""
+Test in-memory collection
+"""
+__author__ = "Dan Gunter"
+__copyright__ = "Copyright 2013, LBNL"
+__email__ = "dkgunter@lbl.gov"
+
+import random
+import unittest
+
+import smoqe
+from smoqe.match import matcher
+from smoqe.memstore import Collection
+
+
+class TestCase(unittest.TestCase):
+
+    QUERIES = ['a = 3', 'a > 2 and a <= 5', 'a >= 8 or s = "x1"', 's = "x3" and b = true',
+               'tags = "t2" and a < 4', 'n.v > 10 and n.v < 20', 'a = 3 and s ~ "^x"',
+               'b = 1', 'a != 3 and s = "x2"', 'c exists false and a = 1', 'a > 100',
+               's = "x2" and s = "x3"', 'tags size 2 and a > 5', 'a > 3 and a > 4.5',
+               'm > 1 and m < 5', 'm >= 2 and m <= 3 and m > 0', 'm > 8 or m < 1']
+
+    def setUp(self):
+        rng = random.Random(1)
+        self.docs = []
+        for i in range(300):
+            doc = {'i': i, 'a': rng.choice([rng.randint(0, 10), rng.random() * 10, True, 'x']),
+                   's': 'x{:d}'.format(rng.randint(0, 5)), 'b': rng.choice([True, False, 1]),
+                   'tags': ['t{:d}'.format(j) for j in range(rng.randint(0, 3))],
+                   'n': {'v': rng.randint(0, 30)}}
+            if rng.random() < 0.2:
+                del doc['a']
+            if rng.random() < 0.5:
+                doc['c'] = 1
+            # arrays whose elements can satisfy a range between them
+            doc['m'] = rng.choice([rng.randint(0, 10), [0, 10], [rng.randint(0, 10)],
+                                   [rng.randint(0, 3), rng.randint(6, 10)]])
+            self.docs.append(doc)
+
+    def _check_all(self, coll):
+        for qry in self.QUERIES:
+            match = matcher(qry)
+            expect = [d for d in self.docs if match(d)]
+            self.assertEqual(coll.find(qry), expect, qry)
+            self.assertEqual(coll.count(qry), len(expect), qry)
+
+    def test_same_as_scan(self):
+        "Indexed lookups give the same results as a scan"
+        coll = Collection(self.docs)
+        self._check_all(coll)
+        self.assertEqual(coll.explain('a = 3'), [{'indexes': [], 'scan': True}])
+        coll.create_index('a', kind='sorted')
+        coll.create_index('s')
+        coll.create_index('b')
+        coll.create_index('tags')
+        coll.create_index('n.v', kind='sorted')
+        coll.create_index('m', kind='sorted')
+        self._check_all(coll)
+        self.assertEqual(coll.explain('m > 1 and m < 5')[0]['indexes'],
+                         [('m', 'sorted'), ('m', 'sorted')])
+        arrays = Collection([{'a': [0, 10]}, {'a': 3}, {'a': [2]}])
+        arrays.create_index('a', kind='sorted')
+        self.assertEqual(len(arrays.find('a > 1 and a < 5')), 3)
+        arrays.delete('a = 0')
+        self.assertEqual(arrays.explain('a > 1 and a < 5')[0]['indexes'], [('a', 'sorted')])
+        self.assertEqual(coll.explain('a > 2 and a < 4 and s = "x" or c = 1'),
+                         [{'indexes': [('s', 'hash'), ('a', 'sorted')], 'scan': False},
+                          {'indexes': [], 'scan': True}])
+        coll.create_index('a', kind='hash')
+        self.assertEqual(coll.explain('a > 2')[0]['scan'], True)
+        self._check_all(coll)
+
+    def test_modify(self):
+        "Indexes follow inserts, updates and deletes"
+        coll = Collection()
+        coll.create_index('a', kind='sorted')
+        coll.create_index('s')
+        coll.insert_many(self.docs)
+        self.assertEqual(len(coll), len(self.docs))
+        self._check_all(coll)
+        n = coll.update('s = "x1"', {'s': 'x9', 'n.v': 15})
+        self.assertEqual(n, len([d for d in self.docs if d['s'] == 'x9']))
+        self.assertEqual(coll.count('s = "x1"'), 0)
+        self.assertEqual(coll.count('s = "x9" and n.v = 15'), n)
+        self._check_all(coll)
+        n = coll.delete('a > 5')
+        self.docs = [d for d in self.docs if not matcher('a > 5')(d)]
+        self.assertEqual(len(coll), len(self.docs))
+        self.assertEqual(coll.find('a > 5'), [])
+        self._check_all(coll)
+        self.assertEqual(coll.find_one('i < 0'), None)
+        self.assertEqual(coll.find(), self.docs)
+
+    def test_sort(self):
+        "Order by, limit and skip"
+        coll = Collection(self.docs)
+        coll.create_index('s')
+        # a descending sort with a limit keeps only the top documents
+        expect = sorted((d for d in self.docs if d['s'] == 'x1'), key=lambda d: -d['n']['v'])
+        for qry, start, end in (('s = "x1" order by n.v desc', 0, None),
+                                ('s = "x1" order by n.v desc limit 5', 0, 5),
+                                ('s = "x1" order by n.v desc skip 3 limit 4', 3, 7)):
+            self.assertEqual(coll.find(qry), expect[start:end], qry)
+        # mixed directions, and types in MongoDB's order: missing, numbers, strings, bools
+        found = coll.find('order by a, i desc')
+        ranks = [(0,) if 'a' not in d else (5,) if d['a'] is True else
+                 (2,) if d['a'] == 'x' else (1, d['a']) for d in found]
+        self.assertEqual(ranks, sorted(ranks))
+        self.assertEqual(found[0]['i'], max(d['i'] for d in self.docs if 'a' not in d))
+        self.assertEqual(coll.count('s = "x1" limit 2'), 2)
+        self.assertEqual(coll.count('skip 290'), 10)
+        self.assertEqual(coll.find_one('order by i desc')['i'], 299)
+        self.assertEqual(coll.find('limit 0'), self.docs)
+        self.assertRaises(smoqe.BadExpression, coll.delete, 'a = 1 limit 1')
+        self.assertRaises(smoqe.BadExpression, coll.update, 'order by a', {'z': 1})
+        self.assertRaises(smoqe.BadExpression, coll.find, 'select a where a = 1')
+
+    def test_errors(self):
+        "Bad input"
+        coll = Collection()
+        self.assertRaises(ValueError, coll.create_index, 'a', kind='btree')
+        self.assertRaises(TypeError, coll.insert, [1])
+        self.assertRaises(smoqe.BadExpression, coll.find, 'a >')
+        self.assertRaises(KeyError, coll.drop_index, 'a')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+"""
+Test rewriting of MongoDB queries
+"""
+__author__ = "Dan Gunter"
+__copyright__ = "Copyright 2013, LBNL"
+__email__ = "dkgunter@lbl.gov"
+
+import unittest
+
+import smoqe
+from smoqe.optimizer import optimize, QueryOptimizer
+
+
+class TestCase(unittest.TestCase):
+
+    def _o_expect(self, expr, expected):
+        mx = smoqe.to_mongo(expr, optimize=True)
+        self.assertEqual(mx, expected, "Expression ({e}) optimized = {x}\nbut expected: {y}".format(
+            e=expr, x=mx, y=expected))
+
+    def test_ranges(self):
+        "Merge ranges"
+        self._o_expect('a > 3 and a > 5', {'a': {'$gt': 5}})
+        self._o_expect('a > 5 and a > 3', {'a': {'$gt': 5}})
+        self._o_expect('a < 3 and a <= 5 and a >= 1', {'a': {'$lt': 3, '$gte': 1}})
+        self._o_expect('a >= 1 and a > 1', {'a': {'$gt': 1}})
+        self._o_expect('a ~ "x" and a ~ "y"', {'a': {'$regex': 'x'}, '$and': [{'a': {'$regex': 'y'}}]})
+
+    def test_in(self):
+        "Equality disjunctions"
+        self._o_expect('a = 1 or a = 2 or a = 3', {'a': {'$in': [1, 2, 3]}})
+        self._o_expect('a = 1 or b = 2 or a = "x"', {'$or': [{'a': {'$in': [1, 'x']}}, {'b': 2}]})
+        self._o_expect('a = true or a = 1', {'a': {'$in': [True, 1]}})
+
+    def test_branches(self):
+        "Duplicate, subsumed and shared parts of branches"
+        self._o_expect('a = 1 or a = 1', {'a': 1})
+        self._o_expect('a = 1 and b = 2 or a = 1', {'a': 1})
+        self._o_expect('a = 1 or a = 1 and b = 2 or c = 3', {'$or': [{'a': 1}, {'c': 3}]})
+        self._o_expect('x = 1 and a = 1 or x = 1 and b > 2',
+                       {'x': 1, '$or': [{'a': 1}, {'b': {'$gt': 2}}]})
+        self._o_expect('x = 1 and a = 1 or x = 1', {'x': 1})
+
+    def test_nested(self):
+        "Nested $or"
+        q = {'$or': [{'$or': [{'a': 1}, {'a': 2}]}, {'b': 1}]}
+        self.assertEqual(optimize(q), {'$or': [{'a': {'$in': [1, 2]}}, {'b': 1}]})
+        # input is not modified
+        self.assertEqual(q, {'$or': [{'$or': [{'a': 1}, {'a': 2}]}, {'b': 1}]})
+
+    def test_switches(self):
+        "Choose rewrites, list what fired"
+        q = smoqe.to_mongo('a = 1 or a = 2 or a = 2')
+        opt = QueryOptimizer(rewrites=['duplicate'])
+        self.assertEqual(opt.optimize(q), {'$or': [{'a': 1}, {'a': 2}]})
+        self.assertEqual([name for name, _ in opt.fired], ['duplicate'])
+        opt = QueryOptimizer()
+        opt.optimize(q)
+        self.assertEqual(set(name for name, _ in opt.fired), {'duplicate', 'in_list', 'single_or'})
+        self.assertRaises(ValueError, QueryOptimizer, rewrites=['nope'])
+        self.assertEqual(smoqe.to_mongo('a = 1 or a = 2'), {'$or': [{'a': 1}, {'a': 2}]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,7 +5,11 @@ __author__ = "Dan Gunter"
 __copyright__ = "Copyright 2013, LBNL"
 __email__ = "dkgunter@lbl.gov"
 
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import os
+import pickle
+import tracemalloc
 import unittest
 import time
 
@@ -32,10 +36,18 @@ class TestCase(unittest.TestCase):
         except smoqe.BadExpression as err:
             self.fail("Unexpected BadExpression for '{e}'".format(e=expr))
 
+    def _q_expect_where(self, expr, expected):
+        mx = smoqe.to_mongo(expr, where=True)
+        self.assertEqual(mx, expected, "Expression ({e}).to_mongo(where=True) = {x}\nbut expected: {y}".format(
+            e=expr, x=mx, y=expected))
+
     def test_q1(self):
         "Query 1"
         v = self.V
         self._q_expect('{v1} > 12 and {v2} <= 3 or {v3} type int'.format(**v),
+                {'$or': [{v['v1']: {'$gt': 12}, v['v2']: {'$lte': 3}},
+                         {v['v3']: {'$type': 'number'}}]})
+        self._q_expect_where('{v1} > 12 and {v2} <= 3 or {v3} type int'.format(**v),
                 {'$or': [{v['v1']: {'$gt': 12}, v['v2']: {'$lte': 3}},
                          {'$where': 'typeof this.{v3} == "number"'.format(**v)}]})
 
@@ -43,10 +55,28 @@ class TestCase(unittest.TestCase):
         "Query 2"
         v = self.V
         self._q_expect('{v1} > 12 and {v2} <= 3 or {v3} type int or {v1} = "foo" and {v2} exists false'.format(**v),
+                {'$or': [{v['v1']: {'$gt': 12}, v['v2']: {'$lte': 3}},
+                         {v['v3']: {'$type': 'number'}},
+                         {v['v1']: "foo", v['v2']: {'$exists': False}}]})
+        self._q_expect_where('{v1} > 12 and {v2} <= 3 or {v3} type int or {v1} = "foo" and {v2} exists false'.format(**v),
                 {'$or': [{v['v1']: {'$gt': 12}, v['v2']: {'$lte': 3}},
                          {'$where': 'typeof this.{v3} == "number"'.format(**v)},
                          {v['v1']: "foo", v['v2']: {'$exists': False}}]})
 
+    def test_size(self):
+        "Size comparisons"
+        guard = lambda f, e: {'$expr': {'$and': [{'$isArray': '$' + f}, e]}}
+        self._q_expect('t size 2', {'t': {'$size': 2}})
+        self._q_expect('t size> 2', guard('t', {'$gt': [{'$size': '$t'}, 2]}))
+        self._q_expect('t size< 2', guard('t', {'$lt': [{'$size': '$t'}, 2]}))
+        self._q_expect('t size$ n', guard('t', {'$eq': [{'$size': '$t'}, '$n']}))
+        self._q_expect('t size> 2 and t size< 5 and s type string',
+                       {'s': {'$type': 'string'},
+                        '$expr': {'$and': [{'$isArray': '$t'}, {'$gt': [{'$size': '$t'}, 2]},
+                                           {'$lt': [{'$size': '$t'}, 5]}]}})
+        self._q_expect_where('t size> 2 and t size$ n',
+                             {'$where': 'this.t.length > 2 && this.t.length == this.n'})
+
 
     def test_q3(self):
         "Bad ones"
@@ -56,6 +86,362 @@ class TestCase(unittest.TestCase):
         "Simple good ones"
         map(self._q_ok, ["a = 1", "dude_where_is = 'my car'"])
 
+    def test_same_field(self):
+        "Multiple constraints on one field"
+        self._q_expect('a > 1 and a < 5', {'a': {'$gt': 1, '$lt': 5}})
+        self._q_expect('a > 1 and a > 5', {'a': {'$gt': 1}, '$and': [{'a': {'$gt': 5}}]})
+        self._q_expect('a != true', {'a': {'$ne': True}})
+        self._q_expect('a/b = 2', {'a.b': 2})
+
+    def test_parse(self):
+        "Parentheses, nesting and quoting"
+        self._q_expect('a = "x and y" or b = \'c or d\'', {'$or': [{'a': 'x and y'}, {'b': 'c or d'}]})
+        self._q_expect('((a > 1))', {'a': {'$gt': 1}})
+        self._q_expect('(a = 1 or b = 2) and c = 3',
+                       {'$or': [{'a': 1, 'c': 3}, {'b': 2, 'c': 3}]})
+        self._q_expect('a = 1 and (b = 2 or (c = 3 and d = 4))',
+                       {'$or': [{'a': 1, 'b': 2}, {'a': 1, 'c': 3, 'd': 4}]})
+        self._q_expect('and = 1 and or = 2', {'and': 1, 'or': 2})
+        self._q_expect(['(a = 1)', 'b = 2 and c = 3'], {'a': 1, 'b': 2, 'c': 3})
+        for expr in ('(a = 1', 'a = 1)', 'a = 1 b = 2', 'a = 1 and', 'a > 3x',
+                     'a = 1 AND b = 2', ' ', ['a = 1 or b = 2']):
+            self._q_bad(expr)
+
+    def test_parse_offset(self):
+        "Error offsets"
+        for expr, offset, msg in (('a = 1 and b >', 13, 'expected value'),
+                                  ('a = 1 and !b = 2', 10, 'expected field name'),
+                                  ('a = 1 and b is 2', 12, 'expected operator'),
+                                  ('(a = 1 or b = 2', 15, "missing ')'"),
+                                  ('a = 1 or b = 2) or c = 1', 14, "unbalanced ')'"),
+                                  ('a = 1 and b ~ "("', 10, 'bad regular expression'),
+                                  ('a = 1 and b = :x', 14, 'unbound parameter')):
+            try:
+                smoqe.to_mongo(expr)
+                self.fail("BadExpression not raised for '{}'".format(expr))
+            except smoqe.BadExpression as err:
+                self.assertEqual(err.expr, expr)
+                self.assertEqual(err.offset, offset, "{}: {}".format(expr, err.details))
+                self.assertIn(msg, err.details)
+
+    def test_parse_expansion(self):
+        "An 'and' of 'or's cannot expand exponentially"
+        expr = ' and '.join('(a{:d} = 1 or a{:d} = 2)'.format(i, i) for i in range(20))
+        t0 = time.perf_counter()
+        for fn in (smoqe.to_mongo, smoqe.fingerprint):
+            try:
+                fn(expr)
+                self.fail("BadExpression not raised")
+            except smoqe.BadExpression as err:
+                # 2 ** 14 groups is the first product over the limit
+                self.assertEqual(err.offset, expr.index('(a13 '))
+                self.assertIn('expands to more than', err.details)
+        self.assertLess(time.perf_counter() - t0, 1.0)
+        small = ' and '.join('(a{:d} = 1 or a{:d} = 2)'.format(i, i) for i in range(4))
+        self.assertEqual(len(smoqe.to_mongo(small)['$or']), 16)
+
+    def test_ast(self):
+        "Shared, immutable query nodes"
+        from smoqe.query import Constraint, ConstraintOperator, _group_constraints
+        gt = ConstraintOperator('>')
+        self.assertIs(ConstraintOperator('>'), gt)
+        self.assertIs(gt.reverse(), ConstraintOperator('<='))
+        self.assertEqual(str(gt), '>')
+        self.assertIs(pickle.loads(pickle.dumps(ConstraintOperator('size>'))),
+                      ConstraintOperator('size>'))
+        a, b = _group_constraints(['xyz_field > 1', 'xyz_field > 2'])
+        self.assertIs(a.field.name, b.field.name)
+        self.assertRaises(AttributeError, setattr, a, 'value', 3)
+        self.assertRaises(AttributeError, setattr, a, 'extra', 3)
+
+    def test_ast_memory(self):
+        "Bytes per parsed expression"
+        from smoqe.query import _group_constraints
+        n = 5000
+        exprs = ['field_{:d} > {:d}'.format(i % 20, i) for i in range(n)]
+        _group_constraints(exprs[:100])
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            constraints = _group_constraints(exprs)
+            per_expr = (tracemalloc.get_traced_memory()[0] - before) / n
+        finally:
+            tracemalloc.stop()
+        logging.info("Memory per expression = {:.0f} bytes".format(per_expr))
+        # about 360 bytes with a __dict__ per node and an operator per constraint
+        self.assertLess(per_expr, 250)
+        self.assertEqual(len(constraints), n)
+
+    def test_cache(self):
+        "Cached results"
+        smoqe.clear_cache()
+        expr = 'a > 1 and b ~ "^x"'
+        q1 = smoqe.to_mongo(expr)
+        q2 = smoqe.to_mongo("  " + expr)
+        self.assertEqual(q1, q2)
+        info = smoqe.cache_info()
+        self.assertEqual((info['hits'], info['misses']), (1, 1))
+        # callers cannot corrupt the cached value
+        q2['a']['$gt'] = 99
+        self.assertEqual(smoqe.to_mongo(expr), q1)
+        # lists are cached, too
+        smoqe.to_mongo([['a > 1'], ['b < 2']])
+        smoqe.to_mongo([['a > 1'], ['b < 2']])
+        self.assertEqual(smoqe.cache_info()['hits'], 3)
+
+    def test_cache_size(self):
+        "Cache eviction and disabling"
+        smoqe.clear_cache()
+        try:
+            smoqe.set_cache_size(2)
+            for expr in ('a = 1', 'a = 2', 'a = 3'):
+                smoqe.to_mongo(expr)
+            info = smoqe.cache_info()
+            self.assertEqual((info['size'], info['evictions']), (2, 1))
+            smoqe.set_cache_size(0)
+            smoqe.to_mongo('a = 3')
+            info = smoqe.cache_info()
+            self.assertEqual((info['size'], info['hits']), (0, 0))
+            self.assertRaises(ValueError, smoqe.set_cache_size, -1)
+        finally:
+            smoqe.set_cache_size(smoqe.query.DEFAULT_CACHE_SIZE)
+            smoqe.clear_cache()
+
+    def test_compile(self):
+        "Compiled queries with parameters"
+        q = smoqe.compile('user = :name and age > :min or tag ~ :pat and n size :n')
+        self.assertEqual(q.params, frozenset(['name', 'min', 'pat', 'n']))
+        for name, low in (('alice', 21), ('bob', 3.5)):
+            literal = 'user = "{}" and age > {} or tag ~ "^a" and n size 2'.format(name, low)
+            self.assertEqual(q.bind(name=name, min=low, pat='^a', n=2),
+                             smoqe.to_mongo(literal))
+        # results are independent of each other
+        r = q.bind(name='alice', min=1, pat='x', n=1)
+        r['$or'][0]['age']['$gt'] = 100
+        self.assertEqual(q(name='alice', min=1, pat='x', n=1)['$or'][0]['age'], {'$gt': 1})
+
+    def test_compile_bad(self):
+        "Bad parameters"
+        q = smoqe.compile('a > :low and b ~ :pat and c exists :e')
+        ok = dict(low=1, pat='x', e=True)
+        self.assertRaises(smoqe.BadExpression, q.bind, low=1)
+        for bad in (dict(low='x'), dict(low=True), dict(pat=1), dict(pat='('),
+                    dict(e=1), dict(low={'$ne': None})):
+            values = dict(ok, **bad)
+            self.assertRaises(smoqe.BadExpression, q.bind, **values)
+        self._q_bad('a = :x')
+        self.assertRaises(smoqe.BadExpression, smoqe.compile, 'a type :t')
+        self.assertRaises(smoqe.BadExpression, smoqe.compile, 'a size> :n')
+
+    def test_many(self):
+        "Translate many queries in parallel"
+        queries = ['a > {:d} and b = "x{:d}"'.format(i, i) for i in range(50)]
+        expect = [smoqe.to_mongo(q) for q in queries]
+        self.assertEqual(smoqe.to_mongo_many(queries), expect)
+        self.assertEqual(smoqe.to_mongo_many(queries, workers=2, chunksize=7), expect)
+        # an executor is split into chunks for one worker per CPU
+        chunks = []
+
+        class Pool(ThreadPoolExecutor):
+            def map(self, fn, *iterables, **kwargs):
+                items = list(iterables[0])
+                chunks.extend(items)
+                return super(Pool, self).map(fn, items, **kwargs)
+        with Pool(max_workers=2) as pool:
+            self.assertEqual(smoqe.to_mongo_many(queries, workers=pool), expect)
+        nproc = os.cpu_count() or 1
+        self.assertEqual(len(chunks[0][1]), -(-len(queries) // (nproc * 4)))
+        bad = list(queries)
+        bad[3], bad[40] = 'a >', 'b ~ "("'
+        for workers in (None, 2):
+            try:
+                smoqe.to_mongo_many(bad, workers=workers)
+                self.fail("BatchError not raised")
+            except smoqe.BatchError as err:
+                self.assertEqual([e[0] for e in err.errors], [3, 40])
+                self.assertEqual(err.errors[0][1], 'a >')
+        # bad values found after parsing are reported the same way
+        for workers in (None, 2):
+            try:
+                smoqe.to_mongo_many(['a = 1', 'a size> -1'] * 2, workers=workers)
+                self.fail("BatchError not raised")
+            except smoqe.BatchError as err:
+                self.assertEqual([e[:2] for e in err.errors], [(1, 'a size> -1'), (3, 'a size> -1')])
+                self.assertIn('negative value for size', err.errors[0][2])
+
+    def test_find(self):
+        "Select clause and covered projections"
+        self.assertEqual(smoqe.to_find('select a, b.c where x > 3'),
+                         ({'x': {'$gt': 3}}, {'a': 1, 'b.c': 1}))
+        self.assertEqual(smoqe.to_find('select a, b.c where x > 3', covered=True),
+                         ({'x': {'$gt': 3}}, {'a': 1, 'b.c': 1, 'x': 1, '_id': 0}))
+        self.assertEqual(smoqe.to_find('select a, b/c'), ({}, {'a': 1, 'b.c': 1}))
+        self.assertEqual(smoqe.to_find('x > 3'), ({'x': {'$gt': 3}}, None))
+        self.assertEqual(smoqe.to_find(['x > 3', 'y = 2'], covered=True),
+                         ({'x': {'$gt': 3}, 'y': 2}, {'x': 1, 'y': 1, '_id': 0}))
+        # overlapping paths are merged, a selected _id is kept
+        self.assertEqual(smoqe.to_find('select a.d, _id where a = 1 or b.c size$ n',
+                                       covered=True)[1],
+                         {'a': 1, '_id': 1, 'b.c': 1, 'n': 1})
+        # 'select' is still a field name in an expression
+        self.assertEqual(smoqe.to_mongo('select = 3'), {'select': 3})
+        self.assertEqual(smoqe.to_find('select = 3'), ({'select': 3}, None))
+        for bad, offset in (('select a where x >', 18), ('select a where ', 15)):
+            try:
+                smoqe.to_find(bad)
+                self.fail("BadExpression not raised")
+            except smoqe.BadExpression as err:
+                self.assertEqual(err.offset, offset)
+        self.assertRaises(smoqe.BadExpression, smoqe.to_mongo, 'select a where x > 3')
+        # cached results are copies
+        spec, projection = smoqe.to_find('select a where x > 3')
+        spec['y'] = 1
+        projection['b'] = 1
+        self.assertEqual(smoqe.to_find('select a where x > 3'), ({'x': {'$gt': 3}}, {'a': 1}))
+
+    def test_find_spec(self):
+        "Order by, limit and skip clauses"
+        spec = smoqe.to_find_spec('status = "open" order by age desc, name limit 100')
+        self.assertEqual(spec, smoqe.FindSpec({'status': 'open'}, sort=[('age', -1), ('name', 1)],
+                                              limit=100))
+        self.assertEqual(spec.options(), {'sort': [('age', -1), ('name', 1)], 'limit': 100})
+        self.assertEqual(smoqe.to_find_spec('select a order by b asc skip 2 limit 3'),
+                         smoqe.FindSpec({}, {'a': 1}, [('b', 1)], 3, 2))
+        self.assertEqual(smoqe.to_find_spec('limit 5'), smoqe.FindSpec({}, limit=5))
+        self.assertEqual(smoqe.to_find_spec('(a = 1 or b = 2) order by c').filter,
+                         {'$or': [{'a': 1}, {'b': 2}]})
+        self.assertEqual(smoqe.to_find_spec('x > 1 order by a', covered=True).projection,
+                         {'x': 1, 'a': 1, '_id': 0})
+        self.assertEqual(smoqe.to_find_spec(['x > 1']), smoqe.FindSpec({'x': {'$gt': 1}}))
+        # keywords are still field names in expressions
+        self.assertEqual(smoqe.to_find_spec('limit = 3 and order > 1 limit 2'),
+                         smoqe.FindSpec({'limit': 3, 'order': {'$gt': 1}}, limit=2))
+        schema = smoqe.Schema(aliases={'when': 'created'})
+        self.assertEqual(smoqe.to_find_spec('order by when desc', schema=schema).sort,
+                         [('created', -1)])
+        # cached results are copies
+        smoqe.to_find_spec('x > 1 order by a').sort.append(('b', 1))
+        self.assertEqual(smoqe.to_find_spec('x > 1 order by a').sort, [('a', 1)])
+        for bad, offset in (('x > 1 order by', 14), ('x > 1 limit 2 limit 3', 14),
+                            ('x > 1 order by a,', 17), ('x > 1 order by a b', 17)):
+            try:
+                smoqe.to_find_spec(bad)
+                self.fail("BadExpression not raised")
+            except smoqe.BadExpression as err:
+                self.assertEqual(err.offset, offset, bad)
+        self.assertRaises(smoqe.BadExpression, smoqe.to_mongo, 'x > 1 limit 2')
+        self.assertRaises(smoqe.BadExpression, smoqe.to_find, 'x > 1 order by a')
+
+    def test_fingerprint(self):
+        "Same shape, same fingerprint"
+        same = ['(b = "x" and a > 3) or c exists True',
+                'c exists true or a > 10.5 and b = "y"',
+                'c   exists TRUE or (b = :v and (a > :min))',
+                [['c exists true'], ['b = "z"', 'a > 0']]]
+        fps = [smoqe.fingerprint(q) for q in same]
+        self.assertEqual(fps[0], (fps[0][0], 'a > ? and b = ? or c exists true'))
+        self.assertEqual(len(fps[0][0]), 16)
+        self.assertEqual(set(fps), {fps[0]})
+        for q in ('c exists false or a > 3 and b = "x"', 'a >= 3 and b = "x" or c exists true',
+                  'a > 3 and b = "x"', 'a > 3 and b = "x" or c type int'):
+            self.assertNotEqual(smoqe.fingerprint(q)[0], fps[0][0], q)
+        # type names, variable sizes and clauses
+        self.assertEqual(smoqe.fingerprint('t type INT and l size$ n')[1],
+                         'l size$ n and t type number')
+        self.assertEqual(smoqe.fingerprint('select z, a where x = 1 order by y desc, w limit 5'),
+                         smoqe.fingerprint('select a, z where x = 2 order by y desc, w limit 9'))
+        self.assertEqual(smoqe.fingerprint('select z, a order by y desc, w skip 1')[1],
+                         'select a, z order by y desc, w skip ?')
+        self.assertEqual(smoqe.fingerprint('')[1], '')
+        schema = smoqe.Schema(aliases={'postcode': 'zip'})
+        self.assertEqual(smoqe.fingerprint('postcode = 1', schema=schema)[1], 'zip = ?')
+        self.assertRaises(smoqe.BadExpression, smoqe.fingerprint, 'a >')
+
+    def test_pipeline(self):
+        "Aggregation pipeline with indexable constraints first"
+        size_gt = {'$expr': {'$and': [{'$isArray': '$b'}, {'$gt': [{'$size': '$b'}, 1]}]}}
+        self.assertEqual(smoqe.to_pipeline('a > 3 and b size> 1'),
+                         [{'$match': {'a': {'$gt': 3}}}, {'$match': size_gt}])
+        self.assertEqual(smoqe.to_pipeline('a = 1 and c ~ "^x" and t type string'),
+                         [{'$match': {'a': 1, 'c': {'$regex': '^x'}}},
+                          {'$match': {'t': {'$type': 'string'}}}])
+        self.assertEqual(smoqe.to_pipeline('a = 1 or c = 2'),
+                         [{'$match': {'$or': [{'a': 1}, {'c': 2}]}}])
+        # the second stage checks whole groups
+        self.assertEqual(smoqe.to_pipeline('a = 1 or c = 2 and b size> 1'),
+                         [{'$match': {'$or': [{'a': 1}, {'c': 2}]}},
+                          {'$match': {'$or': [{'a': 1}, dict(c=2, **size_gt)]}}])
+        # a group with nothing indexable
+        self.assertEqual(smoqe.to_pipeline('a = 1 or b size> 1'),
+                         [{'$match': {'$or': [{'a': 1}, size_gt]}}])
+        self.assertEqual(smoqe.to_pipeline(''), [])
+        self.assertEqual(smoqe.to_pipeline('a = 1 or a = 2', optimize=True),
+                         [{'$match': {'a': {'$in': [1, 2]}}}])
+        # no stage uses $where
+        self.assertNotIn('$where', str(smoqe.to_pipeline('b size> 1 and t type bool')))
+        self.assertRaises(smoqe.BadExpression, smoqe.to_pipeline, 'a >')
+
+    def test_many_groups(self):
+        "Translate the groups of a large query in parallel"
+        n = smoqe.query.PARALLEL_MIN_GROUPS
+        qry = [['a = {:d}'.format(i), 'b > 1'] for i in range(n)]
+        smoqe.clear_cache()
+        expect = smoqe.to_mongo(qry)
+        smoqe.clear_cache()
+        self.assertEqual(smoqe.to_mongo(qry, workers=2), expect)
+        qry[n - 1] = ['a =']
+        smoqe.clear_cache()
+        try:
+            smoqe.to_mongo(qry, workers=2)
+            self.fail("BatchError not raised")
+        except smoqe.BatchError as err:
+            self.assertEqual([e[0] for e in err.errors], [n - 1])
+        qry[n - 1] = ['a size> -1']
+        smoqe.clear_cache()
+        try:
+            smoqe.to_mongo(qry, workers=2)
+            self.fail("BatchError not raised")
+        except smoqe.BatchError as err:
+            self.assertEqual([e[0] for e in err.errors], [n - 1])
+
+    def test_stats(self):
+        "Per-stage statistics"
+        records = []
+        smoqe.clear_cache()
+        smoqe.reset_stats()
+        smoqe.to_mongo('a > 1')
+        self.assertEqual(smoqe.stats()['queries'], 0)
+        smoqe.enable_stats(callback=records.append)
+        try:
+            smoqe.to_mongo('a > 1 and b ~ "^x" or c = 2', optimize=True)
+            smoqe.to_mongo('a > 1 and b ~ "^x" or c = 2', optimize=True)   # cached
+            smoqe.to_mongo([['d = 1', 'e < 2']])
+            self.assertRaises(smoqe.BadExpression, smoqe.to_mongo, 'a >')
+            smoqe.to_find_spec('f = 1 order by g desc')
+            self.assertRaises(ValueError, smoqe.to_mongo, 'h size> -1')
+            st = smoqe.stats()
+        finally:
+            smoqe.disable_stats()
+        self.assertTrue(st['enabled'])
+        self.assertFalse(smoqe.stats()['enabled'])
+        self.assertEqual((st['queries'], st['groups'], st['expressions'], st['errors'],
+                          st['sorted']), (5, 5, 7, 2, 1))
+        stages = st['stages']
+        self.assertEqual(stages['clause']['calls'], 6)
+        self.assertEqual(stages['regex']['calls'], 1)
+        self.assertEqual(stages['constraint']['calls'], 7)
+        self.assertEqual(stages['optimize']['calls'], 1)
+        self.assertEqual(stages['translate']['calls'], 5)
+        self.assertGreaterEqual(stages['translate']['time'], stages['parse']['time'])
+        self.assertEqual([r['error'] is None for r in records], [True, True, False, True, False])
+        self.assertEqual(records[3]['sort'], [('g', -1)])
+        self.assertIn('negative value for size', records[4]['error'])
+        self.assertIsNone(getattr(smoqe.query._collector._local, 'record', None))
+        self.assertEqual(records[0]['expressions'], 3)
+        self.assertEqual(set(records[0]['time']), set(smoqe.query.QueryStats.STAGES))
+        smoqe.reset_stats()
+        self.assertEqual(smoqe.stats()['queries'], 0)
+
     def test_perf(self):
         "Perf test"
         # implemented for easy cmdline import
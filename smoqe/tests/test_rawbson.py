@@ -0,0 +1,65 @@
+"""
+Test lazy decoding of raw BSON
+"""
+__author__ = "Dan Gunter"
+__copyright__ = "Copyright 2013, LBNL"
+__email__ = "dkgunter@lbl.gov"
+
+import datetime
+import unittest
+
+try:
+    import bson
+    from smoqe.rawbson import FieldDecoder, documents
+    have_bson = True
+except ImportError:
+    have_bson = False
+
+
+@unittest.skipUnless(have_bson, "bson (pymongo) is not installed")
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.docs = [
+            {'_id': bson.ObjectId(), 'name': 'héllo', 'age': 42, 'big': 2 ** 40, 'score': 1.5,
+             'ok': True, 'none': None, 'when': datetime.datetime(2020, 1, 2, 3, 4, 5),
+             'data': bson.Binary(b'\x00\x01', 0), 'pat': bson.Regex('^a', 'i'),
+             'dec': bson.Decimal128('1.25'), 'owner': {'id': 7, 'name': 'x'},
+             'events': [1, {'t': 1, 'msg': 'a'}, [{'t': 2}], 'b'], 'last': 'end'},
+            {'name': 'other', 'owner': 'nobody'},
+        ]
+        self.batch = b''.join(bson.encode(d) for d in self.docs)
+
+    def test_documents(self):
+        "A batch is split without decoding"
+        docs = documents(self.batch)
+        self.assertEqual(len(docs), 2)
+        self.assertEqual([d.raw for d in docs], [bson.encode(d) for d in self.docs])
+        self.assertEqual(docs[1]['name'], 'other')
+        self.assertEqual(documents(b''), [])
+
+    def test_fields(self):
+        "Only the wanted fields are decoded"
+        doc, other = documents(self.batch)
+        decode = FieldDecoder(['name', 'owner.id', 'events.t', 'last', 'missing'])
+        self.assertEqual(decode(doc), {'name': 'héllo', 'owner': {'id': 7},
+                                       'events': [{'t': 1}, [{'t': 2}]], 'last': 'end'})
+        self.assertEqual(decode(other.raw), {'name': 'other'})
+        # a field wanted whole includes its embedded fields
+        self.assertEqual(FieldDecoder(['owner.id', 'owner'])(doc), {'owner': {'id': 7, 'name': 'x'}})
+        self.assertEqual(FieldDecoder(['owner/name'])(doc), {'owner': {'name': 'x'}})
+
+    def test_types(self):
+        "Values of every type decode as with bson"
+        doc = documents(self.batch)[0]
+        self.assertEqual(FieldDecoder(list(self.docs[0]))(doc), bson.decode(doc.raw))
+
+    def test_query(self):
+        "Fields from a query"
+        decode = FieldDecoder.for_query('select name, owner.id where age > 30')
+        self.assertEqual(sorted(decode.fields), ['age', 'name', 'owner.id'])
+        self.assertEqual(decode(documents(self.batch)[0]),
+                         {'name': 'héllo', 'age': 42, 'owner': {'id': 7}})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+"""
+Test schemas: aliases, coercion and static checks
+"""
+__author__ = "Dan Gunter"
+__copyright__ = "Copyright 2013, LBNL"
+__email__ = "dkgunter@lbl.gov"
+
+import unittest
+
+import smoqe
+from smoqe.schema import FieldType
+
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.schema = smoqe.Schema({'age': 'int', 'score': 'float', 'zip': 'string',
+                                    'tags': ['string'], 'active': 'bool', 'e.x': 'number',
+                                    'any': 'array'},
+                                   aliases={'postcode': 'zip', 'years': 'age'})
+
+    def _q(self, qry):
+        return smoqe.to_mongo(qry, schema=self.schema)
+
+    def test_coerce(self):
+        "Literals are converted to the declared type"
+        self.assertEqual(self._q('age = "42"'), {'age': 42})
+        self.assertEqual(self._q('age > "4.5"'), {'age': {'$gt': 4.5}})
+        self.assertEqual(self._q('score = 3'), {'score': 3.0})
+        self.assertEqual(self._q('zip = 02139'), {'zip': '02139'})
+        self.assertEqual(self._q('tags = 5'), {'tags': '5'})
+        self.assertEqual(self._q('active != "true"'), {'active': {'$ne': True}})
+        self.assertEqual(self._q('e/x = "3"'), {'e.x': 3})
+        self.assertEqual(self._q('other = "42"'), {'other': '42'})
+        # list form, and without a schema nothing changes
+        self.assertEqual(smoqe.to_mongo([['age = "1"']], schema=self.schema), {'age': 1})
+        self.assertEqual(smoqe.to_mongo('age = "42"'), {'age': '42'})
+
+    def test_aliases(self):
+        "Aliases are resolved before types"
+        self.assertEqual(self._q('postcode = 123 or years < "3"'),
+                         {'$or': [{'zip': '123'}, {'age': {'$lt': 3}}]})
+        self.assertEqual(self.schema.aliases, {'postcode': 'zip', 'years': 'age'})
+
+    def test_static(self):
+        "Type checks are resolved, size is checked"
+        self.assertEqual(self._q('age type number and zip type string'),
+                         {'age': {'$exists': True}, 'zip': {'$exists': True}})
+        self.assertEqual(self._q('tags type string'), {'tags': {'$type': 'string'}})
+        self.assertEqual(self._q('tags size 2'), {'tags': {'$size': 2}})
+        self.assertEqual(self._q('any size> 2'), {'$expr': {'$and': [
+            {'$isArray': '$any'}, {'$gt': [{'$size': '$any'}, 2]}]}})
+
+    def test_bad(self):
+        "Expressions that cannot match a declared field"
+        for expr in ('age type string', 'active type number', 'age size 2', 'zip size> 1',
+                     'age = "abc"', 'zip = true', 'zip > 5', 'active = 1', 'active < 2'):
+            self.assertRaises(smoqe.BadExpression, self._q, expr)
+        try:
+            self._q('b = 1 and years size 2')
+        except smoqe.BadExpression as err:
+            self.assertEqual(err.offset, 10)
+            self.assertIn("'age'", err.details)
+        self.assertRaises(ValueError, smoqe.Schema, {'a': 'date'})
+        self.assertRaises(ValueError, smoqe.Schema, {'a': ['int', 'str']})
+
+    def test_compile(self):
+        "Parameter values are converted when bound"
+        q = smoqe.compile('years = :a and zip = :z', schema=self.schema)
+        self.assertEqual(q.bind(a='42', z=2139), {'age': 42, 'zip': '2139'})
+        self.assertRaises(smoqe.BadExpression, q.bind, a='x', z='1')
+        self.assertRaises(smoqe.BadExpression, smoqe.compile, 'age size :n', schema=self.schema)
+
+    def test_many(self):
+        "Batches and the cache"
+        self.assertEqual(smoqe.to_mongo_many(['age = "1"', 'zip = 1'], schema=self.schema),
+                         [{'age': 1}, {'zip': '1'}])
+        # the same query, with and without a schema, is cached separately
+        self.assertEqual(self._q('age = "7"'), {'age': 7})
+        self.assertEqual(smoqe.to_mongo('age = "7"'), {'age': '7'})
+
+    def test_field_type(self):
+        self.assertEqual(repr(FieldType(['int'])), "FieldType(['int'])")
+        self.assertEqual(repr(FieldType('array')), "FieldType('array')")
+        self.assertTrue(self.schema.field_type('tags').array)
+        self.assertIsNone(self.schema.field_type('nope'))
+
+
+if __name__ == '__main__':
+    unittest.main()
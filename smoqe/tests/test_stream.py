@@ -0,0 +1,59 @@
+"""
+Test filtering of JSON-lines streams
+"""
+__author__ = "Dan Gunter"
+__copyright__ = "Copyright 2013, LBNL"
+__email__ = "dkgunter@lbl.gov"
+
+import io
+import itertools
+import unittest
+
+from smoqe import stream
+
+LINES = [b'{"a": 5, "b": "hello"}\n',
+         b'{"a": 1}\n',
+         b'\n',
+         b'{"c": 3, "a": 10, "b": "x and y"}\n',
+         b'[1, 2]\n',
+         b'{"d": {"e": 2}}']
+
+
+class TestCase(unittest.TestCase):
+
+    def _s_expect(self, expr, expected, **kw):
+        found = list(stream.filter_lines(expr, LINES, **kw))
+        self.assertEqual(found, [LINES[i] for i in expected])
+
+    def test_filter(self):
+        "Select lines"
+        self._s_expect('a > 3', [0, 3])
+        self._s_expect('a > 3 and b ~ "and"', [3])
+        self._s_expect('a = 1 or d.e = 2', [1, 5])
+        self._s_expect('a exists false', [5])
+        self._s_expect('a != 5', [1, 3, 5])
+        self._s_expect('a > 3', [0, 3], prefilter=False)
+
+    def test_prefilter(self):
+        "Lines that cannot match are not decoded"
+        self._s_expect('zz = 1', [])
+        lines = [b'{"a": 1}\n', b'not json\n']
+        self.assertEqual(list(stream.filter_lines('a = 1', lines)), lines[:1])
+        self.assertRaises(ValueError, list, stream.filter_lines('a = 1', lines, prefilter=False))
+
+    def test_lazy(self):
+        "Input is consumed as output is produced"
+        endless = itertools.cycle(LINES)
+        found = list(itertools.islice(stream.filter_lines('a > 3', endless), 5))
+        self.assertEqual(len(found), 5)
+
+    def test_file(self):
+        "Whole files"
+        out = io.BytesIO()
+        n = stream.filter_file('b exists true', io.BytesIO(b''.join(LINES)), out)
+        self.assertEqual(n, 2)
+        self.assertEqual(out.getvalue(), LINES[0] + LINES[3])
+
+
+if __name__ == '__main__':
+    unittest.main()
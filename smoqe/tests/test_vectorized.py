@@ -0,0 +1,98 @@
+"""
+Test vectorized evaluation over columns
+"""
+__author__ = "Dan Gunter"
+__copyright__ = "Copyright 2013, LBNL"
+__email__ = "dkgunter@lbl.gov"
+
+import unittest
+
+try:
+    import numpy as np
+    from smoqe.vectorized import evaluate
+    have_numpy = True
+except ImportError:
+    have_numpy = False
+
+import smoqe
+
+
+@unittest.skipUnless(have_numpy, "numpy is not installed")
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.columns = {
+            'a': np.array([5, 7, 1, 12]),
+            'b': np.array(['hello', 'x', 'abc', 'yellow']),
+            'f': np.array([1.0, np.nan, 2.5, -1.0]),
+            'ok': np.array([True, False, True, False]),
+            't': np.array([[1, 2, 3], None, [], ['x']], dtype=object),
+            'k': np.array([3, 0, 0, 2]),
+        }
+
+    def _v_expect(self, expr, expected):
+        mask = evaluate(expr, self.columns)
+        found = np.flatnonzero(mask).tolist()
+        self.assertEqual(found, expected, "Expression ({e}) matched rows {x}\nbut expected: {y}".format(
+            e=expr, x=found, y=expected))
+
+    def test_compare(self):
+        "Equality and inequality"
+        self._v_expect('a > 5', [1, 3])
+        self._v_expect('a = 5', [0])
+        self._v_expect('a != 5', [1, 2, 3])
+        self._v_expect('a = "5"', [])
+        self._v_expect('b = "x"', [1])
+        self._v_expect('f <= 1', [0, 3])
+        self._v_expect('ok = true', [0, 2])
+        self._v_expect('ok = 1', [])
+        self._v_expect('b > 1', [])
+
+    def test_other_ops(self):
+        "Regex, exists, type, size"
+        self._v_expect('b ~ "ell"', [0, 3])
+        self._v_expect('b ~ "^y"', [3])
+        self._v_expect('b ~ "l+o$"', [0])
+        self._v_expect('f exists false', [1])
+        self._v_expect('t exists true', [0, 2, 3])
+        self._v_expect('nope exists false', [0, 1, 2, 3])
+        self._v_expect('f type int', [0, 2, 3])
+        self._v_expect('b type string', [0, 1, 2, 3])
+        self._v_expect('a type bool', [])
+        self._v_expect('t size 0', [2])
+        self._v_expect('t size> 0', [0, 3])
+        self._v_expect('t size< 2', [2, 3])
+        self._v_expect('t size$ k', [0, 2])
+
+    def test_groups(self):
+        "Disjunction of conjunctions"
+        self._v_expect('a > 3 and b ~ "l" or f < 0', [0, 3])
+        self._v_expect([['a > 3', 'b ~ "l"'], ['f < 0']], [0, 3])
+        self._v_expect('', [0, 1, 2, 3])
+
+    def test_structured(self):
+        "Structured and masked arrays"
+        arr = np.array([(1, 2.0), (5, 3.0)], dtype=[('a', 'i4'), ('b', 'f8')])
+        self.assertEqual(evaluate('a > 2 or b < 2.5', arr).tolist(), [True, True])
+        masked = {'a': np.ma.array([1, 2, 3], mask=[False, True, False])}
+        self.assertEqual(evaluate('a exists true', masked).tolist(), [True, False, True])
+        self.assertEqual(evaluate('a < 5', masked).tolist(), [True, False, True])
+
+    def test_same_as_matcher(self):
+        "Same result as matching each record"
+        docs = []
+        for i in range(4):
+            doc = {}
+            for name, col in self.columns.items():
+                v = col[i]
+                if v is None or (isinstance(v, float) and np.isnan(v)):
+                    continue
+                doc[name] = v.item() if hasattr(v, 'item') else v
+            docs.append(doc)
+        for expr in ('a > 3 and ok = false', 'b ~ "l" or t size 0', 'k != 0 and f exists true'):
+            match = smoqe.matcher(expr)
+            self.assertEqual(evaluate(expr, self.columns).tolist(), [match(d) for d in docs])
+
+
+if __name__ == '__main__':
+    unittest.main()
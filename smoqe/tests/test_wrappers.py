@@ -0,0 +1,115 @@
+"""
+Test pymongo wrappers
+"""
+__author__ = "Dan Gunter"
+__copyright__ = "Copyright 2013, LBNL"
+__email__ = "dkgunter@lbl.gov"
+
+import unittest
+
+from smoqe import wrappers
+
+
+def cursor_spec(cursor):
+    for attr in ('_spec', '_Cursor__spec'):
+        if hasattr(cursor, attr):
+            return getattr(cursor, attr)
+    raise AttributeError('query of cursor')
+
+
+@unittest.skipUnless(wrappers.have_pymongo, "pymongo not installed")
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        # no server is contacted: find() only builds the cursor
+        self.client = wrappers.MongoClient(connect=False, serverSelectionTimeoutMS=1)
+
+    def tearDown(self):
+        self.client.close()
+
+    def test_handles(self):
+        "Databases and collections are reused"
+        db = self.client.app
+        self.assertIsInstance(db, wrappers.Database)
+        self.assertIs(self.client['app'], db)
+        self.assertIs(db.events, db['events'])
+        self.assertIsInstance(db.events, wrappers.Collection)
+        self.assertIsNot(db.events, db.other)
+        self.assertRaises(AttributeError, getattr, db, '_private')
+        self.assertRaises(AttributeError, getattr, self.client, '_private')
+
+    def test_find(self):
+        "Query argument is rewritten"
+        coll = self.client.app.events
+        expect = {'a': {'$gt': 1}, 'b': 'x'}
+        self.assertEqual(cursor_spec(coll.find('a > 1 and b = "x"')), expect)
+        self.assertEqual(cursor_spec(coll.find(filter='a > 1 and b = "x"')), expect)
+        self.assertEqual(cursor_spec(coll.find([['a > 1', 'b = "x"']])), expect)
+        self.assertEqual(cursor_spec(coll.find({'c': 1})), {'c': 1})
+        self.assertRaises(wrappers.pymongo.errors.InvalidOperation, coll.find, 'a >')
+
+    def test_select(self):
+        "A select clause sets the projection"
+        coll = self.client.app.events
+        cursor = coll.find('select a, b.c where x > 1')
+        self.assertEqual(cursor_spec(cursor), {'x': {'$gt': 1}})
+        self.assertEqual(cursor._projection, {'a': 1, 'b.c': 1})
+        self.assertEqual(coll.find(filter='select a where x > 1')._projection, {'a': 1})
+        # the caller's projection takes precedence
+        self.assertEqual(coll.find('select a where x > 1', {'z': 1})._projection, {'z': 1})
+        self.assertEqual(coll.find('select a where x > 1', projection=['z'])._projection, {'z': 1})
+        self.assertIsNone(coll.find('x > 1')._projection)
+
+    def test_sort(self):
+        "Order by, limit and skip clauses are applied to the cursor"
+        coll = self.client.app.events
+        cursor = coll.find('select a where x > 1 order by a desc, b limit 5 skip 2')
+        self.assertEqual(cursor_spec(cursor), {'x': {'$gt': 1}})
+        self.assertEqual(cursor._projection, {'a': 1})
+        self.assertEqual(dict(cursor._ordering), {'a': -1, 'b': 1})
+        self.assertEqual((cursor._limit, cursor._skip), (5, 2))
+        # the caller's options take precedence
+        self.assertEqual(coll.find('x > 1 limit 5', limit=3)._limit, 3)
+        cursor = coll.find('x > 1 order by a skip 2 limit 5', None, 4, 3)
+        self.assertEqual((cursor._skip, cursor._limit, dict(cursor._ordering)), (4, 3, {'a': 1}))
+        cursor = coll.find('select a where x > 1 skip 2', None, 4, 3, False,
+                           wrappers.pymongo.CursorType.NON_TAILABLE, [('b', -1)])
+        self.assertEqual((cursor._projection, cursor._skip, dict(cursor._ordering)),
+                         (None, 4, {'b': -1}))
+        self.assertEqual(coll.find('x > 1 skip 2', None, 5)._skip, 5)
+        self.assertRaises(wrappers.pymongo.errors.InvalidOperation,
+                          coll.find_one_and_delete, 'x > 1 limit 3')
+        self.assertRaises(wrappers.pymongo.errors.InvalidOperation,
+                          coll.delete_many, 'x > 1 limit 3')
+
+    def test_find_raw(self):
+        "Batches of raw documents"
+        import bson
+        coll = self.client.app.events
+        batches = [bson.encode({'a': 1}) + bson.encode({'a': 2}), bson.encode({'a': 3})]
+        calls = []
+
+        def find_raw_batches(*args, **kwargs):
+            calls.append((args, kwargs))
+            return iter(batches)
+        coll.find_raw_batches = find_raw_batches
+        result = [[d['a'] for d in batch] for batch in coll.find_raw('a > 0')]
+        self.assertEqual(result, [[1, 2], [3]])
+        self.assertEqual(calls, [(('a > 0',), {'batch_size': wrappers.RAW_BATCH_SIZE})])
+        list(coll.find_raw('a > 0', batch_size=10))
+        self.assertEqual(calls[-1][1], {'batch_size': 10})
+        del coll.find_raw_batches
+        # the query and its clauses go to the server
+        cursor = coll.find_raw_batches('select a where a > 0 limit 5', batch_size=10)
+        self.assertEqual(cursor_spec(cursor), {'a': {'$gt': 0}})
+        self.assertEqual((cursor._projection, cursor._limit, cursor._batch_size),
+                         ({'a': 1}, 5, 10))
+
+    def test_or_id(self):
+        "Strings that are not queries can be ids"
+        self.assertEqual(wrappers._rewrite('a > 1', True), {'a': {'$gt': 1}})
+        self.assertEqual(wrappers._rewrite('5f1e', True), '5f1e')
+        self.assertRaises(wrappers.pymongo.errors.InvalidOperation, wrappers._rewrite, '5f1e', False)
+
+if __name__ == '__main__':
+    unittest.main()
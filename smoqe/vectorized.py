@@ -0,0 +1,236 @@
+"""
+Evaluate smoqe queries over columns of data with NumPy.
+
+Usage:
+
+    import numpy as np
+    from smoqe.vectorized import evaluate
+    columns = {'a': np.arange(10), 'b': np.array(['x', 'y'] * 5)}
+    mask = evaluate('a > 3 and b = "x"', columns)
+    rows = np.flatnonzero(mask)
+
+Each constraint becomes one or a few whole-array operations, and the
+groups are combined with `&` and `|`, so there is no per-row Python code
+except for regexes and for columns of Python objects.
+"""
+__author__ = 'Dan Gunter <dkgunter@lbl.gov>'
+
+from numbers import Number
+import operator
+
+import numpy as np
+
+from .match import value_test
+from .query import ConstraintOperator, _group_constraints, _split_groups
+
+# numpy dtype kinds, by smoqe type
+_NUMERIC_KINDS = 'iuf'
+_STRING_KINDS = 'US'
+
+# regex characters that make a pattern more than a literal substring
+_REGEX_SPECIAL = set('.^$*+?{}[]\\|()')
+
+_NP_OPS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le}
+
+_EQ = ConstraintOperator('=')
+
+
+def evaluate(qry, columns):
+    """Evaluate a query over a batch of records held as columns.
+
+    Fields are looked up by their full (dotted) name. A field that is not
+    one of the columns is missing from every record. Within a column, these
+    values mark a missing field:
+
+        - masked entries, for a masked array
+        - NaN, for a floating-point column
+        - None, for a column of Python objects
+
+    Columns of Python objects (e.g. lists, for `size`) are evaluated element
+    by element with the same semantics as :py:func:`smoqe.matcher`.
+
+    :param qry: Filter expression(s), as for `to_mongo()`
+    :type qry: str or list
+    :param columns: Columns of data, all of the same length
+    :type columns: dict of numpy.ndarray, or numpy structured array
+    :return: One boolean per record, True where the query matches
+    :rtype: numpy.ndarray
+    :raises: BadExpression, if one of the input expressions cannot be parsed
+    """
+    table = _Columns(columns)
+    if qry == "" or qry == []:
+        return np.ones(table.nrows, dtype=bool)
+    result = None
+    for filter_exprs in _split_groups(qry):
+        mask = None
+        for constraint in _group_constraints(filter_exprs):
+            m = _constraint_mask(constraint, table)
+            if mask is None:
+                mask = m
+            else:
+                mask &= m
+        if result is None:
+            result = mask
+        else:
+            result |= mask
+    return result
+
+
+class _Columns(object):
+    """Uniform access to the columns and their missing values.
+    """
+
+    def __init__(self, columns):
+        if isinstance(columns, np.ndarray):
+            names = columns.dtype.names
+            if names is None:
+                raise ValueError('array of columns must have named fields')
+            self._cols = {name: columns[name] for name in names}
+            self.nrows = len(columns)
+        else:
+            self._cols = dict(columns)
+            lengths = set(len(c) for c in self._cols.values())
+            if len(lengths) > 1:
+                raise ValueError('columns have different lengths: {}'.format(sorted(lengths)))
+            self.nrows = lengths.pop() if lengths else 0
+        self._present = {}
+
+    def get(self, name):
+        """Get column data and a mask of where the field is present.
+
+        :return: (data, present), or (None, None) if there is no such column.
+                 `present` is None if the field is present in every record.
+        """
+        col = self._cols.get(name, None)
+        if col is None:
+            return None, None
+        if name not in self._present:
+            self._present[name] = _present_mask(col)
+        if isinstance(col, np.ma.MaskedArray):
+            col = col.data
+        return np.asarray(col), self._present[name]
+
+    def falses(self):
+        return np.zeros(self.nrows, dtype=bool)
+
+
+def _present_mask(col):
+    if isinstance(col, np.ma.MaskedArray):
+        present = ~np.ma.getmaskarray(col)
+        col = col.data
+    else:
+        present = None
+    col = np.asarray(col)
+    if col.dtype.kind == 'f':
+        p = ~np.isnan(col)
+    elif col.dtype.kind == 'O':
+        p = np.not_equal(col, None)
+    else:
+        return present
+    return p if present is None else (present & p)
+
+
+def _where_present(mask, present):
+    if present is None:
+        return mask
+    mask &= present
+    return mask
+
+
+def _elementwise(test, col, present):
+    """Apply a per-value test to each present element of an object column.
+    """
+    result = np.frompyfunc(test, 1, 1)(col).astype(bool)
+    return _where_present(result, present)
+
+
+def _constraint_mask(c, table):
+    op, value = c.op, c.value
+    col, present = table.get(c.field.full_name)
+    if op.is_exists():
+        if col is None:
+            return ~table.falses() if not value else table.falses()
+        if present is None:
+            return ~table.falses() if value else table.falses()
+        return present.copy() if value else ~present
+    if col is None:
+        # `!=` is the only other operator that matches a missing field
+        return ~table.falses() if op.is_neq() else table.falses()
+    kind = col.dtype.kind
+    if op.is_eq() or op.is_neq():
+        mask = _eq_mask(col, kind, present, value)
+        return ~mask if op.is_neq() else mask
+    if op.is_size():
+        if kind != 'O':
+            return table.falses()
+        return _where_present(_size_mask(op, col, value, table), present)
+    if kind == 'O':
+        return _elementwise(value_test(op, value), col, present)
+    if op.is_inequality():
+        if kind not in _NUMERIC_KINDS:
+            return table.falses()
+        return _where_present(_NP_OPS[str(op)](col, value), present)
+    if op.is_regex():
+        if kind not in _STRING_KINDS:
+            return table.falses()
+        return _where_present(_regex_mask(col, value), present)
+    return _type_mask(kind, value, present, table)
+
+
+def _eq_mask(col, kind, present, value):
+    if kind == 'O':
+        return _elementwise(value_test(_EQ, value), col, present)
+    if isinstance(value, bool):
+        ok = kind == 'b'
+    elif isinstance(value, Number):
+        ok = kind in _NUMERIC_KINDS
+    else:
+        ok = kind in _STRING_KINDS
+        if kind == 'S':
+            value = value.encode('utf-8')
+    if not ok:
+        return np.zeros(len(col), dtype=bool)
+    return _where_present(col == value, present)
+
+
+def _regex_mask(col, regex):
+    pattern = regex.pattern
+    if col.dtype.kind == 'S':
+        col = np.char.decode(col, 'utf-8')
+    anchored = pattern.startswith('^')
+    body = pattern[1:] if anchored else pattern
+    if not _REGEX_SPECIAL.intersection(body):
+        # literal prefix or substring: use the vectorized string functions
+        if anchored:
+            return np.char.startswith(col, body)
+        return np.char.find(col, body) >= 0
+    search = regex.search
+    return np.frompyfunc(lambda x: search(x) is not None, 1, 1)(col).astype(bool)
+
+
+def _type_mask(kind, value, present, table):
+    if value is Number:
+        ok = kind in _NUMERIC_KINDS
+    elif value is bool:
+        ok = kind == 'b'
+    else:
+        ok = kind in _STRING_KINDS
+    if not ok:
+        return table.falses()
+    return ~table.falses() if present is None else present.copy()
+
+
+def _size_mask(op, col, value, table):
+    # length of each list, -1 for anything else
+    lengths = np.fromiter((len(x) if type(x) is list else -1 for x in col),
+                          dtype=np.int64, count=len(col))
+    if op.is_variable():
+        sizes = table.get(value)[0]
+        if sizes is None or sizes.dtype.kind not in _NUMERIC_KINDS:
+            return table.falses()
+        return (lengths >= 0) & (lengths == sizes)
+    if op.is_size_gt():
+        return lengths > value
+    if op.is_size_lt():
+        return (lengths >= 0) & (lengths < value)
+    return lengths == value
@@ -19,7 +19,7 @@ coll.find("beverage = 'beer' and IBU > 20")
 __author__ = 'Dan Gunter <dkgunter@lbl.gov>'
 __date__ = '9/6/13'
 
-from .query import to_mongo, BadExpression
+from .query import to_mongo, to_find_spec, BadExpression, FindSpec, _has_clauses
 
 have_pymongo = False
 try:
@@ -34,74 +34,204 @@ if have_pymongo:
     from pymongo.database import Database as _Database
     from pymongo.collection import Collection as _Collection
 
-    spec_pos = 1   # which arg
-
-    def smoq_spec(or_id):
-        """Run to_mongo() on string or list 'spec' arguments.
+    from .rawbson import documents
+
+    # Wrapped methods, with the position of the query argument (not counting
+    # 'self') and whether a string that is not a query can be a document _id.
+    # Methods that this version of pymongo lacks (e.g. remove/update in
+    # pymongo 4) are skipped.
+    WRAPPED_METHODS = (
+        ('find', 0, False), ('find_one', 0, True), ('find_raw_batches', 0, False),
+        ('count_documents', 0, False), ('distinct', 1, False),
+        ('delete_one', 0, False), ('delete_many', 0, False),
+        ('update_one', 0, False), ('update_many', 0, False), ('replace_one', 0, False),
+        ('find_one_and_delete', 0, False), ('find_one_and_replace', 0, False),
+        ('find_one_and_update', 0, False),
+        # pymongo < 4
+        ('count', 0, False), ('remove', 0, False), ('update', 0, True),
+    )
+
+    # Keyword names of the query argument, in different pymongo versions
+    SPEC_KEYWORDS = ('filter', 'spec', 'spec_or_id')
+
+    # Methods that take options from the 'select', 'order by', 'limit' and 'skip'
+    # clauses of a query: the options each method takes, with the position of
+    # the argument for each (not counting 'self'), or None if it is keyword-only.
+    _CURSOR_OPTIONS = {'projection': 1, 'skip': 2, 'limit': 3, 'sort': 6}
+    FIND_OPTIONS = {
+        'find': _CURSOR_OPTIONS,
+        'find_raw_batches': _CURSOR_OPTIONS,
+        'find_one': {'projection': 1, 'skip': 2, 'sort': 6},
+        'count_documents': {'limit': None, 'skip': None},
+        'find_one_and_delete': {'projection': 1, 'sort': 2},
+        'find_one_and_replace': {'projection': 2, 'sort': 3},
+        'find_one_and_update': {'projection': 2, 'sort': 3},
+    }
+
+    # Default number of documents per batch for `Collection.find_raw()`
+    RAW_BATCH_SIZE = 1000
+
+    # Query clause of each option, for errors
+    _CLAUSES = {'projection': 'select', 'sort': 'order by', 'limit': 'limit', 'skip': 'skip'}
+
+    def _rewrite(spec, or_id, find=False):
+        """Run to_mongo() on a string or list query,
+        or with `find`, to_find_spec().
         """
-        def wrap(fn):
-            def wrapped_fn(*args, **kwargs):
-                # find spec
-                spec, in_args = None, False
-                if len(args) > spec_pos:    # 0-th is 'self'
-                    spec = args[spec_pos]
-                    in_args = True
-                elif 'spec' in kwargs:
-                    spec = kwargs['spec']
-                if spec is not None and (
-                        isinstance(spec, str) or isinstance(spec, list)):
-                    try:
-                        spec = to_mongo(spec)
-                        if in_args:
-                            args = list(args)
-                            args[spec_pos] = spec
-                        else:
-                            kwargs['spec'] = spec
-                    except BadExpression as err:
-                        if or_id:
-                            pass   # treat as id, so ignore err
+        try:
+            return to_find_spec(spec) if find else to_mongo(spec)
+        except BadExpression as err:
+            if or_id:
+                return FindSpec(spec) if find else spec   # treat as id
+            raise pymongo.errors.InvalidOperation('{}: {}'.format(err, err.details))
+
+    def _find_options(name, find_spec, positions, args, kwargs):
+        """Add the options from a query to the keyword arguments of a method.
+        Options given by the caller, by position or keyword, take precedence.
+        """
+        options = find_spec.options()
+        for key, value in options.items():
+            if key not in positions:
+                raise pymongo.errors.InvalidOperation("'{}' clause not allowed for {}()".format(
+                    _CLAUSES[key], name))
+            pos = positions[key]
+            if pos is None or len(args) <= pos:
+                kwargs.setdefault(key, value)
+
+    def _wrap_method(cls, name, pos, or_id):
+        """Wrap a method of a collection class so a smoqe query can be given
+        in place of the MongoDB query, in position `pos` or by keyword.
+        The result of the method is returned as-is, so this works
+        for coroutine methods too.
+        """
+        base = getattr(cls, name)
+
+        if name not in FIND_OPTIONS:
+            def method(self, *args, **kwargs):
+                if len(args) > pos:
+                    spec = args[pos]
+                    if type(spec) is str or type(spec) is list:
+                        args = args[:pos] + (_rewrite(spec, or_id),) + args[pos + 1:]
+                elif kwargs:
+                    for key in SPEC_KEYWORDS:
+                        spec = kwargs.get(key)
+                        if type(spec) is str or type(spec) is list:
+                            kwargs[key] = _rewrite(spec, or_id)
+                            break
+                return base(self, *args, **kwargs)
+        else:
+            positions = FIND_OPTIONS[name]
+
+            def method(self, *args, **kwargs):
+                find_spec = None
+                if len(args) > pos:
+                    spec = args[pos]
+                    if type(spec) is list:
+                        args = args[:pos] + (_rewrite(spec, or_id),) + args[pos + 1:]
+                    elif type(spec) is str:
+                        if _has_clauses(spec):
+                            find_spec = _rewrite(spec, or_id, find=True)
+                            spec = find_spec.filter
                         else:
-                            raise pymongo.errors.InvalidOperation(str(err))
-                return fn(*args, **kwargs)
-            return wrapped_fn
-        return wrap
+                            spec = _rewrite(spec, or_id)
+                        args = args[:pos] + (spec,) + args[pos + 1:]
+                elif kwargs:
+                    for key in SPEC_KEYWORDS:
+                        spec = kwargs.get(key)
+                        if type(spec) is str and _has_clauses(spec):
+                            find_spec = _rewrite(spec, or_id, find=True)
+                            kwargs[key] = find_spec.filter
+                            break
+                        if type(spec) is str or type(spec) is list:
+                            kwargs[key] = _rewrite(spec, or_id)
+                            break
+                if find_spec is not None:
+                    _find_options(name, find_spec, positions, args, kwargs)
+                return base(self, *args, **kwargs)
+        method.__name__ = name
+        method.__doc__ = base.__doc__
+        return method
 
     class Collection(_Collection):
-        @smoq_spec(False)
-        def find(self, *args, **kwargs):
-            return _Collection.find(self, *args, **kwargs)
-
-        @smoq_spec(True)
-        def find_one(self, *args, **kwargs):
-            return _Collection.find(self, *args, **kwargs)
-
-        @smoq_spec(False)
-        def remove(self, *args, **kwargs):
-            return _Collection.remove(self, *args, **kwargs)
+        """pymongo Collection whose query methods accept smoqe queries.
+        """
+        def find_raw(self, *args, **kwargs):
+            """Run a query, and get the results in batches of documents
+            that are not decoded, e.g. to forward them as they are, or to
+            decode only some fields with :py:class:`smoqe.rawbson.FieldDecoder`.
+
+            The arguments are those of `find_raw_batches()`, which takes a
+            smoqe query as `find()` does, including its clauses.
+
+            :param batch_size: Number of documents in each batch
+                               (default `RAW_BATCH_SIZE`)
+            :type batch_size: int
+            :return: Iterator over the batches, each a list of documents
+            :rtype: iterator(list(RawBSONDocument))
+            :raises: InvalidOperation, if the query cannot be parsed
+            """
+            kwargs.setdefault('batch_size', RAW_BATCH_SIZE)
+            cursor = self.find_raw_batches(*args, **kwargs)
+            return (documents(data) for data in cursor)
+
+    def _wrap_collection_class(cls, base):
+        """Add the wrapped query methods of `base` to its subclass `cls`.
+        """
+        for name, pos, or_id in WRAPPED_METHODS:
+            if hasattr(base, name):
+                setattr(cls, name, _wrap_method(base, name, pos, or_id))
 
-        @smoq_spec(True)
-        def update(self, *args, **kwargs):
-            return _Collection.update(self, *args, **kwargs)
+    _wrap_collection_class(Collection, _Collection)
 
     class Database(_Database):
+        """pymongo Database that returns wrapped collections,
+        with one handle per collection name.
+        """
+        def __init__(self, *args, **kwargs):
+            _Database.__init__(self, *args, **kwargs)
+            self._smoqe_collections = {}
+
         def __getitem__(self, item):
-            return Collection(self, item)
+            try:
+                return self._smoqe_collections[item]
+            except KeyError:
+                return self._smoqe_collections.setdefault(item, Collection(self, item))
+
         def __getattr__(self, item):
-            return Collection(self, item)
+            if item.startswith('_'):
+                raise AttributeError(item)
+            return self[item]
 
     class MongoClient(_MongoClient):
         """Drop-in replacement for pymongo.MongoClient.
 
-        Three functions are enabled:
-
-        * find
-        * update
-        * remove
-
-        In each case, the `spec` argument will be transparently
-        pre-processed as a smoqe query if it is a string or list.
+        The query methods of collections, e.g.
+
+        * find, find_one
+        * count_documents, distinct
+        * update_one, update_many, delete_one, delete_many
+        * update, remove (pymongo < 4)
+
+        transparently pre-process the query (`filter` or `spec`) argument
+        as a smoqe query if it is a string or list. For the methods that take
+        them, the ``select``, ``order by``, ``limit`` and ``skip`` clauses of the
+        query (see :py:func:`smoqe.to_find_spec`) set the projection, sort, limit
+        and skip, so the server can use an index for the sort and return only
+        the documents and fields that are needed.
+        Databases and collections reached by attribute or item access
+        are created once per name and reused.
         """
+        def __init__(self, *args, **kwargs):
+            self._smoqe_databases = {}
+            _MongoClient.__init__(self, *args, **kwargs)
+
         def __getitem__(self, item):
-            return Database(self, item)
+            try:
+                return self._smoqe_databases[item]
+            except KeyError:
+                return self._smoqe_databases.setdefault(item, Database(self, item))
+
         def __getattr__(self, item):
-            return Database(self, item)
+            if item.startswith('_'):
+                raise AttributeError(item)
+            return self[item]